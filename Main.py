@@ -1,7 +1,32 @@
 import logging
+import logging.handlers
+import queue
 import sys
+import asyncio
+import time
+import datetime
+import itertools
+import pickle
+import tempfile
+import json
+import csv
+import io
+import sqlite3
+import functools
+import math
+import random
+import bisect
+import heapq
+import contextvars
+import contextlib
+import threading
+import importlib.util
+from dataclasses import dataclass, fields
+from collections import OrderedDict, deque
+from array import array
+from types import MappingProxyType
 import os # Import modul os, meskipun sebagian besar Railway-specific logic dihapus, tetap ada untuk kompatibilitas jika diperlukan di masa depan.
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Chat
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Chat
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -11,13 +36,18 @@ from telegram.ext import (
     ConversationHandler,
     MessageHandler,
     filters,
-    PicklePersistence,
+    BasePersistence,
+    PersistenceInput,
+    BaseUpdateProcessor,
 )
-from telegram.error import BadRequest, Forbidden
+from telegram.request import BaseRequest, HTTPXRequest
+import httpx
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
 
-# Enable logging
+# Enable logging (konfigurasi awal; saat bot dijalankan diganti configure_logging() sesuai LOG_* di bawah)
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format=LOG_TEXT_FORMAT,
     level=logging.INFO,
     stream=sys.stdout
 )
@@ -38,214 +68,1255 @@ REQUIRED_CHANNEL_LINK = "https://t.me/Privateyyds"
 IMAGE_URL_VERIFICATION = "https://i.imgur.com/JS49Nau.jpeg" # Gambar untuk menu verifikasi/selamat datang
 IMAGE_URL_MAIN_MENU = "https://i.imgur.com/T1r2fbC.jpeg" # Gambar untuk menu utama pribadi & grup
 
+# File lokal cadangan (opsional) jika file_id tersimpan ditolak dan URL Imgur juga gagal diambil Telegram
+IMAGE_LOCAL_FALLBACKS = {
+    IMAGE_URL_VERIFICATION: os.path.join("assets", "verification.jpeg"),
+    IMAGE_URL_MAIN_MENU: os.path.join("assets", "main_menu.jpeg"),
+}
+# Chat (misal channel log pribadi) untuk meng-upload gambar menu sekali saat startup; kosongkan untuk melewati warm-up
+PHOTO_WARMUP_CHAT_ID = os.getenv("PHOTO_WARMUP_CHAT_ID")
+
+# Lokasi database SQLite untuk persistence, dan file pickle lama yang akan dimigrasikan otomatis
+PERSISTENCE_DB_PATH = os.getenv("PERSISTENCE_DB_PATH", "my_bot_data.sqlite3")
+LEGACY_PICKLE_PATH = "my_bot_data.pkl"
+# Jumlah maksimum entri user_data / chat_data yang disimpan di memori (masing-masing). Entri dimuat dari
+# database saat pertama diakses dan entri yang paling lama tidak dipakai dikembalikan ke database.
+# 0 = mode lama: semua data dimuat saat startup dan tinggal di memori selamanya.
+DATA_CACHE_MAX_ENTRIES = int(os.getenv("DATA_CACHE_MAX_ENTRIES", "20000"))
+
+# Jurnal write-ahead untuk ban yang belum selesai (diputar ulang saat startup), dan jumlah record
+# yang ditulis sebelum jurnal dipadatkan ulang (hanya menyisakan ban yang belum selesai)
+BAN_JOURNAL_PATH = os.getenv("BAN_JOURNAL_PATH", "ban_journal.jsonl")
+BAN_JOURNAL_COMPACT_RECORDS = int(os.getenv("BAN_JOURNAL_COMPACT_RECORDS", "10000"))
+
+# Batas kecepatan antrian dispatch ban (mengikuti flood limit Telegram: ~30 request/detik global,
+# ~1 pesan/detik per chat). Bisa diatur lewat environment variable.
+DISPATCH_GLOBAL_RATE = float(os.getenv("DISPATCH_GLOBAL_RATE", "25"))
+DISPATCH_BAN_CHAT_RATE = float(os.getenv("DISPATCH_BAN_CHAT_RATE", "5"))
+DISPATCH_MESSAGE_CHAT_RATE = float(os.getenv("DISPATCH_MESSAGE_CHAT_RATE", "1"))
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+DISPATCH_MAX_PENDING = int(os.getenv("DISPATCH_MAX_PENDING", "20000"))
+DISPATCH_MAX_ATTEMPTS = int(os.getenv("DISPATCH_MAX_ATTEMPTS", "5"))
+
+# Mode notifikasi blokir: 'instant' (satu pesan per ban) atau 'digest' (ringkasan gabungan).
+# Ringkasan dikirim setelah NOTIFY_DIGEST_WINDOW detik atau saat sudah terkumpul NOTIFY_DIGEST_MAX_ENTRIES entri.
+NOTIFY_DIGEST_WINDOW = float(os.getenv("NOTIFY_DIGEST_WINDOW", "30"))
+NOTIFY_DIGEST_MAX_ENTRIES = int(os.getenv("NOTIFY_DIGEST_MAX_ENTRIES", "50"))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+NOTIFICATION_MODE_LABELS = {'instant': "Instan", 'digest': "Ringkasan"}
+
+# Masa berlaku (detik) cache hasil pemeriksaan izin admin bot per chat
+BOT_PERMISSION_CACHE_TTL = float(os.getenv("BOT_PERMISSION_CACHE_TTL", "600"))
+
+# Masa berlaku (detik) cache keanggotaan channel wajib: hasil positif disimpan lebih lama
+# daripada hasil negatif, supaya pengguna yang baru bergabung cepat terverifikasi.
+MEMBERSHIP_CACHE_POSITIVE_TTL = float(os.getenv("MEMBERSHIP_CACHE_POSITIVE_TTL", "3600"))
+MEMBERSHIP_CACHE_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_CACHE_NEGATIVE_TTL", "15"))
+
+# Jendela (detik) dedup ban: event "left" untuk pasangan (chat, user) yang sama dalam jendela ini diabaikan
+# (update duplikat/ter-replay setelah reconnect). Jumlah entri dibatasi supaya memori tetap konstan.
+BAN_DEDUP_WINDOW = float(os.getenv("BAN_DEDUP_WINDOW", "300"))
+BAN_DEDUP_MAX_ENTRIES = int(os.getenv("BAN_DEDUP_MAX_ENTRIES", "50000"))
+
+# Deteksi lonjakan keluar (surge): jika dalam SURGE_WINDOW detik ada SURGE_THRESHOLD event left atau lebih di satu
+# chat, chat masuk "surge mode": ban diproses lewat jalur lambat terpisah (SURGE_BAN_CHAT_RATE ban/detik per chat),
+# pemilik mendapat satu peringatan, dan notifikasi per user diganti satu ringkasan saat surge selesai. Surge selesai
+# setelah laju turun di bawah separuh ambang selama SURGE_COOLDOWN detik dan semua ban-nya sudah diproses.
+SURGE_WINDOW = float(os.getenv("SURGE_WINDOW", "60"))
+SURGE_THRESHOLD = int(os.getenv("SURGE_THRESHOLD", "100"))
+SURGE_COOLDOWN = float(os.getenv("SURGE_COOLDOWN", "120"))
+SURGE_BAN_CHAT_RATE = float(os.getenv("SURGE_BAN_CHAT_RATE", "2"))
+SURGE_TRACKED_CHATS = int(os.getenv("SURGE_TRACKED_CHATS", "10000")) # Batas chat yang punya penghitung di memori
+
+# Batas waktu (detik) saat shutdown (SIGTERM saat deploy) untuk menuntaskan ban & notifikasi yang masih antri.
+# Harus di bawah masa tenggang platform sebelum proses di-SIGKILL (umumnya 10 detik). Ban yang belum sempat
+# diproses tetap tercatat di jurnal dan diputar ulang saat startup berikutnya.
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "8"))
+
+# Logging: LOG_QUEUE=1 membuat log ditulis ke stdout oleh thread terpisah (QueueListener), jadi event loop tidak
+# pernah menunggu stdout. LOG_FORMAT 'text' atau 'json' (satu objek JSON per baris). Jika stdout macet sampai antrian
+# berisi LOG_QUEUE_MAX_RECORDS record, record baru di-drop (dihitung di metrik), bukan menahan bot.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_QUEUE = os.getenv("LOG_QUEUE", "1") != "0"
+LOG_QUEUE_MAX_RECORDS = int(os.getenv("LOG_QUEUE_MAX_RECORDS", "100000"))
+# Sampling warning/error berulang: per chat, baris dengan template yang sama maksimal LOG_SAMPLE_LIMIT kali
+# per LOG_SAMPLE_WINDOW detik (sisanya dihitung dan dilaporkan di baris berikutnya). 0 = nonaktif.
+LOG_SAMPLE_LIMIT = int(os.getenv("LOG_SAMPLE_LIMIT", "20"))
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", "60"))
+
+# Alamat Bot API alternatif (misal server Bot API lokal atau server palsu loadtest.py); kosong = api.telegram.org
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")
+
+# Koneksi HTTP ke Bot API. Panggilan API (ban, notifikasi, menu, cek izin) dan long-polling getUpdates memakai
+# pool terpisah, jadi getUpdates yang menggantung menunggu update tidak pernah memakan slot koneksi untuk ban.
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "256"))
+# Koneksi idle yang disimpan untuk dipakai ulang agar burst tidak membuka koneksi TCP/TLS baru (0 = seukuran pool)
+BOT_API_KEEPALIVE_CONNECTIONS = int(os.getenv("BOT_API_KEEPALIVE_CONNECTIONS", "0"))
+BOT_API_KEEPALIVE_EXPIRY = float(os.getenv("BOT_API_KEEPALIVE_EXPIRY", "30"))
+# Jumlah koneksi per shard pool. Satu pool httpx besar memeriksa semua koneksinya untuk setiap request, jadi pool
+# dipecah menjadi beberapa client kecil (256 koneksi = 16 client x 16 koneksi).
+BOT_API_POOL_SHARD_SIZE = int(os.getenv("BOT_API_POOL_SHARD_SIZE", "16"))
+# Batas waktu (detik): menunggu slot pool, membuka koneksi, membaca respons, mengirim request
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", "1"))
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", "5"))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", "5"))
+# "2" = HTTP/2 (banyak request dalam satu koneksi); butuh paket h2: pip install "python-telegram-bot[http2]"
+BOT_API_HTTP_VERSION = os.getenv("BOT_API_HTTP_VERSION", "1.1")
+# Pool untuk getUpdates (mode polling). Hanya ada satu long-poll aktif, jadi 1 koneksi sudah cukup.
+GET_UPDATES_POOL_SIZE = int(os.getenv("GET_UPDATES_POOL_SIZE", "1"))
+
+# Mode webhook: aktif jika WEBHOOK_URL (URL publik bot, misal https://nama-app.up.railway.app) diatur.
+# Tanpa WEBHOOK_URL bot berjalan dengan polling seperti biasa.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") # Dicocokkan dengan header X-Telegram-Bot-Api-Secret-Token
+# Jumlah update yang diproses bersamaan (1 = berurutan). Default lebih tinggi di mode webhook.
+# Update dari chat yang sama tetap diproses berurutan (lihat ChatSequentialUpdateProcessor).
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16" if WEBHOOK_URL else "1"))
+
+# Batas antrian update per chat saat concurrent updates aktif; update di atas batas ini di-drop (tercatat di statistik)
+UPDATE_QUEUE_PER_CHAT = int(os.getenv("UPDATE_QUEUE_PER_CHAT", "500"))
+# Batas total update yang boleh tertahan di memori (sedang diproses + menunggu giliran)
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "10000"))
+
+# Update chat_member/my_chat_member (event keluar & perubahan izin bot) didahulukan dari menu/perintah saat antrian
+# update menumpuk. 0 = urutan masuk biasa (FIFO) untuk semua jenis update.
+UPDATE_PRIORITY_LANE = os.getenv("UPDATE_PRIORITY_LANE", "1") != "0"
+
+# Endpoint metrik Prometheus (GET /metrics); 0 = nonaktif. Default hanya mendengarkan di localhost.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Batas bucket (detik) untuk histogram latensi handler & Bot API
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bucket untuk latensi event keluar -> ban selesai (bisa puluhan detik saat antrian ban dibatasi flood limit)
+METRICS_LEAVE_BAN_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Allowlist di database SQLite sendiri, supaya import besar (ditulis dari thread) tidak mengunci database persistence
+# yang ditulis langsung di event loop. Versi lama menyimpannya di PERSISTENCE_DB_PATH; dipindahkan sekali saat startup
+ALLOWLIST_DB_PATH = os.getenv("ALLOWLIST_DB_PATH", "allowlist.sqlite3")
+# Ukuran maksimum file import allowlist (batas download Bot API juga 20 MB)
+ALLOWLIST_MAX_IMPORT_BYTES = int(os.getenv("ALLOWLIST_MAX_IMPORT_BYTES", "20000000"))
+
+# Riwayat hasil ban (untuk /stats & /export) di database SQLite terpisah; string kosong = nonaktif
+BAN_AUDIT_DB_PATH = os.getenv("BAN_AUDIT_DB_PATH", "ban_audit.sqlite3")
+# Record yang menunggu ditulis thread penulis; jika penuh, record baru dibuang (dihitung di metrik) daripada menahan event loop
+BAN_AUDIT_MAX_PENDING = int(os.getenv("BAN_AUDIT_MAX_PENDING", "100000"))
+# Record per transaksi; saat burst semua yang sudah antri ikut satu commit sampai batas ini
+BAN_AUDIT_BATCH_SIZE = int(os.getenv("BAN_AUDIT_BATCH_SIZE", "5000"))
+# Baris mentah disimpan per bulan; partisi yang lebih tua dari ini dihapus (rekap harian tetap disimpan). 0 = simpan semua
+BAN_AUDIT_RETENTION_MONTHS = int(os.getenv("BAN_AUDIT_RETENTION_MONTHS", "12"))
+# Zona waktu pembagian hari/bulan di statistik dan waktu di file export (default WIB)
+BAN_AUDIT_UTC_OFFSET_HOURS = float(os.getenv("BAN_AUDIT_UTC_OFFSET_HOURS", "7"))
+# Batas ukuran file /export (batas upload dokumen Bot API 50 MB); baris terlama dipotong jika lebih
+BAN_AUDIT_EXPORT_MAX_BYTES = int(os.getenv("BAN_AUDIT_EXPORT_MAX_BYTES", "45000000"))
+
+# Audit izin berkala (JobQueue): setiap PERMISSION_AUDIT_INTERVAL detik izin 'Ban Users' bot diperiksa ulang di semua
+# chat yang banning-nya aktif, disebar merata sepanjang interval dengan paling banyak PERMISSION_AUDIT_CONCURRENCY
+# pemeriksaan bersamaan. 0 = nonaktif. Butuh paket job-queue: pip install "python-telegram-bot[job-queue]"
+PERMISSION_AUDIT_INTERVAL = float(os.getenv("PERMISSION_AUDIT_INTERVAL", "21600"))
+# Job audit berjalan setiap PERMISSION_AUDIT_TICK detik dan hanya memeriksa satu batch kecil per jalan, supaya
+# Application.stop() (yang menunggu job yang sedang berjalan) tidak tertahan lama saat SIGTERM/redeploy
+PERMISSION_AUDIT_TICK = float(os.getenv("PERMISSION_AUDIT_TICK", "30"))
+PERMISSION_AUDIT_CONCURRENCY = int(os.getenv("PERMISSION_AUDIT_CONCURRENCY", "4"))
+# Ban yang gagal (Forbidden/BadRequest) memicu pemeriksaan izin chat tersebut, paling sering sekali per jendela ini
+PERMISSION_RECHECK_WINDOW = float(os.getenv("PERMISSION_RECHECK_WINDOW", "60"))
+
+# Batas channel/grup yang boleh didaftarkan satu pemilik, dan jumlah channel per halaman di menu daftar channel
+OWNER_MAX_CHANNELS = int(os.getenv("OWNER_MAX_CHANNELS", "200"))
+CHANNEL_MENU_PAGE_SIZE = int(os.getenv("CHANNEL_MENU_PAGE_SIZE", "8"))
+
+# /start, /cancel & input channel mengedit menu foto lama di tempat (bukan hapus + kirim ulang) selama paling banyak
+# sekian pesan lain muncul setelah menu itu (id pesan berurutan per chat); jika lebih, menu dikirim ulang di bawah
+MENU_EDIT_IN_PLACE_MAX_GAP = int(os.getenv("MENU_EDIT_IN_PLACE_MAX_GAP", "3"))
+# Jumlah pesan menu yang isi terakhirnya diingat di memori, supaya edit yang tidak mengubah apa pun dilewati
+MENU_RENDER_CACHE_SIZE = int(os.getenv("MENU_RENDER_CACHE_SIZE", "50000"))
+
 # States untuk ConversationHandler dalam alur pengaturan channel pribadi
 GET_CHANNEL_ID = range(1)
 
+# --- CACHE DENGAN MASA BERLAKU (TTL) ---
+
+class TTLCache:
+    """
+    Cache sederhana dengan masa berlaku per entri, ukuran maksimum, dan penghitung hit/miss
+    untuk melihat berapa banyak panggilan Bot API yang berhasil dihemat.
+    Entri disimpan urut waktu set, jadi saat penuh entri yang paling lama di-set (biasanya sudah atau hampir
+    kedaluwarsa) dibuang dari depan dalam O(1); entri kedaluwarsa lainnya dibuang saat dibaca.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict() # key -> (waktu kedaluwarsa, value), urut waktu set
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl: float = None) -> None:
+        if key in self._data:
+            self._data.move_to_end(key)
+        elif len(self._data) >= self.max_size:
+            self._data.popitem(last=False)
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+
+    def invalidate(self, key) -> None:
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class RecentKeys:
+    """
+    Himpunan key yang baru dilihat dengan jendela waktu tetap dan jumlah entri maksimum (untuk dedup).
+    Entri disimpan urut waktu masuk, jadi entri kedaluwarsa dan entri tertua (saat penuh) selalu
+    dibuang dari depan dalam O(1); memori tidak bergantung pada jumlah chat yang dimonitor.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._seen: OrderedDict = OrderedDict() # key -> waktu pertama kali dilihat
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def check_and_add(self, key) -> bool:
+        """Mengembalikan True jika key sudah terlihat dalam jendela (duplikat); jika belum, key dicatat."""
+        now = time.monotonic()
+        seen = self._seen
+        while seen:
+            first_seen = next(iter(seen.values()))
+            if now - first_seen < self.window:
+                break
+            seen.popitem(last=False)
+        if key in seen:
+            self.hits += 1
+            return True
+        self.misses += 1
+        if len(seen) >= self.max_size:
+            seen.popitem(last=False)
+            self.evictions += 1
+        seen[key] = now
+        return False
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+# --- LOGGING (ANTRIAN, TIDAK MEMBLOKIR EVENT LOOP) ---
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler yang tidak memformat record di thread pemanggil. Hanya pesan (msg % args) yang digabung, supaya
+    argumen yang bisa berubah (misal dict statistik) tercatat sesuai nilainya saat itu; waktu, JSON, dan traceback
+    diformat oleh thread QueueListener. Jika antrian penuh, record di-drop dan dihitung, bukan menahan event loop.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class ChatLogSampler(logging.Filter):
+    """
+    Membatasi warning/error berulang per chat. Record dengan atribut chat_id (lewat extra=) dan template pesan yang
+    sama hanya diteruskan `limit` kali per `window` detik; jumlah yang di-suppress ditempelkan ke baris pertama
+    jendela berikutnya. Jumlah pasangan (chat, template) yang diingat dibatasi (LRU), jadi memori tetap kecil.
+    """
+    MAX_KEYS = 10000
+
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._windows: OrderedDict = OrderedDict() # (chat_id, template) -> [awal jendela, jumlah, di-suppress]
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        chat_id = getattr(record, "chat_id", None)
+        if chat_id is None or not logging.WARNING <= record.levelno < logging.CRITICAL:
+            return True
+        key = (chat_id, record.msg)
+        now = time.monotonic()
+        entry = self._windows.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            skipped = entry[2] if entry else 0
+            self._windows[key] = [now, 1, 0]
+            self._windows.move_to_end(key)
+            if len(self._windows) > self.MAX_KEYS:
+                self._windows.popitem(last=False)
+            if skipped and isinstance(record.args, tuple):
+                if not record.args:
+                    record.msg = str(record.msg).replace("%", "%%")
+                record.msg = f"{record.msg} (+%d baris serupa di-suppress)"
+                record.args = record.args + (skipped,)
+            return True
+        entry[1] += 1
+        if entry[1] <= self.limit:
+            return True
+        entry[2] += 1
+        self.suppressed += 1
+        return False
+
+class JsonLogFormatter(logging.Formatter):
+    """Satu objek JSON per baris: ts, level, logger, msg, chat_id (jika ada), dan exc (traceback, jika ada)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        chat_id = getattr(record, "chat_id", None)
+        if chat_id is not None:
+            entry["chat_id"] = chat_id
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+log_sampler = ChatLogSampler(LOG_SAMPLE_LIMIT, LOG_SAMPLE_WINDOW)
+log_queue_handler: NonBlockingQueueHandler = None
+log_listener: logging.handlers.QueueListener = None
+
+def configure_logging() -> None:
+    """Mengganti handler stdout dari basicConfig sesuai LOG_LEVEL/LOG_FORMAT/LOG_QUEUE (dipanggil sekali dari main())."""
+    global log_queue_handler, log_listener
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    # httpx mencatat setiap request Bot API di level INFO, saat burst berarti satu baris per ban/notifikasi
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter(LOG_TEXT_FORMAT))
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = stream_handler
+    if LOG_QUEUE:
+        handler = log_queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_MAX_RECORDS))
+        log_listener = logging.handlers.QueueListener(log_queue_handler.queue, stream_handler, respect_handler_level=True)
+        log_listener.start()
+    if LOG_SAMPLE_LIMIT:
+        handler.addFilter(log_sampler)
+    root.addHandler(handler)
+
+def stop_logging() -> None:
+    """Menulis sisa record di antrian dan menghentikan thread QueueListener."""
+    if log_listener:
+        log_listener.stop()
+
+# --- METRIK (FORMAT PROMETHEUS) ---
+
+# Handler/konteks yang sedang berjalan, dipakai untuk mengatribusikan panggilan Bot API ke handler pemicunya.
+# Task yang dibuat dari dalam handler (create_task) ikut mewarisi nilainya.
+current_metrics_scope: contextvars.ContextVar[str] = contextvars.ContextVar("current_metrics_scope", default="none")
+
+class Histogram:
+    """Histogram kumulatif sederhana (detik) dengan bucket tetap, cukup untuk dihitung p50/p99 di Prometheus."""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple = METRICS_LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # Bucket terakhir = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+class MetricsRegistry:
+    """
+    Penampung seluruh metrik bot. Histogram dan counter diperbarui langsung di jalur panas (tanpa lock,
+    semuanya berjalan di satu event loop); nilai gauge dari komponen lain (dispatcher, cache, processor)
+    diambil lewat collector saat endpoint /metrics dibaca.
+    """
+
+    def __init__(self):
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.help: dict[str, tuple[str, str]] = {} # nama metrik -> (tipe, deskripsi)
+        self.buckets: dict[str, tuple] = {} # nama histogram -> batas bucket (default METRICS_LATENCY_BUCKETS)
+        self._collectors = []
+
+    def describe(self, name: str, kind: str, description: str, buckets: tuple = None) -> None:
+        self.help[name] = (kind, description)
+        if buckets:
+            self.buckets[name] = buckets
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets.get(name, METRICS_LATENCY_BUCKETS))
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_collector(self, collector) -> None:
+        """collector() mengembalikan iterable (nama, tipe, deskripsi, [(labels, nilai), ...])."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Menghasilkan seluruh metrik dalam format teks Prometheus (text/plain; version=0.0.4)."""
+        families: dict[str, list[str]] = {}
+        for (name, labels), value in self.counters.items():
+            families.setdefault(name, []).append(f"{name}{_format_labels(dict(labels))} {value}")
+        for (name, labels), histogram in self.histograms.items():
+            lines = families.setdefault(name, [])
+            labels = dict(labels)
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels({**labels, 'le': le})} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        output = []
+        for name, lines in families.items():
+            kind, description = self.help.get(name, ("untyped", name))
+            output += [f"# HELP {name} {description}", f"# TYPE {name} {kind}", *lines]
+        for collector in self._collectors:
+            try:
+                for name, kind, description, samples in collector():
+                    output += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+                    output += [f"{name}{_format_labels(labels)} {value}" for labels, value in samples]
+            except Exception as e:
+                logger.error("Collector metrik %s error: %s", collector.__name__, e)
+        return "\n".join(output) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("bot_handler_duration_seconds", "histogram", "Durasi eksekusi handler/fungsi bot.")
+metrics.describe("bot_handler_errors_total", "counter", "Exception yang keluar dari handler, per tipe error.")
+metrics.describe("bot_api_request_duration_seconds", "histogram", "Durasi panggilan Bot API per method.")
+metrics.describe("bot_api_calls_total", "counter", "Panggilan Bot API per method dan handler pemicunya.")
+metrics.describe("bot_api_errors_total", "counter", "Error dari Bot API per method dan tipe (RetryAfter, BadRequest, ...).")
+metrics.describe("bot_event_loop_lag_seconds", "histogram", "Keterlambatan event loop (waktu tidur aktual dikurangi yang diminta).")
+metrics.describe("bot_http_pool_wait_seconds", "histogram", "Waktu menunggu slot koneksi HTTP ke Bot API, per lane (api/updates).")
+metrics.describe("bot_leave_to_ban_seconds", "histogram", "Waktu dari update event keluar diterima bot sampai ban-nya selesai, per jalur ban.",
+                 buckets=METRICS_LEAVE_BAN_BUCKETS)
+
+def instrumented(name: str):
+    """Decorator untuk fungsi async: mencatat durasi & error ke metrik dan menandai panggilan API di dalamnya dengan `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            # Fungsi bantu yang dipanggil dari handler lain tetap mengatribusikan panggilan API ke handler luarnya
+            token = current_metrics_scope.set(name) if current_metrics_scope.get() == "none" else None
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                metrics.inc("bot_handler_errors_total", handler=name, error=type(e).__name__)
+                raise
+            finally:
+                metrics.observe("bot_handler_duration_seconds", time.perf_counter() - started, handler=name)
+                if token is not None:
+                    current_metrics_scope.reset(token)
+        return wrapper
+    return decorator
+
+def instrument_handlers(application: Application) -> None:
+    """Membungkus callback setiap handler yang terdaftar (termasuk di dalam ConversationHandler) dengan `instrumented`."""
+    def wrap(handler) -> None:
+        if isinstance(handler, ConversationHandler):
+            for inner in itertools.chain(handler.entry_points, handler.fallbacks, *handler.states.values()):
+                wrap(inner)
+        elif not getattr(handler.callback, "__wrapped__", None):
+            handler.callback = instrumented(handler.callback.__name__)(handler.callback)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+http_lanes: dict[str, "InstrumentedRequest"] = {}
+
+class InstrumentedRequest(BaseRequest):
+    """
+    Request Bot API untuk satu lane (api/updates) yang mencatat jumlah panggilan, durasi, dan error setiap method.
+
+    Pool koneksi lane dibagi ke beberapa HTTPXRequest kecil (shard). httpcore memeriksa setiap koneksi di pool
+    untuk setiap request yang antri, jadi satu pool besar berisi puluhan koneksi keep-alive memakan CPU event loop
+    saat burst; shard berukuran kecil menjaga pemeriksaan itu tetap murah. Setiap request harus mendapat slot dari
+    gate seukuran total pool sebelum dikirim ke shard yang paling sedikit dipakai, sehingga waktu menunggu koneksi
+    bebas dan pemakaian pool bisa diukur per lane.
+    """
+
+    def __init__(self, lane: str, pool_size: int, shard_size: int, keepalive: int, **kwargs):
+        self.lane = lane
+        self.size = pool_size
+        shard_count = -(-pool_size // max(1, shard_size))
+        self.shards = []
+        for index in range(shard_count):
+            # Bagi pool (dan koneksi keep-alive) serata mungkin ke setiap shard
+            connections = pool_size // shard_count + (index < pool_size % shard_count)
+            limits = httpx.Limits(max_connections=connections,
+                                  max_keepalive_connections=min(connections, -(-keepalive * connections // pool_size)),
+                                  keepalive_expiry=BOT_API_KEEPALIVE_EXPIRY)
+            # HTTPXRequest hanya mengatur max_connections; limits lengkap (keep-alive) diteruskan langsung ke httpx
+            self.shards.append(HTTPXRequest(connection_pool_size=connections, httpx_kwargs={"limits": limits}, **kwargs))
+        self._shard_load = [0] * shard_count
+        self._gate = asyncio.Semaphore(pool_size)
+        self.in_use = 0
+        self.peak = 0
+        self.waiting = 0
+        self.pool_timeouts = 0
+        http_lanes[lane] = self
+
+    @property
+    def read_timeout(self) -> float | None:
+        return self.shards[0].read_timeout
+
+    async def initialize(self) -> None:
+        await asyncio.gather(*(shard.initialize() for shard in self.shards))
+
+    async def shutdown(self) -> None:
+        await asyncio.gather(*(shard.shutdown() for shard in self.shards))
+
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        metrics.inc("bot_api_calls_total", method=method, handler=current_metrics_scope.get())
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", method=method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_api_request_duration_seconds", time.perf_counter() - started, method=method)
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        if not self._gate.locked():
+            # Jalur cepat: slot tersedia, acquire() langsung kembali tanpa membuat task wait_for
+            await self._gate.acquire()
+            metrics.observe("bot_http_pool_wait_seconds", 0.0, lane=self.lane)
+        else:
+            if isinstance(pool_timeout, type(BaseRequest.DEFAULT_NONE)):  # tidak diatur pemanggil -> default pool
+                pool_timeout = BOT_API_POOL_TIMEOUT
+            started = time.perf_counter()
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._gate.acquire(), pool_timeout)
+            except asyncio.TimeoutError:
+                self.pool_timeouts += 1
+                raise TimedOut(f"Pool timeout: semua {self.size} koneksi lane {self.lane} sedang dipakai") from None
+            finally:
+                self.waiting -= 1
+                metrics.observe("bot_http_pool_wait_seconds", time.perf_counter() - started, lane=self.lane)
+        index = min(range(len(self.shards)), key=self._shard_load.__getitem__)
+        self._shard_load[index] += 1
+        self.in_use += 1
+        self.peak = max(self.peak, self.in_use)
+        try:
+            # Slot gate menjamin shard terpilih masih punya koneksi bebas, jadi checkout di httpx tidak menunggu lagi
+            return await self.shards[index].do_request(url, method, request_data, read_timeout, write_timeout,
+                                                       connect_timeout, pool_timeout)
+        finally:
+            self._shard_load[index] -= 1
+            self.in_use -= 1
+            self._gate.release()
+
+@functools.cache
+def bot_api_http_version() -> str:
+    """Versi HTTP dari BOT_API_HTTP_VERSION; kembali ke HTTP/1.1 (sekali peringatan) jika paket h2 tidak terpasang."""
+    if BOT_API_HTTP_VERSION == "2" and importlib.util.find_spec("h2") is None:
+        logger.warning("BOT_API_HTTP_VERSION=2 butuh paket h2 (pip install \"python-telegram-bot[http2]\"); memakai HTTP/1.1.")
+        return "1.1"
+    return BOT_API_HTTP_VERSION
+
+def build_request(lane: str, pool_size: int) -> InstrumentedRequest:
+    """Membuat request Bot API untuk satu lane dengan pengaturan pool, keep-alive, dan timeout dari env."""
+    return InstrumentedRequest(
+        lane=lane,
+        pool_size=pool_size,
+        shard_size=BOT_API_POOL_SHARD_SIZE,
+        keepalive=min(BOT_API_KEEPALIVE_CONNECTIONS or pool_size, pool_size),
+        pool_timeout=BOT_API_POOL_TIMEOUT,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        read_timeout=BOT_API_READ_TIMEOUT,
+        write_timeout=BOT_API_WRITE_TIMEOUT,
+        http_version=bot_api_http_version(),
+    )
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    """Mengukur seberapa terlambat event loop membangunkan task ini; lag besar = ada kode yang memblokir loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        metrics.observe("bot_event_loop_lag_seconds", max(0.0, loop.time() - started - interval))
+
+class MetricsServer:
+    """Server HTTP minimal (tanpa dependensi tambahan) yang melayani GET /metrics untuk Prometheus."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._server: asyncio.base_events.Server = None
+        self._lag_task: asyncio.Task = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self._lag_task = asyncio.create_task(monitor_event_loop_lag(), name="metrics-loop-lag")
+        logger.info("Endpoint metrik aktif di http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._lag_task:
+            self._lag_task.cancel()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
 # --- FUNGSI PEMERIKSAAN IZIN (UNIVERSAL UNTUK CHAT/GROUP) ---
 
-async def check_bot_ban_permissions(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> (bool, str):
+# Cache hasil pemeriksaan izin bot per chat. Diperbarui langsung oleh update my_chat_member
+# (lihat handle_bot_member_update), jadi TTL hanya jaring pengaman jika ada update yang terlewat.
+bot_permission_cache = TTLCache(ttl=BOT_PERMISSION_CACHE_TTL)
+
+def evaluate_bot_member(bot_member) -> (bool, str):
+    """Menilai objek ChatMember milik bot: apakah admin dengan izin 'Ban Users'."""
+    # Memeriksa apakah status bot adalah administrator
+    if bot_member.status != "administrator":
+        return False, "Bot bukan admin di chat tersebut. Mohon jadikan bot admin terlebih dahulu."
+
+    # Memeriksa apakah bot memiliki izin untuk 'Ban Users'
+    if not bot_member.can_restrict_members:
+        return False, "Bot adalah admin, tetapi tidak memiliki izin untuk 'Ban Users'. Mohon berikan izin tersebut."
+
+    return True, "Bot adalah admin dengan izin yang benar."
+
+async def check_bot_ban_permissions(bot: Bot, chat_id: int, use_cache: bool = True,
+                                    raise_transient: bool = False) -> (bool, str):
     """
     Memeriksa apakah bot adalah admin dengan izin 'Ban Users' di chat (channel atau group) yang diberikan.
     Mengembalikan (True, "Success") jika valid, atau (False, "Pesan Error") jika tidak.
+    - use_cache: False untuk memaksa pemeriksaan langsung ke Bot API.
+    - raise_transient: True untuk meneruskan error sementara (jaringan/timeout/flood limit) alih-alih
+      menganggapnya izin tidak valid, supaya pemanggil bisa mencoba lagi nanti.
     """
+    if use_cache:
+        cached = bot_permission_cache.get(chat_id)
+        if cached is not None:
+            return cached
+
     try:
         # Mendapatkan objek member bot di chat_id yang diberikan
-        bot_member = await context.bot.get_chat_member(chat_id=chat_id, user_id=context.bot.id)
-        
-        # Memeriksa apakah status bot adalah administrator
-        if bot_member.status != "administrator":
-            return False, "Bot bukan admin di chat tersebut. Mohon jadikan bot admin terlebih dahulu."
-        
-        # Memeriksa apakah bot memiliki izin untuk 'Ban Users'
-        if not bot_member.can_restrict_members:
-            return False, "Bot adalah admin, tetapi tidak memiliki izin untuk 'Ban Users'. Mohon berikan izin tersebut."
-        
-        return True, "Bot adalah admin dengan izin yang benar."
+        bot_member = await bot.get_chat_member(chat_id=chat_id, user_id=bot.id)
+        result = evaluate_bot_member(bot_member)
+        bot_permission_cache.set(chat_id, result)
+        return result
     except (BadRequest, Forbidden) as e:
-        logger.error(f"Error checking permissions for chat {chat_id}: {e}")
+        logger.error("Error checking permissions for chat %s: %s", chat_id, e)
         # Menangani error spesifik jika bot tidak ditemukan di chat atau chat tidak ditemukan
         if "user not found" in str(e) or "chat not found" in str(e):
              return False, "Bot tidak ditemukan di chat tersebut. Mohon tambahkan bot terlebih dahulu."
         return False, f"Terjadi kesalahan: {e}" # Mengembalikan pesan error yang lebih umum jika terjadi masalah lain
+    except (NetworkError, RetryAfter):
+        if raise_transient:
+            raise
+        logger.error("Error jaringan saat memeriksa izin di chat %s.", chat_id, exc_info=True)
+        return False, "Terjadi kesalahan tak terduga saat memeriksa izin."
     except Exception as e:
-        logger.error(f"Unexpected error checking permissions for chat {chat_id}: {e}")
+        logger.error("Unexpected error checking permissions for chat %s: %s", chat_id, e)
         return False, "Terjadi kesalahan tak terduga saat memeriksa izin."
 
+async def handle_bot_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Menangani update my_chat_member (status/izin bot sendiri berubah di suatu chat).
+    Hasilnya langsung ditulis ke cache izin, sehingga perubahan hak admin bot langsung terlihat.
+    """
+    chat_id = update.my_chat_member.chat.id
+    is_valid, message = evaluate_bot_member(update.my_chat_member.new_chat_member)
+    bot_permission_cache.set(chat_id, (is_valid, message))
+    logger.info("Status bot di chat %s berubah menjadi '%s' (izin ban: %s). Cache izin: %s hit / %s miss.", chat_id, update.my_chat_member.new_chat_member.status, is_valid, bot_permission_cache.hits, bot_permission_cache.misses)
+
+# --- DATA PENGATURAN PEMILIK & GRUP ---
+
+class ConfigRecord:
+    """
+    Dasar record pengaturan (dipakai sebagai context.user_data / context.chat_data).
+    Disimpan ke database sebagai tuple nilai field sesuai urutan deklarasi, jadi field baru
+    hanya boleh ditambahkan di akhir (dengan nilai default).
+    """
+    __slots__ = ()
+
+    def to_row(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def from_row(cls, row):
+        """Membuat record dari tuple tersimpan, atau dari dict format lama (key yang tidak dikenal diabaikan)."""
+        if isinstance(row, dict):
+            return cls(**{f.name: row[f.name] for f in fields(cls) if f.name in row})
+        return cls(*row)
+
+@dataclass(slots=True)
+class OwnerConfig(ConfigRecord):
+    """Pengaturan pengguna di chat pribadi bot (pemilik channel/grup yang dimonitor)."""
+    is_verified: bool = False
+    # Format lama (satu channel per pemilik); dipindahkan ke `channels` saat record dimuat
+    monitored_channel_id: int = None
+    monitored_channel_title: str = None
+    banning_enabled: bool = False
+    notification_mode: str = 'instant'
+    last_private_menu_message_id: int = None
+    # chat_id -> (judul, banning aktif) untuk setiap channel/grup yang didaftarkan pemilik; None sampai channel
+    # pertama ditambahkan (kebanyakan user tidak pernah mendaftarkan channel, jadi tidak perlu dict kosong per record)
+    channels: dict = None
+    # Pesan panduan lengkap yang sudah pernah dikirim (tidak dikirim ulang setiap tombol "Cara Pakai" ditekan)
+    guide_message_id: int = None
+
+    def __post_init__(self):
+        if not self.channels:
+            self.channels = None # Record lama bisa menyimpan dict kosong
+        if self.monitored_channel_id:
+            if self.monitored_channel_id not in (self.channels or {}):
+                self.set_channel(self.monitored_channel_id, self.monitored_channel_title, self.banning_enabled)
+            self.monitored_channel_id = self.monitored_channel_title = None
+            self.banning_enabled = False
+
+    def set_channel(self, chat_id: int, title: str, banning: bool) -> None:
+        """Menambahkan atau memperbarui satu channel di `channels` (dict dibuat saat channel pertama)."""
+        if self.channels is None:
+            self.channels = {}
+        self.channels[chat_id] = (title, banning)
+
+    def remove_channel(self, chat_id: int):
+        """Menghapus satu channel; mengembalikan (judul, banning aktif) atau None. Daftar yang kosong kembali None."""
+        if not self.channels:
+            return None
+        removed = self.channels.pop(chat_id, None)
+        if not self.channels:
+            self.channels = None
+        return removed
+
+    @property
+    def banning_active(self) -> bool:
+        return bool(self.channels) and any(enabled for _, enabled in self.channels.values())
+
+@dataclass(slots=True)
+class GroupConfig(ConfigRecord):
+    """Pengaturan bot di sebuah grup."""
+    banning_enabled: bool = False
+    notification_mode: str = 'instant'
+    last_group_menu_message_id: int = None
+    guide_message_id: int = None
+
+    @property
+    def banning_active(self) -> bool:
+        return self.banning_enabled
+
+# --- INDEKS CHAT YANG DIMONITOR (LOOKUP CEPAT UNTUK EVENT LEFT) ---
+
+# Peta chat_id channel -> set user_id pemilik yang mengaktifkan banning untuk channel tersebut,
+# dan kebalikannya (user_id pemilik -> channel aktifnya) untuk menyelaraskan saat pengaturan pemilik berubah.
+channel_owner_index: dict[int, set[int]] = {}
+owner_channel_index: dict[int, set[int]] = {}
+# Set chat_id grup yang fitur banning-nya sedang aktif.
+active_group_ids: set[int] = set()
+# Mode notifikasi setiap penerima yang terindeks (user_id pemilik atau chat_id grup)
+notification_modes: dict[int, str] = {}
+
+class MonitorRule:
+    """
+    Aturan yang sudah dihitung untuk satu chat yang dimonitor. Event left cukup melakukan satu lookup
+    di monitor_rules untuk tahu bahwa chat ini harus diban dan siapa saja yang dikabari hasilnya.
+    Target notifikasi berupa tuple (chat_id penerima, mode notifikasi, penerima adalah grup itu sendiri).
+    """
+    __slots__ = ("owner_ids", "group_enabled", "surge_recipients", "on_success", "on_failure")
+
+    def __init__(self, chat_id: int, owner_ids: tuple, group_enabled: bool):
+        self.owner_ids = owner_ids
+        self.group_enabled = group_enabled
+        owners = tuple((owner_id, notification_modes.get(owner_id, 'instant'), False) for owner_id in owner_ids)
+        group = ((chat_id, notification_modes.get(chat_id, 'instant'), True),) if group_enabled else ()
+        # Ban yang berhasil hanya diumumkan di grup jika tidak ada pemilik yang sudah dikabari lewat chat pribadi
+        self.on_success = owners or group
+        self.on_failure = owners + group
+        self.surge_recipients = owner_ids or (chat_id,)
+
+# Tabel aturan per chat_id; chat yang tidak ada di sini tidak dimonitor
+monitor_rules: dict[int, MonitorRule] = {}
+
+def refresh_monitor_rule(chat_id: int) -> None:
+    """Menghitung ulang aturan satu chat dari indeks pemilik & grup."""
+    owner_ids = tuple(sorted(channel_owner_index.get(chat_id, ())))
+    group_enabled = chat_id in active_group_ids
+    if owner_ids or group_enabled:
+        monitor_rules[chat_id] = MonitorRule(chat_id, owner_ids, group_enabled)
+    else:
+        monitor_rules.pop(chat_id, None)
+
+def update_channel_index(owner_id: int, user_data: OwnerConfig, refresh: bool = True) -> None:
+    """
+    Menyelaraskan indeks channel dengan pengaturan seorang pemilik (channel baru/dihapus, banning, mode notifikasi).
+    - refresh: False saat indeks dibangun massal; aturan dihitung sekali di akhir oleh build_monitor_index.
+    """
+    enabled = {chat_id for chat_id, (_, banning) in (user_data.channels or {}).items() if banning}
+    previous = owner_channel_index.pop(owner_id, set())
+    for chat_id in previous - enabled:
+        owners = channel_owner_index.get(chat_id)
+        if owners is not None:
+            owners.discard(owner_id)
+            if not owners:
+                del channel_owner_index[chat_id]
+    for chat_id in enabled - previous:
+        channel_owner_index.setdefault(chat_id, set()).add(owner_id)
+
+    if enabled:
+        owner_channel_index[owner_id] = enabled
+        notification_modes[owner_id] = user_data.notification_mode
+    else:
+        notification_modes.pop(owner_id, None)
+    if refresh:
+        for chat_id in previous | enabled:
+            refresh_monitor_rule(chat_id)
+
+def update_group_index(chat_id: int, chat_data: GroupConfig, refresh: bool = True) -> None:
+    """Menyelaraskan indeks grup aktif dengan status banning & mode notifikasi di chat_data grup tersebut."""
+    if chat_data.banning_enabled:
+        active_group_ids.add(chat_id)
+        notification_modes[chat_id] = chat_data.notification_mode
+    else:
+        active_group_ids.discard(chat_id)
+        notification_modes.pop(chat_id, None)
+    if refresh:
+        refresh_monitor_rule(chat_id)
+
+def build_monitor_index(application: Application) -> None:
+    """
+    Membangun ulang indeks channel & grup serta tabel aturan saat startup dengan membaca database baris per baris,
+    jadi indeks tetap lengkap walaupun user_data/chat_data dimuat secara lazy.
+    """
+    for index in (channel_owner_index, owner_channel_index, active_group_ids, notification_modes, monitor_rules):
+        index.clear()
+    # Hanya baris dengan banning aktif yang bisa masuk indeks
+    for owner_id, user_data in application.persistence.iter_rows("user_data", banning_only=True):
+        update_channel_index(owner_id, user_data, refresh=False)
+    for chat_id, chat_data in application.persistence.iter_rows("chat_data", banning_only=True):
+        update_group_index(chat_id, chat_data, refresh=False)
+    for chat_id in channel_owner_index.keys() | active_group_ids:
+        refresh_monitor_rule(chat_id)
+    logger.info("Indeks monitor dibangun: %s channel, %s grup aktif, %s pemilik, %s aturan.",
+                len(channel_owner_index), len(active_group_ids), len(owner_channel_index), len(monitor_rules))
+
 # --- Helper untuk kirim/edit pesan foto ---
-async def send_or_edit_photo_message(update: Update, context: ContextTypes.DEFAULT_TYPE, photo_url: str, caption_text: str, reply_markup: InlineKeyboardMarkup, is_new_message: bool = False):
+
+async def send_cached_photo(bot, bot_data: dict, chat_id: int, photo_url: str, **kwargs):
     """
-    Mengirim pesan foto baru atau mengedit caption dari pesan foto yang sudah ada.
-    - is_new_message: True jika ini adalah pesan baru (misal dari /start atau setelah delete pesan lama).
-    - caption_text: Teks singkat untuk caption foto, karena Telegram punya batasan panjang caption.
+    Mengirim foto menu dengan memakai ulang file_id dari pengiriman pertama (disimpan di bot_data),
+    sehingga Telegram tidak perlu mengambil ulang gambar dari Imgur setiap kali.
+    Urutan percobaan: file_id tersimpan -> URL Imgur -> file lokal cadangan (jika ada).
     """
-    target_chat_id = update.effective_chat.id
+    file_ids = bot_data.setdefault('photo_file_ids', {})
+    file_id = file_ids.get(photo_url)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning("file_id tersimpan untuk %s ditolak (%s), mengirim ulang dari URL.", photo_url, e)
+            file_ids.pop(photo_url, None)
 
-    if is_new_message:
-        # Mengirim pesan foto baru
-        sent_message = await context.bot.send_photo(
-            chat_id=target_chat_id,
-            photo=photo_url,
-            caption=caption_text, # Caption singkat di sini
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
-        return sent_message.message_id
-    elif update.callback_query:
-        query = update.callback_query
+    try:
+        sent_message = await bot.send_photo(chat_id=chat_id, photo=photo_url, **kwargs)
+    except BadRequest as e:
+        local_path = IMAGE_LOCAL_FALLBACKS.get(photo_url)
+        if not local_path or not os.path.exists(local_path):
+            raise
+        logger.warning("Gagal mengirim foto dari URL %s (%s), memakai file lokal %s.", photo_url, e, local_path)
+        with open(local_path, "rb") as photo_file:
+            sent_message = await bot.send_photo(chat_id=chat_id, photo=photo_file, **kwargs)
+
+    file_ids[photo_url] = sent_message.photo[-1].file_id
+    return sent_message
+
+async def warm_up_photo_cache(application: Application) -> None:
+    """Meng-upload gambar menu yang belum punya file_id ke PHOTO_WARMUP_CHAT_ID saat startup, lalu menghapus pesannya."""
+    if not PHOTO_WARMUP_CHAT_ID:
+        return
+    cached = application.bot_data.get('photo_file_ids', {})
+    for photo_url in (IMAGE_URL_VERIFICATION, IMAGE_URL_MAIN_MENU):
+        if photo_url in cached:
+            continue
         try:
-            # Mengedit caption dari pesan yang memicu callback query
-            # Metode edit_caption() dari query.message tidak memerlukan chat_id atau message_id eksplisit
-            await query.message.edit_caption(
-                caption=caption_text, # Caption singkat di sini
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
+            sent_message = await send_cached_photo(
+                application.bot, application.bot_data, PHOTO_WARMUP_CHAT_ID, photo_url, disable_notification=True
             )
-            return query.message.message_id # Mengembalikan ID pesan yang baru saja diedit
+            await sent_message.delete()
+            logger.info("Warm-up foto %s selesai.", photo_url)
+        except Exception as e:
+            logger.warning("Warm-up foto %s gagal: %s", photo_url, e)
+
+class MenuRenderCache:
+    """
+    Isi terakhir (foto, caption, tombol) setiap pesan menu yang dikirim/diedit bot, per (chat_id, message_id), LRU terbatas.
+    Dipakai untuk melewati edit yang hasilnya sama persis, dan untuk tahu kapan fotonya perlu diganti (editMessageMedia).
+    Juga mencatat berapa pesan perintah setelah menu itu yang sudah dihapus bot, supaya tidak dihitung sebagai pesan
+    yang menimbun menu. Hanya di memori: setelah restart, isi pesan menu lama dianggap belum diketahui.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self.stats = {"sent": 0, "edited": 0, "media_edited": 0, "skipped": 0, "deleted": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, chat_id: int, message_id: int):
+        entry = self._entries.get((chat_id, message_id))
+        if entry is None:
+            return None
+        self._entries.move_to_end((chat_id, message_id))
+        return entry[0]
+
+    def set(self, chat_id: int, message_id: int, rendered: tuple) -> None:
+        entry = self._entries.get((chat_id, message_id))
+        if entry is None:
+            # [isi, jumlah pesan perintah setelah menu ini yang sudah dihapus]
+            self._entries[(chat_id, message_id)] = [rendered, 0]
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            entry[0] = rendered
+            self._entries.move_to_end((chat_id, message_id))
+
+    def deleted_after(self, chat_id: int, message_id: int) -> int:
+        entry = self._entries.get((chat_id, message_id))
+        return entry[1] if entry else 0
+
+    def add_deleted_after(self, chat_id: int, message_id: int) -> None:
+        entry = self._entries.get((chat_id, message_id))
+        if entry:
+            entry[1] += 1
+
+    def discard(self, chat_id: int, message_id: int) -> None:
+        self._entries.pop((chat_id, message_id), None)
+
+menu_renders = MenuRenderCache(MENU_RENDER_CACHE_SIZE)
+
+@instrumented("send_or_edit_photo_message")
+async def send_or_edit_photo_message(update: Update, context: ContextTypes.DEFAULT_TYPE, photo_url: str, caption_text: str, reply_markup: InlineKeyboardMarkup,
+                                     is_new_message: bool = False, message_id: int = None, replace_photo: bool = False):
+    """
+    Menampilkan menu foto dengan panggilan Bot API seminimal mungkin; mengembalikan message_id pesan menu.
+    - is_new_message: True untuk mengirim pesan foto baru.
+    - Selain itu yang diedit adalah `message_id` (menu lama yang masih di bawah chat), atau pesan yang memicu callback query.
+    - caption_text: Teks singkat untuk caption foto, karena Telegram punya batasan panjang caption.
+    - replace_photo: petunjuk bahwa pesan itu menampilkan foto lain, dipakai jika isinya tidak ada di menu_renders.
+    Edit dilewati jika foto, caption dan tombolnya sama persis dengan yang terakhir ditampilkan.
+    """
+    target_chat_id = update.effective_chat.id
+    rendered = (photo_url, caption_text, reply_markup)
+    if not is_new_message and message_id is None and update.callback_query and update.callback_query.message:
+        message_id = update.callback_query.message.message_id
+
+    if not is_new_message and message_id is not None:
+        previous = menu_renders.get(target_chat_id, message_id)
+        if previous == rendered:
+            menu_renders.stats["skipped"] += 1
+            return message_id
+        photo_changed = previous[0] != photo_url if previous else replace_photo
+        try:
+            if photo_changed:
+                # Foto diganti sekaligus caption & tombolnya dalam satu panggilan, memakai file_id jika sudah ada
+                photo = context.bot_data.get('photo_file_ids', {}).get(photo_url, photo_url)
+                await context.bot.edit_message_media(
+                    chat_id=target_chat_id, message_id=message_id, reply_markup=reply_markup,
+                    media=InputMediaPhoto(media=photo, caption=caption_text, parse_mode='Markdown')
+                )
+                menu_renders.stats["media_edited"] += 1
+            else:
+                await context.bot.edit_message_caption(
+                    chat_id=target_chat_id, message_id=message_id,
+                    caption=caption_text, # Caption singkat di sini
+                    reply_markup=reply_markup,
+                    parse_mode='Markdown'
+                )
+                menu_renders.stats["edited"] += 1
+            menu_renders.set(target_chat_id, message_id, rendered)
+            return message_id
         except BadRequest as e:
-            logger.warning(f"Gagal mengedit caption pesan via callback di chat {target_chat_id}: {e}. Mengirim pesan baru sebagai fallback.")
-            # Fallback: jika gagal edit (misal karena caption terlalu panjang di update sebelumnya atau pesan sudah tidak ada), kirim pesan baru
-            sent_message = await context.bot.send_photo(
-                chat_id=target_chat_id,
-                photo=photo_url,
-                caption=caption_text,
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-            return sent_message.message_id
-    else:
-        # Ini adalah kasus fallback jika bukan pesan baru dan bukan dari callback query.
-        # Biasanya terjadi jika ada interaksi langsung atau pesan bot yang tidak dilacak ID-nya.
-        # Paling aman adalah mengirim pesan baru.
-        sent_message = await context.bot.send_photo(
-            chat_id=target_chat_id,
-            photo=photo_url,
-            caption=caption_text,
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
-        return sent_message.message_id
+            if "not modified" in str(e).lower():
+                # Isinya memang sudah sama (misal setelah restart, saat menu_renders masih kosong)
+                menu_renders.set(target_chat_id, message_id, rendered)
+                return message_id
+            menu_renders.discard(target_chat_id, message_id)
+            # Fallback: jika gagal edit (misal pesan sudah dihapus atau terlalu lama), kirim pesan baru
+            logger.warning("Gagal mengedit menu %s di chat %s: %s. Mengirim pesan baru sebagai fallback.", message_id, target_chat_id, e)
+
+    sent_message = await send_cached_photo(
+        context.bot, context.bot_data, target_chat_id, photo_url,
+        caption=caption_text,
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+    menu_renders.stats["sent"] += 1
+    menu_renders.set(target_chat_id, sent_message.message_id, rendered)
+    return sent_message.message_id
 
-# --- MENU UTAMA & NAVIGASI (UNTUK CHAT PRIBADI) ---
+def reusable_menu_message_id(update: Update, menu_message_id: int):
+    """
+    ID menu lama jika boleh diedit di tempat untuk pesan perintah ini (/start, /cancel, input channel): paling banyak
+    MENU_EDIT_IN_PLACE_MAX_GAP pesan lain muncul di antara menu dan pesan perintah (id pesan berurutan per chat,
+    dikurangi pesan perintah sebelumnya yang sudah dihapus bot), jadi menu masih terlihat di bagian bawah chat.
+    Selain itu None.
+    """
+    if not menu_message_id or not update.message:
+        return None
+    gap = update.message.message_id - menu_message_id - 1 - menu_renders.deleted_after(update.effective_chat.id, menu_message_id)
+    return menu_message_id if 0 <= gap <= MENU_EDIT_IN_PLACE_MAX_GAP else None
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text="", is_initial_load=False):
+async def render_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, photo_url: str, caption: str, reply_markup: InlineKeyboardMarkup,
+                      current_message_id: int, replace_photo: bool = False) -> int:
     """
-    Menampilkan menu utama dengan tombol interaktif untuk pengaturan channel pribadi pengguna.
-    Menggunakan pesan foto dengan caption singkat dan tombol.
+    Menampilkan menu (pribadi atau grup) dan mengembalikan message_id-nya.
+    Dari tombol: pesan yang ditekan diedit. Dari pesan perintah (yang sudah dihapus pemanggil): menu lama diedit di
+    tempat jika masih di bawah chat; jika sudah tertimbun pesan lain, menu lama dihapus dan menu baru dikirim.
     """
-    user_data = context.user_data
-    banning_status = user_data.get('banning_enabled', False)
-    toggle_text = "🔴 Matikan Ban (Channel)" if banning_status else "🟢 Aktifkan Ban (Channel)"
-    monitored_channel = user_data.get('monitored_channel_title', 'Belum Diatur')
+    if update.callback_query:
+        return await send_or_edit_photo_message(update, context, photo_url, caption, reply_markup, replace_photo=replace_photo)
+    reuse_message_id = reusable_menu_message_id(update, current_message_id)
+    if reuse_message_id is None and current_message_id:
+        try:
+            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=current_message_id)
+            menu_renders.stats["deleted"] += 1
+        except Exception as e:
+            logger.warning("Gagal menghapus pesan menu lama (ID: %s) di chat %s: %s", current_message_id, update.effective_chat.id, e)
+        menu_renders.discard(update.effective_chat.id, current_message_id)
+    message_id = await send_or_edit_photo_message(
+        update, context, photo_url, caption, reply_markup,
+        is_new_message=reuse_message_id is None, message_id=reuse_message_id, replace_photo=replace_photo
+    )
+    if message_id == reuse_message_id:
+        menu_renders.add_deleted_after(update.effective_chat.id, message_id)
+    return message_id
+
+def chat_message_link(chat: Chat, message_id: int):
+    """Link t.me ke sebuah pesan; hanya ada untuk supergroup/channel (chat pribadi & grup biasa tidak punya link pesan)."""
+    if chat.type not in [Chat.SUPERGROUP, Chat.CHANNEL]:
+        return None
+    if chat.username:
+        return f"https://t.me/{chat.username}/{message_id}"
+    return f"https://t.me/c/{str(chat.id).removeprefix('-100')}/{message_id}"
+
+@functools.lru_cache(maxsize=64)
+def guide_menu_template(kind: str, just_sent: bool, link: str = None) -> tuple[str, InlineKeyboardMarkup]:
+    """Caption & tombol menu "Cara Pakai": panduan lengkap dikirim sekali, setelah itu cukup ditautkan / dikirim ulang atas permintaan."""
+    title, back_label, back_data = (
+        ("Channel", "⬅️ Balik ke Menu Utama", "back_to_main") if kind == "channel" else ("Group", "⬅️ Balik ke Menu Group", "back_to_group_menu")
+    )
+    where = "dikirim di bawah ⬇️" if just_sent else "sudah dikirim sebelumnya di chat ini ⬆️"
+    caption = f"📖 **Panduan Penggunaan Bot ({title})**\n\nPanduan lengkapnya {where}"
+    keyboard = []
+    if link:
+        keyboard.append([InlineKeyboardButton("🔗 Buka Panduan", url=link)])
+    if not just_sent:
+        keyboard.append([InlineKeyboardButton("📨 Kirim Ulang Panduan", callback_data=f"how_to_use_{kind}:resend")])
+    keyboard.append([InlineKeyboardButton(back_label, callback_data=back_data)])
+    return caption, InlineKeyboardMarkup(keyboard)
+
+async def show_guide(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, config: ConfigRecord, detailed_text: str) -> None:
+    """
+    Menampilkan menu "Cara Pakai". Teks panduan lengkap (beberapa KB) hanya dikirim jika belum pernah dikirim di chat
+    ini atau jika diminta lewat tombol "Kirim Ulang"; selain itu menu cukup menautkan pesan panduan yang sudah ada.
+    """
+    query = update.callback_query
+    await query.answer()
+    send_guide = config.guide_message_id is None or query.data.endswith(":resend")
+    link = None if send_guide else chat_message_link(update.effective_chat, config.guide_message_id)
+    caption, reply_markup = guide_menu_template(kind, send_guide, link)
 
+    # Edit pesan gambar yang ada dengan caption singkat dan tombol
+    await send_or_edit_photo_message(update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup)
+
+    if send_guide:
+        # Kirim detail panduan sebagai pesan teks terpisah (boleh panjang)
+        sent_message = await update.effective_chat.send_message(text=detailed_text, parse_mode='Markdown', disable_web_page_preview=True)
+        config.guide_message_id = sent_message.message_id
+
+# --- MENU UTAMA & NAVIGASI (UNTUK CHAT PRIBADI) ---
+
+@functools.lru_cache(maxsize=1024)
+def main_menu_template(total_channels: int, active_channels: int, notification_mode: str) -> tuple[str, InlineKeyboardMarkup]:
+    """Caption & tombol menu utama untuk satu kombinasi status; objeknya dipakai ulang, dan dibandingkan di menu_renders."""
+    channel_summary = f"{total_channels} terdaftar, {active_channels} aktif" if total_channels else 'Belum Diatur'
     # Caption singkat untuk foto menu utama
     caption = (
         f"🏠 **Menu Utama (Pengelolaan Channel Pribadi)**\n\n"
-        f"▪️ **Channel Target**: `{monitored_channel}`\n"
-        f"▪️ **Status Banning**: `{'Aktif' if banning_status else 'Tidak Aktif'}`"
+        f"▪️ **Channel Target**: `{channel_summary}`\n"
+        f"▪️ **Notifikasi**: `{NOTIFICATION_MODE_LABELS[notification_mode]}`"
     )
-
-    keyboard = [
-        [InlineKeyboardButton("➕ Kelola Channel Target", callback_data="set_channel")],
-        [InlineKeyboardButton(toggle_text, callback_data="toggle_channel_ban")],
+    keyboard = [[InlineKeyboardButton("➕ Tambah Channel Target", callback_data="set_channel")]]
+    if total_channels:
+        keyboard.append([InlineKeyboardButton(f"📋 Daftar Channel ({total_channels})", callback_data="channels:0")])
+    keyboard += [
+        [InlineKeyboardButton(f"🔔 Notifikasi: {NOTIFICATION_MODE_LABELS[notification_mode]}", callback_data="toggle_notification_mode")],
         [InlineKeyboardButton("📖 Cara Pakai (Wajib Baca!)", callback_data="how_to_use_channel")],
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return caption, InlineKeyboardMarkup(keyboard)
 
-    current_message_id = user_data.get('last_private_menu_message_id')
-
-    # Logika untuk mengirim pesan foto baru atau mengedit yang sudah ada
-    if is_initial_load or (update.message and not update.callback_query):
-        # Jika ini adalah load awal atau dari command /start atau /cancel,
-        # hapus pesan lama (jika ada) dan kirim pesan foto baru.
-        if current_message_id:
-            try:
-                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=current_message_id)
-            except Exception as e:
-                logger.warning(f"Gagal menghapus pesan lama (ID: {current_message_id}) di chat pribadi: {e}")
-        new_message_id = await send_or_edit_photo_message(
-            update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup,
-            is_new_message=True
-        )
-    elif update.callback_query:
-        # Jika dari callback query (misal klik tombol), edit pesan yang sama.
-        await update.callback_query.answer()
-        new_message_id = await send_or_edit_photo_message(
-            update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup,
-            is_new_message=False
-        )
-    else: # Fallback case, seharusnya jarang terjadi jika alur logikanya benar
-        new_message_id = await send_or_edit_photo_message(
-            update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup,
-            is_new_message=True
-        )
-        logger.warning(f"show_main_menu: Tipe update tidak ditangani. Mengirim pesan baru.")
-
-    # Simpan message_id dari pesan menu yang baru dikirim/diedit
-    user_data['last_private_menu_message_id'] = new_message_id
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text="", replace_photo=False):
+    """
+    Menampilkan menu utama dengan tombol interaktif untuk pengaturan channel pribadi pengguna.
+    Menggunakan pesan foto dengan caption singkat dan tombol; `message_text` (hasil aksi) ditaruh di atas caption.
+    Callback query tidak dijawab di sini (sudah dijawab pemanggil).
+    """
+    user_data = context.user_data
+    channels = user_data.channels or {}
+    active_channels = sum(1 for _, enabled in channels.values() if enabled)
+    caption, reply_markup = main_menu_template(len(channels), active_channels, user_data.notification_mode)
+    if message_text:
+        caption = f"{message_text}\n\n{caption}"
+
+    # Simpan message_id dari pesan menu yang dikirim/diedit
+    user_data.last_private_menu_message_id = await render_menu(
+        update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup, user_data.last_private_menu_message_id, replace_photo=replace_photo
+    )
 
 async def back_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Kembali ke menu utama dari menu lain (untuk chat pribadi)."""
+    await update.callback_query.answer()
     await show_main_menu(update, context)
 
 # --- MENU & NAVIGASI (UNTUK GRUP) ---
 
-async def show_group_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text=""):
-    """
-    Menampilkan menu untuk pengaturan bot di dalam grup.
-    Menggunakan pesan foto dengan caption singkat dan tombol.
-    """
-    chat_id = update.effective_chat.id
-    group_data = context.chat_data # Mengakses data khusus untuk grup ini
-
-    banning_status = group_data.get('banning_enabled', False)
+@functools.lru_cache(maxsize=4096)
+def group_menu_template(chat_title: str, banning_status: bool, notification_mode: str) -> tuple[str, InlineKeyboardMarkup]:
+    """Caption & tombol menu grup untuk satu kombinasi status."""
     toggle_text = "🔴 Matikan Ban (Group)" if banning_status else "🟢 Aktifkan Ban (Group)"
-
     # Caption singkat untuk foto menu grup
     caption = (
         f"🏠 **Menu Bot (Group)**\n\n"
-        f"Selamat datang di group `{update.effective_chat.title}`!\n"
-        f"▪️ **Status Banning**: `{'Aktif' if banning_status else 'Tidak Aktif'}`"
+        f"Selamat datang di group `{chat_title}`!\n"
+        f"▪️ **Status Banning**: `{'Aktif' if banning_status else 'Tidak Aktif'}`\n"
+        f"▪️ **Notifikasi**: `{NOTIFICATION_MODE_LABELS[notification_mode]}`"
     )
-
     keyboard = [
         [InlineKeyboardButton(toggle_text, callback_data="toggle_group_ban")],
+        [InlineKeyboardButton(f"🔔 Notifikasi: {NOTIFICATION_MODE_LABELS[notification_mode]}", callback_data="toggle_group_notification_mode")],
         [InlineKeyboardButton("📖 Cara Pakai Group", callback_data="how_to_use_group")],
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    current_message_id = group_data.get('last_group_menu_message_id')
+    return caption, InlineKeyboardMarkup(keyboard)
 
-    if update.message and not update.callback_query: # Berasal dari command /start atau pesan biasa
-        if current_message_id:
-            try:
-                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=current_message_id)
-            except Exception as e:
-                logger.warning(f"Gagal menghapus pesan lama group (ID: {current_message_id}): {e}")
-        new_message_id = await send_or_edit_photo_message(
-            update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup,
-            is_new_message=True
-        )
-    elif update.callback_query:
-        await update.callback_query.answer()
-        new_message_id = await send_or_edit_photo_message(
-            update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup,
-            is_new_message=False
-        )
-    else: # Fallback
-        new_message_id = await send_or_edit_photo_message(
-            update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup,
-            is_new_message=True
-        )
-        logger.warning(f"show_group_menu: Tipe update tidak ditangani. Mengirim pesan baru.")
+async def show_group_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text=""):
+    """
+    Menampilkan menu untuk pengaturan bot di dalam grup.
+    Menggunakan pesan foto dengan caption singkat dan tombol; callback query sudah dijawab pemanggil.
+    """
+    group_data = context.chat_data # Mengakses data khusus untuk grup ini
+    caption, reply_markup = group_menu_template(update.effective_chat.title, group_data.banning_enabled, group_data.notification_mode)
+    if message_text:
+        caption = f"{message_text}\n\n{caption}"
 
-    group_data['last_group_menu_message_id'] = new_message_id
+    group_data.last_group_menu_message_id = await render_menu(
+        update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup, group_data.last_group_menu_message_id
+    )
 
 async def back_to_group_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Kembali ke menu group dari menu lain."""
+    await update.callback_query.answer()
     await show_group_menu(update, context)
 
 # --- ALUR VERIFIKASI PENGGUNA BARU (HANYA UNTUK CHAT PRIBADI) ---
 
+# Cache keanggotaan pengguna di REQUIRED_CHANNEL_ID (user_id -> bool).
+# Selain lewat get_chat_member, cache ini diperbarui oleh event chat_member dari channel wajib itu sendiri.
+membership_cache = TTLCache(ttl=MEMBERSHIP_CACHE_POSITIVE_TTL)
+
+def remember_membership(user_id: int, is_member: bool) -> None:
+    """Menyimpan status keanggotaan channel wajib dengan TTL sesuai hasilnya (positif/negatif)."""
+    membership_cache.set(user_id, is_member, MEMBERSHIP_CACHE_POSITIVE_TTL if is_member else MEMBERSHIP_CACHE_NEGATIVE_TTL)
+
+async def is_required_channel_member(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    """Memeriksa apakah pengguna sudah bergabung di channel wajib, memakai cache jika tersedia."""
+    cached = membership_cache.get(user_id)
+    if cached is not None:
+        return cached
+    try:
+        member = await context.bot.get_chat_member(chat_id=REQUIRED_CHANNEL_ID, user_id=user_id)
+    except BadRequest as e:
+        # Misal "user not found": pengguna memang belum pernah bergabung
+        logger.warning("Gagal memeriksa keanggotaan channel wajib untuk user %s: %s", user_id, e)
+        remember_membership(user_id, False)
+        return False
+    except Exception as e:
+        # Error jaringan dll. tidak disimpan ke cache supaya bisa dicoba lagi
+        logger.warning("Gagal memeriksa keanggotaan channel wajib untuk user %s: %s", user_id, e)
+        return False
+    is_member = member.status in ['member', 'administrator', 'creator']
+    remember_membership(user_id, is_member)
+    return is_member
+
+@functools.cache
+def verification_menu_template() -> tuple[str, InlineKeyboardMarkup]:
+    """Caption & tombol foto verifikasi; link channel wajib ada di caption & tombol, bukan pesan teks terpisah."""
+    # Caption singkat untuk foto verifikasi
+    caption = (
+        f"**Selamat Datang!**\n\nUntuk mengaktifkan fitur, **wajib** gabung channel kami dulu ya.\n\n"
+        f"➡️ **Join di sini**: {REQUIRED_CHANNEL_LINK}\n\nSetelah bergabung, klik tombol ✅ di bawah untuk verifikasi."
+    )
+    keyboard = [
+        [InlineKeyboardButton("➡️ Gabung Channel", url=REQUIRED_CHANNEL_LINK)],
+        [InlineKeyboardButton("✅ Saya Sudah Bergabung", callback_data="verify_join")],
+    ]
+    return caption, InlineKeyboardMarkup(keyboard)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Fungsi /start, memeriksa apakah pengguna sudah terverifikasi (untuk chat pribadi)
@@ -260,36 +1331,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 await update.message.delete()
             except Exception as e:
-                logger.warning(f"Gagal menghapus pesan /start dari user: {e}")
+                logger.warning("Gagal menghapus pesan /start dari user: %s", e)
 
-        try:
-            member = await context.bot.get_chat_member(chat_id=REQUIRED_CHANNEL_ID, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                context.user_data['is_verified'] = True
-                await show_main_menu(update, context, is_initial_load=True) # Mengirim pesan foto menu utama
-            else:
-                raise ValueError("User not in channel")
-        except Exception:
-            context.user_data['is_verified'] = False
-            keyboard = [[InlineKeyboardButton("✅ Saya Sudah Bergabung", callback_data="verify_join")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            # Caption singkat untuk foto verifikasi
-            caption = f"**Selamat Datang!**\n\nUntuk mengaktifkan fitur, **wajib** gabung channel kami dulu ya. Klik tombol!"
-            
-            new_message_id = await send_or_edit_photo_message(
-                update, context, IMAGE_URL_VERIFICATION,
-                caption, # Gunakan caption singkat di sini
-                reply_markup, is_new_message=True
-            )
-            context.user_data['last_private_menu_message_id'] = new_message_id
-
-            # Kirim detail verifikasi sebagai pesan teks terpisah
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"➡️ **Join di sini**: {REQUIRED_CHANNEL_LINK}\n\nSetelah bergabung, klik tombol di atas untuk verifikasi.",
-                parse_mode='Markdown',
-                disable_web_page_preview=True # Untuk menghindari preview link jika tidak diinginkan
+        # Menu terakhir di chat ini menampilkan foto verifikasi jika pengguna belum terverifikasi saat itu
+        was_verified = context.user_data.is_verified
+        if await is_required_channel_member(context, user_id):
+            context.user_data.is_verified = True
+            await show_main_menu(update, context, replace_photo=not was_verified) # Foto menu utama (edit di tempat jika bisa)
+        else:
+            context.user_data.is_verified = False
+            caption, reply_markup = verification_menu_template()
+            context.user_data.last_private_menu_message_id = await render_menu(
+                update, context, IMAGE_URL_VERIFICATION, caption, reply_markup,
+                context.user_data.last_private_menu_message_id, replace_photo=was_verified
             )
 
     elif chat_type in [Chat.GROUP, Chat.SUPERGROUP]:
@@ -298,30 +1352,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 await update.message.delete()
             except Exception as e:
-                logger.warning(f"Gagal menghapus pesan /start dari user di grup: {e}")
+                logger.warning("Gagal menghapus pesan /start dari user di grup: %s", e)
         await show_group_menu(update, context)
 
 async def verify_join_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Memverifikasi ulang keanggotaan pengguna setelah mereka menekan tombol (untuk chat pribadi)."""
     query = update.callback_query
     user_id = query.from_user.id
-    current_message_id = context.user_data.get('last_private_menu_message_id')
 
-    try:
-        member = await context.bot.get_chat_member(chat_id=REQUIRED_CHANNEL_ID, user_id=user_id)
-        if member.status in ['member', 'administrator', 'creator']:
-            context.user_data['is_verified'] = True
-            await query.answer("✅ Verifikasi berhasil!", show_alert=True)
-            # Hapus pesan verifikasi lama (termasuk foto) dan kirim pesan menu utama baru
-            if current_message_id:
-                try:
-                    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=current_message_id)
-                except Exception as e:
-                    logger.warning(f"Gagal menghapus pesan verifikasi lama (ID: {current_message_id}): {e}")
-            await show_main_menu(update, context, message_text="Verifikasi berhasil! Selamat datang di Menu Utama.", is_initial_load=True)
-        else:
-            raise ValueError("User not in channel")
-    except Exception:
+    if await is_required_channel_member(context, user_id):
+        context.user_data.is_verified = True
+        await query.answer("✅ Verifikasi berhasil!", show_alert=True)
+        # Pesan verifikasi yang ditekan langsung diganti jadi menu utama (foto & caption dalam satu edit)
+        await show_main_menu(update, context, message_text="✅ Verifikasi berhasil! Selamat datang di Menu Utama.", replace_photo=True)
+    else:
         await query.answer("❌ Anda belum bergabung. Silakan join channel terlebih dahulu.", show_alert=True)
 
 # --- HANDLER UNTUK FITUR-FITUR BOT (PENGATURAN CHANNEL PRIBADI) ---
@@ -348,81 +1392,128 @@ async def get_channel_id_input(update: Update, context: ContextTypes.DEFAULT_TYP
         try:
             await update.message.delete() # Hapus pesan input dari pengguna
         except Exception as e:
-            logger.warning(f"Gagal menghapus pesan input channel: {e}")
+            logger.warning("Gagal menghapus pesan input channel: %s", e)
 
-    feedback_text = "" # Inisialisasi feedback_text untuk pesan teks terpisah
+    feedback_text = "" # Inisialisasi feedback_text, ditampilkan di caption menu utama
     
     try:
         chat = await context.bot.get_chat(chat_id=channel_input)
-        is_valid, message = await check_bot_ban_permissions(context, chat.id)
+        is_valid, message = await check_bot_ban_permissions(context.bot, chat.id)
         
-        if is_valid:
-            context.user_data['monitored_channel_id'] = chat.id
-            context.user_data['monitored_channel_title'] = chat.title
-            context.user_data['banning_enabled'] = False 
-            feedback_text = f"✅ **Berhasil!**\nChannel **{chat.title}** telah ditambahkan. Silakan aktifkan fitur ban dari Menu Utama."
+        channels = context.user_data.channels or {}
+        if is_valid and chat.id not in channels and len(channels) >= OWNER_MAX_CHANNELS:
+            feedback_text = f"❌ **Gagal!**\nMaksimal {OWNER_MAX_CHANNELS} channel per akun. Hapus channel yang tidak dipakai dari 📋 Daftar Channel."
+        elif is_valid:
+            # Channel yang didaftarkan ulang hanya diperbarui judulnya; status banning-nya tetap
+            _, banning = channels.get(chat.id, (None, False))
+            context.user_data.set_channel(chat.id, chat.title, banning)
+            update_channel_index(update.effective_user.id, context.user_data)
+            feedback_text = f"✅ **Berhasil!**\nChannel **{chat.title}** telah ditambahkan. Silakan aktifkan fitur ban dari 📋 Daftar Channel di Menu Utama."
         else:
             feedback_text = f"❌ **Gagal!**\n{message}\n\nMohon perbaiki dan coba lagi."
             
     except (BadRequest, Forbidden) as e:
-        logger.error(f"Gagal mendapatkan info channel {channel_input}: {e}")
+        logger.error("Gagal mendapatkan info channel %s: %s", channel_input, e)
         feedback_text = "❌ **Gagal!**\nChannel dengan username/ID tersebut tidak ditemukan atau bot tidak memiliki akses."
     
-    # Kirim feedback sebagai pesan teks biasa
-    await update.effective_chat.send_message(text=feedback_text, parse_mode='Markdown')
-
-    # Kembali ke main menu, yang akan memperbarui tampilan menu utama
-    await show_main_menu(update, context, is_initial_load=True) # Mengirim pesan foto menu utama yang baru
+    # Kembali ke main menu dengan feedback di atas caption (menu yang menampilkan prompt input diedit di tempat)
+    await show_main_menu(update, context, message_text=feedback_text)
     return ConversationHandler.END
 
+def channel_list_page(channels: dict, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    """Caption & tombol satu halaman daftar channel pemilik (judul ada di tombol, caption foto dibatasi 1024 karakter)."""
+    entries = sorted(channels.items(), key=lambda item: ((item[1][0] or "").lower(), item[0]))
+    pages = max(1, -(-len(entries) // CHANNEL_MENU_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    active = sum(1 for _, (_, enabled) in entries if enabled)
+    caption = (
+        f"📋 **Daftar Channel Target** (halaman {page + 1}/{pages})\n\n"
+        f"{len(entries)} channel, {active} dengan banning aktif.\n"
+        f"Tekan nama channel untuk menyalakan 🟢 / mematikan 🔴 banning, 🗑️ untuk menghapus."
+    )
+    keyboard = []
+    for chat_id, (title, enabled) in entries[page * CHANNEL_MENU_PAGE_SIZE:(page + 1) * CHANNEL_MENU_PAGE_SIZE]:
+        keyboard.append([
+            InlineKeyboardButton(f"{'🟢' if enabled else '🔴'} {(title or str(chat_id))[:40]}", callback_data=f"ch_toggle:{chat_id}:{page}"),
+            InlineKeyboardButton("🗑️", callback_data=f"ch_remove:{chat_id}:{page}"),
+        ])
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Sebelumnya", callback_data=f"channels:{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("Berikutnya ➡️", callback_data=f"channels:{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("⬅️ Balik ke Menu Utama", callback_data="back_to_main")])
+    return caption, InlineKeyboardMarkup(keyboard)
+
+async def show_channel_list(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int) -> None:
+    """Menampilkan satu halaman daftar channel dengan mengedit caption pesan menu (foto tidak dikirim ulang)."""
+    caption, reply_markup = channel_list_page(context.user_data.channels or {}, page)
+    await send_or_edit_photo_message(update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup, is_new_message=False)
+
+async def channel_list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Navigasi halaman daftar channel (untuk chat pribadi). Tombol 'toggle_channel_ban' dari menu versi lama juga ke sini."""
+    query = update.callback_query
+    await query.answer()
+    _, _, page = query.data.partition(":")
+    await show_channel_list(update, context, int(page or 0))
+
 async def toggle_channel_ban_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Mengaktifkan atau menonaktifkan fitur banning untuk channel (untuk chat pribadi)."""
+    """Mengaktifkan atau menonaktifkan fitur banning untuk satu channel di daftar (untuk chat pribadi)."""
     query = update.callback_query
-    channel_id = context.user_data.get('monitored_channel_id')
+    _, channel_id, page = query.data.split(":")
+    channel_id, page = int(channel_id), int(page)
+    channels = context.user_data.channels or {}
 
-    if not channel_id:
-        await query.answer("⚠️ Anda harus mengatur Channel Target terlebih dahulu!", show_alert=True)
+    if channel_id not in channels:
+        await query.answer("⚠️ Channel ini sudah tidak ada di daftar.", show_alert=True)
+        await show_channel_list(update, context, page)
         return
 
-    if not context.user_data.get('banning_enabled', False):
-        is_valid, message = await check_bot_ban_permissions(context, channel_id)
+    title, enabled = channels[channel_id]
+    if not enabled:
+        is_valid, message = await check_bot_ban_permissions(context.bot, channel_id)
         if not is_valid:
-            context.user_data['banning_enabled'] = False
             await query.answer(f"Gagal Mengaktifkan: {message}", show_alert=True)
-            await show_main_menu(update, context) # Kembali ke menu utama dengan status terbaru
+            await show_channel_list(update, context, page)
             return
 
-    current_state = context.user_data.get('banning_enabled', False)
-    new_state = not current_state
-    context.user_data['banning_enabled'] = new_state
-    
-    status_text = "Aktif" if new_state else "Tidak Aktif"
-    await query.answer(f"Fitur Banning Channel sekarang: {status_text}", show_alert=True)
-    await show_main_menu(update, context)
+    context.user_data.set_channel(channel_id, title, not enabled)
+    update_channel_index(query.from_user.id, context.user_data)
+    await query.answer(f"Banning {title}: {'Tidak Aktif' if enabled else 'Aktif'}", show_alert=True)
+    await show_channel_list(update, context, page)
 
-async def how_to_use_channel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Menampilkan panduan penggunaan bot untuk channel (untuk chat pribadi)."""
+async def remove_channel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Menghapus satu channel dari daftar pemilik (untuk chat pribadi)."""
     query = update.callback_query
-    await query.answer()
-    
-    # Caption singkat untuk gambar "Cara Pakai"
-    caption = "📖 **Panduan Penggunaan Bot (Channel)**"
-    keyboard = [[InlineKeyboardButton("⬅️ Balik ke Menu Utama", callback_data="back_to_main")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    _, channel_id, page = query.data.split(":")
+    removed = context.user_data.remove_channel(int(channel_id))
+    if removed is None:
+        await query.answer("⚠️ Channel ini sudah tidak ada di daftar.", show_alert=True)
+    else:
+        update_channel_index(query.from_user.id, context.user_data)
+        await query.answer(f"🗑️ {removed[0]} dihapus dari daftar.", show_alert=True)
+    await show_channel_list(update, context, int(page))
 
-    # Edit pesan gambar yang ada dengan caption singkat dan tombol
-    await send_or_edit_photo_message(
-        update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup,
-        is_new_message=False
-    )
+async def toggle_notification_mode_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mengganti mode notifikasi blokir channel antara instan dan ringkasan (untuk chat pribadi)."""
+    query = update.callback_query
+    new_mode = 'digest' if context.user_data.notification_mode == 'instant' else 'instant'
+    context.user_data.notification_mode = new_mode
+    update_channel_index(query.from_user.id, context.user_data) # Mode baru dipakai aturan semua channel pemilik ini
+    await query.answer(f"Mode notifikasi sekarang: {NOTIFICATION_MODE_LABELS[new_mode]}", show_alert=True)
+    await show_main_menu(update, context)
 
-    # Kirim detail panduan sebagai pesan teks terpisah (boleh panjang)
+async def how_to_use_channel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Menampilkan panduan penggunaan bot untuk channel (untuk chat pribadi)."""
+    # Teks panduan lengkap; show_guide hanya mengirimnya sekali per chat (atau saat diminta kirim ulang)
     detailed_text = (
         "Halo, bestie! Bot ini tuh fungsinya simpel tapi nampol: **nge-ban otomatis** member yang *left* dari channel Telegram kesayangan kamu. Biar channel kamu isinya member loyal semua!\n\n"
         "--- \n\n"
         "✨ **STEP 1: Nambahin Channel Target**\n\n"
         "Ini dia langkah awal buat botnya kenal sama channel kamu:\n"
-        "1.  Dari **Menu Utama** bot (yang lagi kita diemin ini), klik tombol `➕ Kelola Channel Target`.\n"
+        "1.  Dari **Menu Utama** bot (yang lagi kita diemin ini), klik tombol `➕ Tambah Channel Target`.\n"
         "2.  Nanti bot bakal minta kamu kirimin **username** atau **ID** channel. Nah, ini penting nih:\n"
         "    •   **Buat Channel Publik (yang ada `@` di namanya)**:\n"
         "        Gampang banget! Tinggal copy aja username lengkapnya, misalnya: `@contohchannelpublic`. Terus langsung kirim ke bot ini.\n"
@@ -433,20 +1524,33 @@ async def how_to_use_channel_callback(update: Update, context: ContextTypes.DEFA
         "        b.  Bot tersebut akan menampilkan ID channel (biasanya diawali dengan `-100`).\n"
         "        c.  Nah, salin ID itu, terus kirim ke bot ini.\n\n"
         "🚨 **PENTING BANGET, WAJIB BACA!** 🚨\n"
-        "Sebelum kamu kirim ID/username channel, **PASTIKAN bot ini udah kamu jadiin ADMIN di channel kamu itu!** Plus, bot ini **WAJIB punya izin 'Ban Users'**. Kalau nggak, botnya nggak bakal bisa nambahin channel kamu jadi target, apalagi nge-ban. Jadi, pastiin izinnya on ya! Botnya bakal auto-cek kok, jadi kalau ada yang kurang, dia bakal ngasih tahu.\n\n"
+        "Sebelum kamu kirim ID/username channel, **PASTIKAN bot ini udah kamu jadiin ADMIN di channel kamu itu!** Plus, bot ini **WAJIB punya izin 'Ban Users'**. Kalau nggak, botnya nggak bakal bisa nambahin channel kamu jadi target, apalagi nge-ban. Jadi, pastiin izinnya on ya! Botnya bakal auto-cek kok, jadi kalau ada yang kurang, dia bakal ngasih tahu.\n"
+        "Punya banyak channel (atau grup)? Ulangi aja langkah ini buat masing-masing, semuanya bisa dipantau dari satu akun.\n\n"
         "--- \n\n"
         "🚀 **STEP 2: Aktifin Fitur Banning**\n\n"
         "Channel udah kenal? Saatnya bikin botnya kerja:\n"
-        "1.  Setelah channel target berhasil di-setting, balik lagi ke **Menu Utama**.\n"
-        "2.  Kamu bakal liat tombol `🟢 Aktifkan Ban (Channel)`. Pencet aja tombol itu!\n"
-        "3.  Kalau berhasil, tombolnya bakal berubah jadi `🔴 Matikan Ban (Channel)`. Artinya fitur ban udah ON! Best!\n"
+        "1.  Setelah channel target berhasil di-setting, balik lagi ke **Menu Utama** terus buka `📋 Daftar Channel`.\n"
+        "2.  Tiap channel punya tombol sendiri, awalnya `🔴 Nama Channel`. Pencet aja tombol itu! (Kalau channel-nya banyak, geser halamannya pakai `Berikutnya ➡️`.)\n"
+        "3.  Kalau berhasil, tombolnya bakal berubah jadi `🟢 Nama Channel`. Artinya fitur ban di channel itu udah ON! Best! Pencet lagi buat matiin, atau `🗑️` buat hapus dari daftar.\n"
         "4.  **FYI:** Kalau pas ngaktifin ini muncul error, itu tandanya izin admin bot di channel kamu dicabut atau ada yang salah. Pastiin izinnya dibalikin lagi ya, terus coba lagi.\n"
         "5.  Dan voilà! Mulai sekarang, setiap ada member yang *berani* left dari channel target kamu, mereka bakal langsung di-ban permanen! Auto-bersih!\n\n"
         "--- \n\n"
         "🔔 **Notifikasi Ban (Private Chat)**\n\n"
-        "Setiap kali bot ini sukses nge-ban seseorang dari channel kamu, kamu bakal dapet notifikasi langsung di chat pribadi ini. Jadi, kamu selalu tahu siapa aja yang nggak loyal, hehe."
+        "Setiap kali bot ini sukses nge-ban seseorang dari channel kamu, kamu bakal dapet notifikasi langsung di chat pribadi ini. Jadi, kamu selalu tahu siapa aja yang nggak loyal, hehe.\n"
+        "Kalau tiba-tiba banyak banget yang keluar barengan, kamu cukup dapet satu peringatan 🚨, ban-nya jalan pelan-pelan di belakang, dan hasilnya dikirim sebagai satu ringkasan setelah situasinya reda.\n\n"
+        "--- \n\n"
+        "🛡️ **Allowlist (Member yang Nggak Ikut Di-ban)**\n\n"
+        "Ada staf, bot, atau member VIP yang boleh keluar-masuk? Masukin ke allowlist channel target kamu lewat chat ini:\n"
+        "•   `/allow 12345 67890` buat nambahin ID, `/unallow 12345` buat ngehapus. ID channel/grup (`-100...`) juga bisa.\n"
+        "•   Punya lebih dari satu channel? Sebutin ID channel-nya dulu, misal `/allow -1001234567890 12345`.\n"
+        "•   Punya daftar panjang? Kirim file `.txt`/`.csv` berisi ID dengan caption `/allowlist_import`.\n"
+        "•   `/allowlist_export` buat ngambil daftar lengkapnya sebagai file.\n\n"
+        "--- \n\n"
+        "📊 **Statistik & Riwayat**\n\n"
+        "•   `/stats` buat lihat berapa member yang keluar hari ini, seminggu, sebulan, plus hari & minggu paling rame.\n"
+        "•   `/export` buat download riwayat lengkapnya (CSV), atau `/export 7` buat 7 hari terakhir aja. Channel lebih dari satu? Sebutin ID-nya kayak di `/allow`."
     )
-    await update.effective_chat.send_message(text=detailed_text, parse_mode='Markdown', disable_web_page_preview=True)
+    await show_guide(update, context, "channel", context.user_data, detailed_text)
 
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Membatalkan aksi saat ini dan kembali ke menu utama (untuk chat pribadi)."""
@@ -454,63 +1558,73 @@ async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE
         try:
             await update.message.delete() # Hapus pesan /cancel yang dikirim pengguna
         except Exception as e:
-            logger.warning(f"Gagal menghapus pesan /cancel: {e}")
+            logger.warning("Gagal menghapus pesan /cancel: %s", e)
 
-    await show_main_menu(update, context, message_text="Aksi dibatalkan. Kembali ke Menu Utama.", is_initial_load=True)
+    await show_main_menu(update, context, message_text="Aksi dibatalkan. Kembali ke Menu Utama.")
     return ConversationHandler.END
 
 # --- HANDLER UNTUK FITUR-FITUR BOT (PENGATURAN GRUP) ---
 
-async def toggle_group_ban_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Mengaktifkan atau menonaktifkan fitur banning untuk grup (dari dalam grup)."""
+async def ensure_group_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    Memastikan pengguna yang menekan tombol adalah admin grup.
+    Jika bukan (atau terjadi error), callback query langsung dijawab dengan alert dan mengembalikan False.
+    """
     query = update.callback_query
-    user_id = query.from_user.id
     chat_id = query.message.chat.id
-    chat_title = query.message.chat.title
-
     try:
-        member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+        member = await context.bot.get_chat_member(chat_id=chat_id, user_id=query.from_user.id)
         if member.status not in ["administrator", "creator"]:
             await query.answer("❌ Hanya admin group yang bisa mengaktifkan atau menonaktifkan fitur ini.", show_alert=True)
-            return
+            return False
     except Exception as e:
-        logger.error(f"Error checking user permissions in group {chat_id}: {e}")
+        logger.error("Error checking user permissions in group %s: %s", chat_id, e)
         await query.answer("Terjadi kesalahan saat memeriksa izin Anda.", show_alert=True)
-        return
+        return False
+    return True
 
-    is_valid, message = await check_bot_ban_permissions(context, chat_id)
+async def toggle_group_ban_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mengaktifkan atau menonaktifkan fitur banning untuk grup (dari dalam grup)."""
+    query = update.callback_query
+    chat_id = query.message.chat.id
 
-    if not context.chat_data.get('banning_enabled', False) and not is_valid:
-        context.chat_data['banning_enabled'] = False
-        await query.answer(f"Gagal Mengaktifkan: {message}", show_alert=True)
-        await show_group_menu(update, context, message_text=f"❌ **Gagal!**\n{message}")
+    if not await ensure_group_admin(update, context):
         return
 
-    current_state = context.chat_data.get('banning_enabled', False)
+    # Izin bot hanya perlu diperiksa saat akan mengaktifkan, bukan saat mematikan
+    if not context.chat_data.banning_enabled:
+        is_valid, message = await check_bot_ban_permissions(context.bot, chat_id)
+        if not is_valid:
+            context.chat_data.banning_enabled = False
+            update_group_index(chat_id, context.chat_data)
+            await query.answer(f"Gagal Mengaktifkan: {message}", show_alert=True)
+            await show_group_menu(update, context, message_text=f"❌ **Gagal!**\n{message}")
+            return
+
+    current_state = context.chat_data.banning_enabled
     new_state = not current_state
-    context.chat_data['banning_enabled'] = new_state
+    context.chat_data.banning_enabled = new_state
+    update_group_index(chat_id, context.chat_data)
 
     status_text = "Aktif" if new_state else "Tidak Aktif"
     await query.answer(f"Fitur Banning Group sekarang: {status_text}", show_alert=True)
     await show_group_menu(update, context)
 
-async def how_to_use_group_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Menampilkan panduan penggunaan bot untuk grup (dari dalam grup)."""
+async def toggle_group_notification_mode_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mengganti mode notifikasi blokir grup antara instan dan ringkasan (khusus admin grup)."""
     query = update.callback_query
-    await query.answer()
-
-    # Caption singkat untuk gambar "Cara Pakai"
-    caption = "📖 **Panduan Penggunaan Bot (Group)**"
-    keyboard = [[InlineKeyboardButton("⬅️ Balik ke Menu Group", callback_data="back_to_group_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if not await ensure_group_admin(update, context):
+        return
 
-    # Edit pesan gambar yang ada dengan caption singkat dan tombol
-    await send_or_edit_photo_message(
-        update, context, IMAGE_URL_MAIN_MENU, caption, reply_markup,
-        is_new_message=False
-    )
+    new_mode = 'digest' if context.chat_data.notification_mode == 'instant' else 'instant'
+    context.chat_data.notification_mode = new_mode
+    update_group_index(query.message.chat.id, context.chat_data)
+    await query.answer(f"Mode notifikasi group sekarang: {NOTIFICATION_MODE_LABELS[new_mode]}", show_alert=True)
+    await show_group_menu(update, context)
 
-    # Kirim detail panduan sebagai pesan teks terpisah (boleh panjang)
+async def how_to_use_group_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Menampilkan panduan penggunaan bot untuk grup (dari dalam grup)."""
+    # Teks panduan lengkap; show_guide hanya mengirimnya sekali per chat (atau saat diminta kirim ulang)
     detailed_text = (
         "Woy bestie! Bot ini tuh auto-ban member yang kabur dari grup kamu. Jadi, grup kamu bakal aman dari *silent left* yang bikin gabut.\n\n"
         "--- \n\n"
@@ -532,10 +1646,1413 @@ async def how_to_use_group_callback(update: Update, context: ContextTypes.DEFAUL
         "•   Pokoknya, kalau ada yang *left*, langsung **auto-ban** biar kapok! 😂\n\n"
         "--- \n\n"
         "🔔 **Notifikasi Ban (Langsung di Group)**\n\n"
-        "Setiap kali bot berhasil nge-ban seseorang dari grup, notifikasinya bakal muncul langsung di chat grup ini. Jadi, semua member (dan kamu sebagai admin) bisa langsung tahu siapa yang di-ban. Keren kan?"
+        "Setiap kali bot berhasil nge-ban seseorang dari grup, notifikasinya bakal muncul langsung di chat grup ini. Jadi, semua member (dan kamu sebagai admin) bisa langsung tahu siapa yang di-ban. Keren kan?\n"
+        "Kalau banyak member keluar barengan, grup nggak bakal dibanjiri notifikasi: cukup satu peringatan 🚨 dan satu ringkasan setelah reda.\n\n"
+        "--- \n\n"
+        "🛡️ **Allowlist (Khusus Admin)**\n\n"
+        "•   Balas pesan member dengan `/allow` (atau `/allow <ID>`) biar dia nggak di-ban kalau keluar. `/unallow` buat ngebatalin.\n"
+        "•   Kirim file `.txt`/`.csv` berisi ID dengan caption `/allowlist_import` buat import massal, dan `/allowlist_export` buat download daftarnya.\n\n"
+        "--- \n\n"
+        "📊 **Statistik & Riwayat (Khusus Admin)**\n\n"
+        "•   `/stats` buat lihat jumlah member yang keluar & di-ban, dan `/export` (atau `/export 7`) buat download riwayatnya sebagai CSV."
     )
-    await update.effective_chat.send_message(text=detailed_text, parse_mode='Markdown', disable_web_page_preview=True)
+    await show_guide(update, context, "group", context.chat_data, detailed_text)
+
+# --- ALLOWLIST (PENGECUALIAN BAN PER CHAT) ---
 
+class CompactIntSet:
+    """
+    Himpunan bilangan bulat hemat memori untuk ID Telegram.
+    - Nilai disimpan dalam satu array('q') terurut (8 byte per nilai, dicek dengan bisect).
+    - Rentang 65536 nilai yang berisi lebih dari DENSE_LIMIT nilai dipindah ke bitmap 8 KB ala roaring
+      (dicek dengan satu operasi bit), sehingga daftar padat seperti ID berurutan jauh lebih kecil lagi.
+    Container per 65536 murni ala roaring sengaja tidak dipakai untuk data jarang: ID Telegram tersebar
+    di rentang miliaran, sehingga hampir setiap ID akan punya container sendiri (>100 byte per ID).
+    """
+    __slots__ = ("_sorted", "_bitmaps", "_size")
+    DENSE_LIMIT = 4096 # Di atas ini 8 byte/nilai lebih boros dari bitmap 8 KB
+
+    def __init__(self, values=()):
+        self._sorted = array('q')
+        self._bitmaps: dict[int, bytearray] = {} # 48 bit atas -> bitmap 65536 bit
+        self._size = 0
+        self.update(values)
+
+    @classmethod
+    def from_sorted(cls, values) -> "CompactIntSet":
+        """
+        Membangun himpunan dari nilai unik yang sudah terurut naik (misal kolom PRIMARY KEY dengan ORDER BY) tanpa
+        mengurutkan ulang. Semua nilai disimpan di array; rentang padat baru dipindah ke bitmap saat bertambah.
+        """
+        result = cls()
+        result._sorted = array('q', values)
+        result._size = len(result._sorted)
+        return result
+
+    def __contains__(self, value: int) -> bool:
+        bitmap = self._bitmaps.get(value >> 16)
+        if bitmap is not None:
+            low = value & 0xFFFF
+            return bool(bitmap[low >> 3] & (1 << (low & 7)))
+        values = self._sorted
+        i = bisect.bisect_left(values, value)
+        return i < len(values) and values[i] == value
+
+    def add(self, value: int) -> bool:
+        """Menambahkan satu nilai; mengembalikan True jika sebelumnya belum ada."""
+        if value in self:
+            return False
+        bitmap = self._bitmaps.get(value >> 16)
+        if bitmap is not None:
+            low = value & 0xFFFF
+            bitmap[low >> 3] |= 1 << (low & 7)
+        else:
+            self._sorted.insert(bisect.bisect_left(self._sorted, value), value)
+            self._promote(value >> 16)
+        self._size += 1
+        return True
+
+    def update(self, values) -> list[int]:
+        """Menambahkan banyak nilai sekaligus (import massal, satu kali pengurutan); mengembalikan nilai yang baru."""
+        added = [value for value in set(values) if value not in self]
+        if not added:
+            return added
+        touched = set()
+        fresh = []
+        for value in added:
+            bitmap = self._bitmaps.get(value >> 16)
+            if bitmap is not None:
+                low = value & 0xFFFF
+                bitmap[low >> 3] |= 1 << (low & 7)
+            else:
+                fresh.append(value)
+                touched.add(value >> 16)
+        if len(fresh) * 16 < len(self._sorted):
+            # Batch kecil terhadap array besar: sisip satu per satu lebih murah daripada mengurutkan ulang semuanya
+            for value in fresh:
+                self._sorted.insert(bisect.bisect_left(self._sorted, value), value)
+        elif fresh:
+            merged = list(self._sorted)
+            merged.extend(fresh)
+            merged.sort()
+            self._sorted = array('q', merged)
+        self._size += len(added)
+        # Hanya rentang yang bertambah yang mungkin melewati DENSE_LIMIT
+        for high in touched:
+            self._promote(high)
+        return added
+
+    def _promote(self, high: int) -> bool:
+        """Memindahkan rentang `high` dari array ke bitmap jika isinya sudah melebihi DENSE_LIMIT."""
+        start = bisect.bisect_left(self._sorted, high << 16)
+        end = bisect.bisect_left(self._sorted, (high + 1) << 16, start)
+        if end - start <= self.DENSE_LIMIT:
+            return False
+        bitmap = bytearray(8192)
+        for value in self._sorted[start:end]:
+            low = value & 0xFFFF
+            bitmap[low >> 3] |= 1 << (low & 7)
+        del self._sorted[start:end]
+        self._bitmaps[high] = bitmap
+        return True
+
+    def discard(self, value: int) -> bool:
+        """Menghapus nilai; mengembalikan True jika sebelumnya ada."""
+        if value not in self:
+            return False
+        bitmap = self._bitmaps.get(value >> 16)
+        if bitmap is not None:
+            low = value & 0xFFFF
+            bitmap[low >> 3] &= ~(1 << (low & 7)) & 0xFF
+            if not any(bitmap):
+                del self._bitmaps[value >> 16]
+        else:
+            del self._sorted[bisect.bisect_left(self._sorted, value)]
+        self._size -= 1
+        return True
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _iter_bitmap(high: int, bitmap: bytearray):
+        base = high << 16
+        for byte_index, byte in enumerate(bitmap):
+            while byte:
+                yield base | (byte_index << 3) | ((byte & -byte).bit_length() - 1)
+                byte &= byte - 1
+
+    def __iter__(self):
+        """Nilai dalam urutan naik."""
+        bitmaps = [self._iter_bitmap(high, self._bitmaps[high]) for high in sorted(self._bitmaps)]
+        return heapq.merge(iter(self._sorted), *bitmaps) if bitmaps else iter(self._sorted)
+
+    def nbytes(self) -> int:
+        """Perkiraan memori isi (array + bitmap, tanpa overhead objek)."""
+        return self._sorted.itemsize * len(self._sorted) + 8192 * len(self._bitmaps)
+
+class AllowlistStore:
+    """
+    Allowlist per chat: user yang tidak ikut diban saat keluar (staf, bot, VIP).
+    Isi disimpan di memori sebagai CompactIntSet per chat dan di tabel SQLite (satu baris per pasangan
+    chat/user) di database sendiri (ALLOWLIST_DB_PATH), jadi setiap perubahan hanya menulis baris yang
+    bertambah/berkurang dan tidak pernah menahan lock tulis database persistence.
+    """
+
+    def __init__(self):
+        self._sets: dict[int, CompactIntSet] = {}
+        self._conn: sqlite3.Connection = None
+        self._write_lock = threading.Lock() # Satu koneksi dipakai dari beberapa thread to_thread
+
+    def open(self, db_path: str, legacy_db_path: str = None) -> None:
+        """Membuka database allowlist; tabel allowlist di `legacy_db_path` (format lama) dipindahkan ke sini."""
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS allowlist (chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+            "PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID"
+        )
+        if legacy_db_path and os.path.exists(legacy_db_path) and os.path.abspath(legacy_db_path) != os.path.abspath(db_path):
+            self._move_legacy_table(legacy_db_path)
+        self._sets.clear()
+        rows = self._conn.execute("SELECT chat_id, user_id FROM allowlist ORDER BY chat_id, user_id")
+        for chat_id, chat_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            self._sets[chat_id] = CompactIntSet(user_id for _, user_id in chat_rows)
+        logger.info("Allowlist dimuat: %s user di %s chat.", sum(map(len, self._sets.values())), len(self._sets))
+
+    def _move_legacy_table(self, legacy_db_path: str) -> None:
+        self._conn.execute("ATTACH DATABASE ? AS legacy", (legacy_db_path,))
+        try:
+            if not self._conn.execute("SELECT 1 FROM legacy.sqlite_master WHERE type = 'table' AND name = 'allowlist'").fetchone():
+                return
+            # INSERT OR IGNORE: jika proses berhenti sebelum DROP, pemindahan diulang tanpa duplikat di startup berikutnya
+            self._conn.execute("BEGIN")
+            moved = self._conn.execute("INSERT OR IGNORE INTO main.allowlist SELECT chat_id, user_id FROM legacy.allowlist").rowcount
+            self._conn.execute("DROP TABLE legacy.allowlist")
+            self._conn.execute("COMMIT")
+            logger.info("Allowlist dipindahkan dari %s: %s baris.", legacy_db_path, moved)
+        finally:
+            self._conn.execute("DETACH DATABASE legacy")
+
+    def close(self) -> None:
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def is_allowed(self, chat_id: int, user_id: int) -> bool:
+        allowed = self._sets.get(chat_id)
+        return allowed is not None and user_id in allowed
+
+    def count(self, chat_id: int) -> int:
+        return len(self._sets.get(chat_id, ()))
+
+    def members(self, chat_id: int):
+        """Iterator ID allowlist chat dalam urutan naik."""
+        return iter(self._sets.get(chat_id, ()))
+
+    def totals(self) -> tuple[int, int, int]:
+        """(jumlah chat, jumlah user, perkiraan byte isi) untuk metrik."""
+        sets = self._sets.values()
+        return len(self._sets), sum(map(len, sets)), sum(allowed.nbytes() for allowed in sets)
+
+    async def add(self, chat_id: int, user_ids) -> int:
+        """Menambahkan user ke allowlist chat; mengembalikan jumlah yang benar-benar baru."""
+        added = self._sets.setdefault(chat_id, CompactIntSet()).update(user_ids)
+        if added:
+            await asyncio.to_thread(self._write, "INSERT OR IGNORE INTO allowlist (chat_id, user_id) VALUES (?, ?)", chat_id, added)
+        return len(added)
+
+    async def remove(self, chat_id: int, user_ids) -> int:
+        allowed = self._sets.get(chat_id)
+        if allowed is None:
+            return 0
+        removed = [user_id for user_id in user_ids if allowed.discard(user_id)]
+        if not allowed:
+            del self._sets[chat_id]
+        if removed:
+            await asyncio.to_thread(self._write, "DELETE FROM allowlist WHERE chat_id = ? AND user_id = ?", chat_id, removed)
+        return len(removed)
+
+    def _write(self, statement: str, chat_id: int, user_ids: list[int]) -> None:
+        with self._write_lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(statement, ((chat_id, user_id) for user_id in user_ids))
+            self._conn.execute("COMMIT")
+
+allowlist = AllowlistStore()
+
+def parse_id_token(token: str):
+    """
+    ID Telegram dari satu token teks: hanya digit ASCII dengan paling banyak satu tanda minus di depan
+    (ID channel/sender chat -100...). Mengembalikan None untuk token lain, termasuk digit Unicode seperti "²"
+    yang lolos str.isdigit() tapi ditolak int().
+    """
+    if token.isascii() and token.removeprefix("-").isdigit():
+        return int(token)
+    return None
+
+def parse_user_ids(lines, stats: dict = None) -> list[int]:
+    """
+    Mengambil semua ID numerik dari baris teks/CSV (pemisah koma, titik koma, tab, atau spasi), lihat parse_id_token.
+    Jika `stats` diberikan, token yang berisi angka tapi bukan ID valid (misal "12a", "--5", "²") dihitung di
+    stats["skipped"]; token tanpa angka (header CSV, nama) diabaikan diam-diam.
+    """
+    user_ids = []
+    for line in lines:
+        for token in line.replace(",", " ").replace(";", " ").split():
+            token = token.strip("\"'")
+            user_id = parse_id_token(token)
+            if user_id is not None:
+                user_ids.append(user_id)
+            elif stats is not None and any(char.isdigit() for char in token):
+                stats["skipped"] = stats.get("skipped", 0) + 1
+    return user_ids
+
+async def require_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, chat_kind: str, action: str) -> bool:
+    """Memastikan pengirim perintah admin/creator di `chat_id`; jika bukan (atau gagal dicek), balasan sudah dikirim."""
+    try:
+        member = await context.bot.get_chat_member(chat_id=chat_id, user_id=update.effective_user.id)
+    except Exception as e:
+        logger.error("Error checking user permissions in %s %s: %s", chat_kind, chat_id, e)
+        await update.effective_message.reply_text("Terjadi kesalahan saat memeriksa izin Anda.")
+        return False
+    if member.status not in ["administrator", "creator"]:
+        await update.effective_message.reply_text(f"❌ Hanya admin {chat_kind} yang bisa {action}.")
+        return False
+    return True
+
+async def resolve_command_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = "mengelola allowlist",
+                               example: str = "/allow {chat_id} 12345"):
+    """
+    Menentukan chat yang menjadi sasaran perintah (allowlist, /stats, /export):
+    di grup = grup itu sendiri, di chat pribadi = salah satu channel target milik pengguna; keduanya khusus admin.
+    `action` dan `example` dipakai di pesan balasan. Mengembalikan (chat_id, label) atau None jika perintah
+    tidak bisa diproses (pesan balasan sudah dikirim).
+    """
+    chat = update.effective_chat
+    if chat.type in [Chat.GROUP, Chat.SUPERGROUP]:
+        if not await require_chat_admin(update, context, chat.id, "group", action):
+            return None
+        return chat.id, f"group **{chat.title}**"
+    if chat.type == Chat.PRIVATE:
+        channels = context.user_data.channels
+        if not channels:
+            await update.effective_message.reply_text(f"⚠️ Atur channel target dulu lewat /start sebelum {action}.")
+            return None
+        # Channel dipilih lewat ID-nya di argumen (atau caption untuk import file); wajib jika channel lebih dari satu
+        tokens = context.args if context.args is not None else (update.effective_message.caption or "").split()[1:]
+        channel_id = next((chat_id for chat_id in map(parse_id_token, tokens) if chat_id in channels), None)
+        if channel_id is None and len(channels) == 1:
+            channel_id = next(iter(channels))
+        if channel_id is None:
+            listed = "\n".join(f"▪️ `{chat_id}` — {title}" for chat_id, (title, _) in itertools.islice(channels.items(), 10))
+            await update.effective_message.reply_text(
+                f"Kamu punya {len(channels)} channel target. Sebutkan ID channel-nya dulu, "
+                f"misal `{example.format(chat_id=next(iter(channels)))}`:\n{listed}", parse_mode='Markdown'
+            )
+            return None
+        # Channel masuk daftar cukup dengan mengetik ID-nya, jadi status admin pengirim dicek ulang di sini
+        if not await require_chat_admin(update, context, channel_id, "channel", action):
+            return None
+        return channel_id, f"channel **{channels[channel_id][0]}**"
+    return None
+
+def command_user_ids(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> list[int]:
+    """
+    ID user dari argumen perintah, atau dari pengirim pesan yang dibalas (reply) jika tanpa argumen; pesan atas nama
+    channel/grup memakai ID sender chat. `chat_id` (chat sasaran, bisa ikut tertulis di argumen sebagai pemilih
+    channel) tidak ikut dihitung.
+    """
+    user_ids = [user_id for user_id in parse_user_ids(context.args or []) if user_id != chat_id]
+    reply = update.effective_message.reply_to_message
+    if not user_ids and reply and (reply.sender_chat or reply.from_user):
+        user_ids = [reply.sender_chat.id if reply.sender_chat else reply.from_user.id]
+    return user_ids
+
+async def allow_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/allow <id> [id ...] atau balas pesan dengan /allow: user tidak akan diban saat keluar."""
+    target = await resolve_command_chat(update, context)
+    if target is None:
+        return
+    chat_id, label = target
+    user_ids = command_user_ids(update, context, chat_id)
+    if not user_ids:
+        await update.effective_message.reply_text("Cara pakai: `/allow <user_id> [user_id ...]` atau balas pesan user dengan `/allow`.", parse_mode='Markdown')
+        return
+    added = await allowlist.add(chat_id, user_ids)
+    await update.effective_message.reply_text(
+        f"✅ {added} user ditambahkan ke allowlist {label} (total {allowlist.count(chat_id)}).", parse_mode='Markdown'
+    )
+
+async def unallow_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/unallow <id> [id ...]: menghapus user dari allowlist."""
+    target = await resolve_command_chat(update, context)
+    if target is None:
+        return
+    chat_id, label = target
+    user_ids = command_user_ids(update, context, chat_id)
+    if not user_ids:
+        await update.effective_message.reply_text("Cara pakai: `/unallow <user_id> [user_id ...]`.", parse_mode='Markdown')
+        return
+    removed = await allowlist.remove(chat_id, user_ids)
+    await update.effective_message.reply_text(
+        f"🗑️ {removed} user dihapus dari allowlist {label} (total {allowlist.count(chat_id)}).", parse_mode='Markdown'
+    )
+
+async def allowlist_export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/allowlist_export: mengirim allowlist sebagai file teks (satu ID per baris)."""
+    target = await resolve_command_chat(update, context)
+    if target is None:
+        return
+    chat_id, label = target
+    total = allowlist.count(chat_id)
+    if not total:
+        await update.effective_message.reply_text(f"Allowlist {label} masih kosong.", parse_mode='Markdown')
+        return
+    with tempfile.TemporaryFile() as export_file:
+        # Ditulis per blok ke file sementara supaya daftar besar tidak perlu dirangkai jadi satu string raksasa
+        members = allowlist.members(chat_id)
+        while block := list(itertools.islice(members, 10000)):
+            export_file.write("".join(f"{user_id}\n" for user_id in block).encode())
+        export_file.seek(0)
+        await update.effective_message.reply_document(
+            document=export_file, filename=f"allowlist_{chat_id}.txt",
+            caption=f"📄 Allowlist {label}: {total} user.", parse_mode='Markdown'
+        )
+
+async def allowlist_import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Dokumen CSV/teks dengan caption /allowlist_import: semua ID numerik di dalamnya ditambahkan ke allowlist."""
+    target = await resolve_command_chat(update, context)
+    if target is None:
+        return
+    chat_id, label = target
+    document = update.effective_message.document
+    if document.file_size and document.file_size > ALLOWLIST_MAX_IMPORT_BYTES:
+        await update.effective_message.reply_text(f"❌ File terlalu besar (maksimal {ALLOWLIST_MAX_IMPORT_BYTES // 1_000_000} MB).")
+        return
+    telegram_file = await document.get_file()
+    added = 0
+    import_stats = {"skipped": 0}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = await telegram_file.download_to_drive(os.path.join(tmp_dir, "allowlist_import"))
+        with open(path, "r", encoding="utf-8", errors="ignore") as import_file:
+            # Dibaca per blok baris supaya file besar tidak dimuat utuh ke memori
+            while lines := import_file.readlines(1_000_000):
+                added += await allowlist.add(chat_id, parse_user_ids(lines, import_stats))
+    skipped = import_stats["skipped"]
+    skipped_note = f"\n⚠️ {skipped} nilai bukan ID valid dilewati." if skipped else ""
+    await update.effective_message.reply_text(
+        f"✅ Import selesai: {added} user baru di allowlist {label} (total {allowlist.count(chat_id)}).{skipped_note}",
+        parse_mode='Markdown'
+    )
+
+# --- RIWAYAT BAN (APPEND-ONLY, UNTUK /stats & /export) ---
+
+# Kode hasil di kolom `outcome` = indeks di tuple ini (sekaligus urutan kolom rekap di ban_daily)
+BAN_OUTCOMES = ("banned", "failed", "allowlisted")
+BAN_OUTCOME_LABELS = {"banned": "diban", "failed": "gagal", "allowlisted": "allowlist"}
+
+class BanAuditStore:
+    """
+    Riwayat hasil setiap event left yang diproses (diban, gagal diban, atau dilewati karena allowlist) di SQLite.
+    record() hanya memasukkan tuple ke antrian; satu thread penulis mengambil semua yang sudah antri dan
+    menulisnya dalam satu transaksi, jadi event loop tidak pernah menunggu disk.
+    Baris mentah dipartisi per bulan (tabel bans_YYYYMM dengan indeks (chat_id, ts)), sehingga export hanya
+    menyentuh partisi yang relevan dan retensi cukup DROP TABLE. Rekap harian per chat (ban_daily) diperbarui
+    di transaksi yang sama, jadi /stats hanya membaca rekap dan tetap cepat walau baris mentah berjumlah jutaan.
+    """
+
+    def __init__(self):
+        self.path: str = None
+        self.utc_offset = int(BAN_AUDIT_UTC_OFFSET_HOURS * 3600)
+        self._queue: queue.Queue = queue.Queue(BAN_AUDIT_MAX_PENDING)
+        self._conn: sqlite3.Connection = None # Hanya dipakai thread penulis setelah open()
+        self._writer: threading.Thread = None
+        self._partitions: set[str] = set()
+        self.stats = {"written": 0, "dropped": 0, "batches": 0, "errors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self._writer is not None
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def local_day(self, ts: int) -> int:
+        """Nomor hari (sejak 1970-01-01) di zona waktu BAN_AUDIT_UTC_OFFSET_HOURS."""
+        return (ts + self.utc_offset) // 86400
+
+    def partition_name(self, ts: int) -> str:
+        return time.strftime("bans_%Y%m", time.gmtime(ts + self.utc_offset))
+
+    def open(self, db_path: str) -> None:
+        self.path = db_path
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ban_daily (chat_id INTEGER NOT NULL, day INTEGER NOT NULL, "
+            "banned INTEGER NOT NULL, failed INTEGER NOT NULL, allowlisted INTEGER NOT NULL, "
+            "PRIMARY KEY (chat_id, day)) WITHOUT ROWID"
+        )
+        self._partitions = {
+            name for (name,) in self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'bans_[0-9]*'")
+        }
+        self._drop_expired_partitions()
+        self._writer = threading.Thread(target=self._write_loop, name="ban-audit", daemon=True)
+        self._writer.start()
+        logger.info("Riwayat ban %s dibuka (%s partisi bulanan).", db_path, len(self._partitions))
+
+    async def close(self) -> None:
+        """Menulis sisa antrian lalu menghentikan thread penulis."""
+        if self._writer is None:
+            return
+        await asyncio.to_thread(self._queue.put, None)
+        await asyncio.to_thread(self._writer.join)
+        self._writer = None
+        self._conn.close()
+        logger.info("Riwayat ban ditutup. Statistik: %s", self.stats)
+
+    async def flush(self) -> None:
+        """Menunggu sampai semua record yang sudah masuk antrian selesai ditulis."""
+        if self._writer is None:
+            return
+        written = threading.Event()
+        await asyncio.to_thread(self._queue.put, written)
+        await asyncio.to_thread(written.wait)
+
+    def record(self, chat_id: int, user_id: int, outcome: str, ts: int, full_name: str = None,
+               username: str = None, error: Exception = None) -> None:
+        """Mencatat satu hasil event left; tidak pernah memblokir (record dibuang jika antrian penuh)."""
+        if self._writer is None:
+            return
+        row = (ts, chat_id, user_id, BAN_OUTCOMES.index(outcome), full_name, username, str(error)[:200] if error else None)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _write_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            # Ambil semua yang sudah antri (sampai BAN_AUDIT_BATCH_SIZE) supaya satu burst cukup satu commit
+            rows, markers = [], []
+            item = self._queue.get()
+            while True:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    markers.append(item)
+                else:
+                    rows.append(item)
+                if stopping or len(rows) >= BAN_AUDIT_BATCH_SIZE:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if rows:
+                try:
+                    self._write(rows)
+                except sqlite3.Error as e:
+                    self.stats["errors"] += 1
+                    logger.error("Gagal menulis %s record riwayat ban: %s", len(rows), e)
+            for marker in markers:
+                marker.set()
+
+    def _write(self, rows: list[tuple]) -> None:
+        by_partition: dict[str, list[tuple]] = {}
+        daily: dict[tuple[int, int], list[int]] = {}
+        for row in rows:
+            ts, chat_id, _, outcome = row[:4]
+            by_partition.setdefault(self.partition_name(ts), []).append(row)
+            daily.setdefault((chat_id, self.local_day(ts)), [0, 0, 0])[outcome] += 1
+        created = [name for name in by_partition if name not in self._partitions]
+        self._conn.execute("BEGIN")
+        try:
+            for name in created:
+                self._conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} (ts INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+                    "user_id INTEGER NOT NULL, outcome INTEGER NOT NULL, full_name TEXT, username TEXT, error TEXT)"
+                )
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_chat_ts ON {name} (chat_id, ts)")
+            for name, partition_rows in by_partition.items():
+                self._conn.executemany(f"INSERT INTO {name} VALUES (?, ?, ?, ?, ?, ?, ?)", partition_rows)
+            # Rekap dijumlahkan dulu di memori: satu upsert per (chat, hari) per batch, bukan per record
+            self._conn.executemany(
+                "INSERT INTO ban_daily (chat_id, day, banned, failed, allowlisted) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (chat_id, day) DO UPDATE SET banned = banned + excluded.banned, "
+                "failed = failed + excluded.failed, allowlisted = allowlisted + excluded.allowlisted",
+                ((chat_id, day, *counts) for (chat_id, day), counts in daily.items())
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self.stats["written"] += len(rows)
+        self.stats["batches"] += 1
+        if created:
+            self._partitions.update(created)
+            self._drop_expired_partitions()
+
+    def _drop_expired_partitions(self) -> None:
+        if BAN_AUDIT_RETENTION_MONTHS <= 0:
+            return
+        now = time.gmtime(time.time() + self.utc_offset)
+        month = now.tm_year * 12 + now.tm_mon - 1 - BAN_AUDIT_RETENTION_MONTHS
+        oldest_kept = f"bans_{month // 12:04d}{month % 12 + 1:02d}"
+        for name in sorted(self._partitions):
+            if name >= oldest_kept:
+                break
+            self._conn.execute(f"DROP TABLE IF EXISTS {name}")
+            self._partitions.discard(name)
+            logger.info("Partisi riwayat ban %s dihapus (retensi %s bulan).", name, BAN_AUDIT_RETENTION_MONTHS)
+
+    def _connect_reader(self) -> sqlite3.Connection:
+        # Koneksi baca terpisah per query: WAL mengizinkan baca bersamaan dengan thread penulis tanpa lock
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+
+    def chat_stats(self, chat_id: int, now: float = None, top: int = 5) -> dict:
+        """
+        Statistik keluar satu chat dari rekap harian: jumlah (diban, gagal, allowlist) untuk hari ini, 7 hari,
+        30 hari dan seluruh riwayat, plus hari & minggu (mulai Senin) dengan member keluar terbanyak.
+        Dipanggil lewat asyncio.to_thread.
+        """
+        today = self.local_day(int(now if now is not None else time.time()))
+        with contextlib.closing(self._connect_reader()) as conn:
+            recent = conn.execute(
+                "SELECT day, banned, failed, allowlisted FROM ban_daily WHERE chat_id = ? AND day > ?", (chat_id, today - 30)
+            ).fetchall()
+            all_time = conn.execute(
+                "SELECT COALESCE(SUM(banned), 0), COALESCE(SUM(failed), 0), COALESCE(SUM(allowlisted), 0) "
+                "FROM ban_daily WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            top_days = conn.execute(
+                "SELECT day, banned + failed + allowlisted AS left_count FROM ban_daily WHERE chat_id = ? "
+                "ORDER BY left_count DESC, day DESC LIMIT ?", (chat_id, top)
+            ).fetchall()
+            # Hari ke-0 (1970-01-01) adalah Kamis, jadi (day + 3) / 7 memotong minggu tepat di hari Senin
+            top_weeks = conn.execute(
+                "SELECT (day + 3) / 7 * 7 - 3 AS week_start, SUM(banned + failed + allowlisted) AS left_count "
+                "FROM ban_daily WHERE chat_id = ? GROUP BY week_start ORDER BY left_count DESC, week_start DESC LIMIT ?",
+                (chat_id, top)
+            ).fetchall()
+        periods = {
+            days: tuple(sum(row[column] for row in recent if row[0] > today - days) for column in (1, 2, 3))
+            for days in (1, 7, 30)
+        }
+        periods[None] = tuple(all_time)
+        return {"periods": periods, "top_days": top_days, "top_weeks": top_weeks}
+
+    def export_csv(self, chat_id: int, export_file, since_ts: int = 0, max_bytes: int = BAN_AUDIT_EXPORT_MAX_BYTES) -> tuple[int, bool]:
+        """
+        Menulis riwayat satu chat sebagai CSV (terbaru dulu) ke file biner, per blok supaya riwayat besar tidak
+        dimuat utuh ke memori. Hanya partisi bulan yang mencakup `since_ts` ke atas yang dibaca, masing-masing
+        lewat indeks (chat_id, ts). Mengembalikan (jumlah baris, terpotong karena max_bytes).
+        Dipanggil lewat asyncio.to_thread.
+        """
+        header = "waktu,user_id,nama,username,hasil,error\r\n".encode()
+        export_file.write(header)
+        written_bytes, rows_written = len(header), 0
+        oldest_partition = self.partition_name(since_ts) if since_ts else ""
+        with contextlib.closing(self._connect_reader()) as conn:
+            partitions = [
+                name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'bans_[0-9]*'")
+                if name >= oldest_partition
+            ]
+            for name in sorted(partitions, reverse=True):
+                cursor = conn.execute(
+                    f"SELECT ts, user_id, full_name, username, outcome, error FROM {name} WHERE chat_id = ? AND ts >= ? ORDER BY ts DESC",
+                    (chat_id, since_ts)
+                )
+                while block := cursor.fetchmany(10000):
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    for ts, user_id, full_name, username, outcome, error in block:
+                        writer.writerow((
+                            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts + self.utc_offset)),
+                            user_id, full_name or "", username or "", BAN_OUTCOMES[outcome], error or "",
+                        ))
+                    data = buffer.getvalue().encode()
+                    if written_bytes + len(data) > max_bytes:
+                        # Potong di batas baris supaya file tetap CSV yang valid
+                        last_row_end = data.rfind(b"\r\n", 0, max(max_bytes - written_bytes, 0))
+                        if last_row_end < 0:
+                            return rows_written, True # Tidak ada satu baris utuh pun yang masih muat
+                        cut = last_row_end + 2
+                        export_file.write(data[:cut])
+                        return rows_written + data.count(b"\r\n", 0, cut), True
+                    export_file.write(data)
+                    written_bytes += len(data)
+                    rows_written += len(block)
+        return rows_written, False
+
+ban_audit = BanAuditStore()
+
+def format_day(day: int) -> str:
+    return (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).strftime("%d-%m-%Y")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats [ID channel]: jumlah member keluar hari ini, 7 & 30 hari, seluruh riwayat, dan periode teramai."""
+    target = await resolve_command_chat(update, context, action="melihat statistik", example="/stats {chat_id}")
+    if target is None:
+        return
+    chat_id, label = target
+    if not ban_audit.enabled:
+        await update.effective_message.reply_text("Riwayat ban tidak diaktifkan di bot ini.")
+        return
+    stats = await asyncio.to_thread(ban_audit.chat_stats, chat_id)
+    period_labels = {1: "Hari ini", 7: "7 hari", 30: "30 hari", None: "Semua"}
+    lines = [f"📊 Statistik member keluar di {label}", ""]
+    for days, (banned, failed, allowlisted) in stats["periods"].items():
+        lines.append(f"▪️ {period_labels[days]}: {banned + failed + allowlisted} keluar (diban {banned}, gagal {failed}, allowlist {allowlisted})")
+    if stats["top_days"]:
+        lines += ["", "🔥 **Hari teramai:**"]
+        lines += [f"{rank}. {format_day(day)} — {count} keluar" for rank, (day, count) in enumerate(stats["top_days"], 1)]
+        lines += ["", "🔥 **Minggu teramai (mulai Senin):**"]
+        lines += [f"{rank}. {format_day(day)} — {count} keluar" for rank, (day, count) in enumerate(stats["top_weeks"], 1)]
+    lines += ["", f"Zona waktu UTC{BAN_AUDIT_UTC_OFFSET_HOURS:+g}. `/export` buat download riwayat lengkapnya (CSV)."]
+    await update.effective_message.reply_text("\n".join(lines), parse_mode='Markdown')
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [ID channel] [jumlah hari]: mengirim riwayat hasil ban chat sebagai file CSV (terbaru dulu)."""
+    target = await resolve_command_chat(update, context, action="mengambil riwayat", example="/export {chat_id} 30")
+    if target is None:
+        return
+    chat_id, label = target
+    if not ban_audit.enabled:
+        await update.effective_message.reply_text("Riwayat ban tidak diaktifkan di bot ini.")
+        return
+    # ID channel selalu negatif, jadi angka positif di argumen adalah jumlah hari
+    values = [parse_id_token(token) for token in context.args or []]
+    if any(value is None or value == 0 for value in values):
+        await update.effective_message.reply_text(
+            "Cara pakai: `/export [ID channel] [jumlah hari]`, misal `/export 30` untuk 30 hari terakhir.", parse_mode='Markdown'
+        )
+        return
+    days = next((value for value in values if value > 0), None)
+    now = int(time.time())
+    # Rentang melewati retensi (atau sejak epoch jika retensi tak terbatas) sama saja dengan seluruh riwayat
+    max_days = BAN_AUDIT_RETENTION_MONTHS * 31 if BAN_AUDIT_RETENTION_MONTHS > 0 else now // 86400
+    if days is not None and days >= max_days:
+        days = None
+    since_ts = now - days * 86400 if days else 0
+    # Record yang masih di antrian penulis ikut masuk export
+    await ban_audit.flush()
+    with tempfile.TemporaryFile() as export_file:
+        rows, truncated = await asyncio.to_thread(ban_audit.export_csv, chat_id, export_file, since_ts)
+        if not rows:
+            await update.effective_message.reply_text(f"Belum ada riwayat member keluar di {label}.", parse_mode='Markdown')
+            return
+        export_file.seek(0)
+        caption = f"📄 Riwayat {label}: {rows} baris" + (f" ({days} hari terakhir)." if days else ".")
+        if truncated:
+            caption += f"\n⚠️ Dipotong di {BAN_AUDIT_EXPORT_MAX_BYTES // 1_000_000} MB; pakai `/export <jumlah hari>` buat rentang lebih pendek."
+        await update.effective_message.reply_document(
+            document=export_file, filename=f"riwayat_ban_{chat_id}.csv", caption=caption, parse_mode='Markdown'
+        )
+
+# --- ANTRIAN DISPATCH BAN (RATE LIMIT AWARE) ---
+
+class TokenBucket:
+    """
+    Token bucket sederhana: `rate` token per detik, maksimal `capacity` token tersimpan.
+    Token boleh "berutang" (negatif) sehingga setiap reservasi langsung mendapat slot waktunya sendiri.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0 # Diisi saat Telegram membalas RetryAfter
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """Mengambil satu token dan mengembalikan berapa detik harus menunggu sebelum memakainya."""
+        self._refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return now >= self.blocked_until and self.tokens >= self.capacity
+
+class DispatchJob:
+    """Satu panggilan Bot API yang antri di BanDispatcher (ban atau notifikasi)."""
+    __slots__ = ("kind", "chat_id", "call", "on_done", "attempts", "reserved")
+
+    def __init__(self, kind: str, chat_id: int, call, on_done=None):
+        self.kind = kind # "ban", "surge_ban" atau "message"
+        self.chat_id = chat_id
+        self.call = call # Fungsi tanpa argumen yang mengembalikan coroutine panggilan API
+        self.on_done = on_done # Callback(error) setelah selesai; error None jika sukses
+        self.attempts = 0
+        self.reserved = False # True jika job sudah memegang slot di token bucket chat-nya
+
+class BanDispatcher:
+    """
+    Antrian async untuk ban_chat_member dan notifikasi, dengan token bucket global dan per chat.
+    - Ban selalu diproses lebih dulu daripada notifikasi (priority queue); ban dari chat yang sedang surge
+      ("surge_ban") berjalan di jalur terpisah paling belakang dengan batas per chat yang lebih rendah.
+    - RetryAfter dihormati: chat yang kena flood limit ditahan sampai waktu yang diminta Telegram.
+    - Error jaringan dicoba ulang dengan backoff eksponensial.
+    """
+    PRIORITY = {"ban": 0, "message": 1, "surge_ban": 2}
+    CHAT_RATES = {"ban": DISPATCH_BAN_CHAT_RATE, "message": DISPATCH_MESSAGE_CHAT_RATE, "surge_ban": SURGE_BAN_CHAT_RATE}
+
+    def __init__(self):
+        self._queue: asyncio.PriorityQueue = None
+        self._workers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._global_bucket = TokenBucket(DISPATCH_GLOBAL_RATE, DISPATCH_GLOBAL_RATE)
+        self._chat_buckets: dict[tuple[str, int], TokenBucket] = {}
+        self._pending = 0 # Job yang sudah diterima dan belum selesai (termasuk yang sedang menunggu retry)
+        self._pending_kinds = dict.fromkeys(self.PRIORITY, 0)
+        self._pending_messages: dict[int, int] = {} # chat_id -> notifikasi yang masih antri/tertunda untuk chat itu
+        self._idle: asyncio.Event = None # Di-set saat tidak ada job tertunda (untuk drain saat shutdown)
+        self.stats = {
+            "submitted": 0, "completed": 0, "failed": 0,
+            "retried": 0, "dropped_ban": 0, "dropped_message": 0, "dropped_surge_ban": 0,
+            "coalesced_message": 0, "abandoned_message": 0,
+        }
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def has_pending_message(self, chat_id: int) -> bool:
+        """True jika masih ada notifikasi untuk chat ini yang belum terkirim (menunggu slot rate limit chat-nya)."""
+        return chat_id in self._pending_messages
+
+    async def start(self) -> None:
+        self._queue = asyncio.PriorityQueue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._workers = [asyncio.create_task(self._worker(), name=f"ban-dispatch-{i}") for i in range(DISPATCH_WORKERS)]
+        logger.info("BanDispatcher berjalan dengan %s worker.", DISPATCH_WORKERS)
+
+    async def drain(self, timeout: float) -> bool:
+        """Menunggu sampai semua job tertunda selesai, paling lama `timeout` detik. Mengembalikan True jika tuntas."""
+        if self._idle is None:
+            return self._pending == 0
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+        return self._pending == 0
+
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("BanDispatcher berhenti. Statistik: %s, masih tertunda: %s", self.stats, self._pending)
+        self.stats["abandoned_message"] += self._pending_kinds['message']
+        if self._pending:
+            logger.warning(
+                "BanDispatcher berhenti dengan job belum selesai: %s ban (tetap di jurnal, diputar ulang saat startup) dan %s notifikasi (di-drop).", self._pending_kinds['ban'] + self._pending_kinds['surge_ban'], self._pending_kinds['message']
+            )
+
+    def submit_ban(self, chat_id: int, user_id: int, bot, on_done=None, surge: bool = False) -> bool:
+        """Mengantrikan ban_chat_member (surge=True: jalur lambat surge). Mengembalikan False jika antrian penuh (ban di-drop)."""
+        return self._submit(DispatchJob(
+            "surge_ban" if surge else "ban", chat_id, lambda: bot.ban_chat_member(chat_id=chat_id, user_id=user_id), on_done
+        ))
+
+    def submit_message(self, chat_id: int, bot, **kwargs) -> bool:
+        """Mengantrikan send_message (notifikasi) dengan prioritas lebih rendah dari ban."""
+        return self._submit(DispatchJob(
+            "message", chat_id, lambda: bot.send_message(chat_id=chat_id, **kwargs)
+        ))
+
+    def _submit(self, job: DispatchJob) -> bool:
+        if self._queue is None or self._pending >= DISPATCH_MAX_PENDING:
+            self.stats[f"dropped_{job.kind}"] += 1
+            logger.error("Antrian dispatch penuh/tidak aktif, %s untuk chat %s di-drop.", job.kind, job.chat_id, extra={"chat_id": job.chat_id})
+            return False
+        self._pending += 1
+        self._pending_kinds[job.kind] += 1
+        if job.kind == "message":
+            self._pending_messages[job.chat_id] = self._pending_messages.get(job.chat_id, 0) + 1
+        self._idle.clear()
+        self.stats["submitted"] += 1
+        self._enqueue(job)
+        return True
+
+    def _enqueue(self, job: DispatchJob) -> None:
+        self._queue.put_nowait((self.PRIORITY[job.kind], next(self._seq), job))
+
+    def _requeue_later(self, job: DispatchJob, delay: float) -> None:
+        asyncio.get_running_loop().call_later(delay, self._enqueue, job)
+
+    def _chat_bucket(self, job: DispatchJob) -> TokenBucket:
+        key = (job.kind, job.chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            if len(self._chat_buckets) >= 10000:
+                # Buang bucket chat yang sudah penuh kembali supaya memori tidak tumbuh terus
+                now = time.monotonic()
+                for stale_key in [k for k, b in self._chat_buckets.items() if b.is_idle(now)]:
+                    del self._chat_buckets[stale_key]
+            rate = self.CHAT_RATES[job.kind]
+            bucket = self._chat_buckets[key] = TokenBucket(rate, max(1.0, rate))
+        return bucket
+
+    async def _worker(self) -> None:
+        current_metrics_scope.set("ban_dispatcher")
+        while True:
+            _, _, job = await self._queue.get()
+            chat_bucket = self._chat_bucket(job)
+            now = time.monotonic()
+            if not job.reserved:
+                job.reserved = True
+                wait = chat_bucket.reserve(now)
+            else:
+                # Slot sudah dipesan; jika sejak itu chat kena RetryAfter, pesan slot baru setelah blokirnya selesai
+                wait = chat_bucket.blocked_until - now
+                job.reserved = wait <= 0
+            if wait > 0:
+                # Chat ini sedang dibatasi; jangan blokir worker, antrikan ulang tepat saat slotnya tiba
+                self._requeue_later(job, wait)
+                continue
+            wait = self._global_bucket.reserve(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+            job.reserved = False
+            await self._execute(job, chat_bucket)
+
+    async def _execute(self, job: DispatchJob, chat_bucket: TokenBucket) -> None:
+        job.attempts += 1
+        try:
+            await job.call()
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else float(e.retry_after)
+            chat_bucket.blocked_until = time.monotonic() + retry_after
+            self.stats["retried"] += 1
+            logger.warning("RetryAfter %ss untuk %s di chat %s, dijadwalkan ulang.", retry_after, job.kind, job.chat_id, extra={"chat_id": job.chat_id})
+            self._requeue_later(job, retry_after)
+            return
+        except (TimedOut, NetworkError) as e:
+            if job.attempts < DISPATCH_MAX_ATTEMPTS:
+                backoff = min(2 ** job.attempts, 60)
+                self.stats["retried"] += 1
+                logger.warning("%s di chat %s gagal (%s), dicoba lagi dalam %ss.", job.kind, job.chat_id, e, backoff, extra={"chat_id": job.chat_id})
+                self._requeue_later(job, backoff)
+                return
+            self._finish(job, e)
+            return
+        except Exception as e:
+            self._finish(job, e)
+            return
+        self._finish(job, None)
+
+    def _finish(self, job: DispatchJob, error: Exception) -> None:
+        self.stats["failed" if error else "completed"] += 1
+        if error and not job.on_done:
+            logger.error("%s di chat %s gagal: %s", job.kind, job.chat_id, error, extra={"chat_id": job.chat_id})
+        if job.on_done:
+            # Dipanggil sebelum job dihitung selesai, supaya notifikasi yang diantrikan callback ikut ditunggu drain()
+            try:
+                job.on_done(error)
+            except Exception as e:
+                logger.error("Callback dispatch untuk chat %s error: %s", job.chat_id, e, extra={"chat_id": job.chat_id})
+        self._pending -= 1
+        self._pending_kinds[job.kind] -= 1
+        if job.kind == "message":
+            remaining = self._pending_messages.pop(job.chat_id) - 1
+            if remaining:
+                self._pending_messages[job.chat_id] = remaining
+        if not self._pending:
+            self._idle.set()
+
+ban_dispatcher = BanDispatcher()
+
+# --- RINGKASAN (DIGEST) NOTIFIKASI BLOKIR ---
+
+def split_message_text(header: str, lines: list[str], limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> list[str]:
+    """Menggabungkan baris-baris menjadi satu atau beberapa pesan yang masing-masing tidak melebihi batas Telegram."""
+    chunks = []
+    current = header
+    for line in lines:
+        line = line[:limit - len(header) - 1] # Jaga-jaga jika satu baris saja sudah terlalu panjang
+        if len(current) + len(line) + 1 > limit:
+            chunks.append(current)
+            current = header
+        current += line + "\n"
+    if current != header:
+        chunks.append(current)
+    return chunks
+
+class NotificationDigest:
+    """
+    Mengumpulkan notifikasi blokir per tujuan (chat pribadi pemilik atau grup) dan mengirimnya
+    sebagai satu pesan gabungan setelah jendela waktu habis atau jumlah entri mencapai batas.
+    """
+
+    def __init__(self):
+        self._entries: dict[int, list[str]] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        self._bots: dict[int, object] = {}
+
+    @property
+    def pending_chats(self) -> int:
+        return len(self._entries)
+
+    def has_entries(self, chat_id: int) -> bool:
+        return chat_id in self._entries
+
+    def add(self, chat_id: int, bot, line: str) -> None:
+        entries = self._entries.setdefault(chat_id, [])
+        entries.append(line)
+        self._bots[chat_id] = bot
+        if len(entries) >= NOTIFY_DIGEST_MAX_ENTRIES:
+            self.flush(chat_id)
+        elif chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.get_running_loop().call_later(NOTIFY_DIGEST_WINDOW, self.flush, chat_id)
+
+    def flush(self, chat_id: int) -> None:
+        """Mengirim ringkasan untuk satu tujuan lewat BanDispatcher."""
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        entries = self._entries.pop(chat_id, None)
+        bot = self._bots.pop(chat_id, None)
+        if not entries:
+            return
+        header = f"📋 **Ringkasan Notifikasi Blokir** ({len(entries)} pengguna)\n\n"
+        for text in split_message_text(header, entries):
+            ban_dispatcher.submit_message(chat_id, bot, text=text, parse_mode='Markdown')
+
+    def flush_all(self) -> None:
+        for chat_id in list(self._entries):
+            self.flush(chat_id)
+
+notification_digest = NotificationDigest()
+
+def send_ban_notification(bot, chat_id: int, mode: str, text: str, digest_line: str, parse_mode: str = None) -> None:
+    """
+    Mengirim notifikasi blokir langsung (mode 'instant') atau memasukkannya ke ringkasan (mode 'digest').
+    Mode 'instant' juga masuk ringkasan selama notifikasi sebelumnya ke chat yang sama belum terkirim: saat burst,
+    penerima mendapat satu pesan gabungan per jendela digest, bukan antrian panjang yang dibatasi
+    DISPATCH_MESSAGE_CHAT_RATE (dan di-drop jika bot berhenti sebelum antrian itu habis).
+    """
+    if mode == 'digest':
+        notification_digest.add(chat_id, bot, digest_line)
+    elif ban_dispatcher.has_pending_message(chat_id) or notification_digest.has_entries(chat_id):
+        ban_dispatcher.stats["coalesced_message"] += 1
+        notification_digest.add(chat_id, bot, digest_line)
+    else:
+        ban_dispatcher.submit_message(chat_id, bot, text=text, parse_mode=parse_mode)
+
+# --- DETEKSI LONJAKAN KELUAR (SURGE MODE) ---
+
+class LeaveCounter:
+    """Penghitung event left dalam jendela geser, dibagi ke BUCKETS bucket waktu (memori tetap per chat)."""
+    __slots__ = ("counts", "head", "total")
+    BUCKETS = 12
+
+    def __init__(self):
+        self.counts = array('I', bytes(4 * self.BUCKETS))
+        self.head = 0 # Nomor bucket (waktu / lebar bucket) terakhir yang ditulis
+        self.total = 0
+
+    def add(self, now: float, window: float) -> int:
+        """Mencatat satu event dan mengembalikan jumlah event dalam jendela terakhir."""
+        slot = int(now * self.BUCKETS / window)
+        elapsed = slot - self.head
+        if elapsed >= self.BUCKETS:
+            self.counts = array('I', bytes(4 * self.BUCKETS))
+            self.total = 0
+        else:
+            # Bucket yang sudah keluar dari jendela dikosongkan
+            for expired in range(self.head + 1, slot + 1):
+                self.total -= self.counts[expired % self.BUCKETS]
+                self.counts[expired % self.BUCKETS] = 0
+        self.head = max(self.head, slot)
+        self.counts[slot % self.BUCKETS] += 1
+        self.total += 1
+        return self.total
+
+class Surge:
+    """Status satu chat yang sedang surge: siapa yang diberi tahu dan hasil ban yang dikumpulkan untuk ringkasan."""
+    __slots__ = ("chat_title", "recipients", "started", "last_hot", "leaves", "banned", "failed", "pending", "last_error", "timer")
+
+    def __init__(self, chat_title: str, recipients: tuple, now: float):
+        self.chat_title = chat_title
+        self.recipients = recipients # Tujuan notifikasi: pemilik channel, atau grup itu sendiri
+        self.started = now
+        self.last_hot = now # Terakhir kali laju keluar masih di atas separuh ambang
+        self.leaves = 0
+        self.banned = 0
+        self.failed = 0
+        self.pending = 0 # Ban surge yang belum selesai di BanDispatcher
+        self.last_error = None
+        self.timer: asyncio.TimerHandle = None
+
+class SurgeDetector:
+    """
+    Mendeteksi lonjakan event left per chat dan mengatur surge mode.
+    - Penghitung per chat disimpan di LRU berukuran SURGE_TRACKED_CHATS, jadi memori tetap terbatas
+      berapa pun jumlah chat yang dimonitor (chat yang lama sepi dibuang lebih dulu).
+    - Masuk surge: satu peringatan ke penerima notifikasi chat tersebut.
+    - Selama surge: notifikasi per user ditahan dan dihitung; setelah surge selesai dikirim satu ringkasan.
+    """
+
+    def __init__(self):
+        self._counters: OrderedDict = OrderedDict() # chat_id -> LeaveCounter
+        self._surges: dict[int, Surge] = {}
+        self.stats = {"started": 0, "ended": 0, "evicted_counters": 0}
+
+    @property
+    def active(self) -> int:
+        return len(self._surges)
+
+    @property
+    def tracked(self) -> int:
+        return len(self._counters)
+
+    def is_active(self, chat_id: int) -> bool:
+        return chat_id in self._surges
+
+    def record_leave(self, chat_id: int, chat_title: str, recipients: tuple, bot) -> bool:
+        """Mencatat satu event left; mengembalikan True jika chat sedang (atau baru saja masuk) surge."""
+        now = time.monotonic()
+        counter = self._counters.get(chat_id)
+        if counter is None:
+            if len(self._counters) >= SURGE_TRACKED_CHATS:
+                self._counters.popitem(last=False)
+                self.stats["evicted_counters"] += 1
+            counter = self._counters[chat_id] = LeaveCounter()
+        else:
+            self._counters.move_to_end(chat_id)
+        rate = counter.add(now, SURGE_WINDOW)
+        surge = self._surges.get(chat_id)
+        if surge is None:
+            if rate < SURGE_THRESHOLD:
+                return False
+            surge = self._start(chat_id, chat_title, recipients, bot, now, rate)
+        if rate * 2 >= SURGE_THRESHOLD:
+            surge.last_hot = now
+        surge.leaves += 1
+        return True
+
+    def _start(self, chat_id: int, chat_title: str, recipients: tuple, bot, now: float, rate: int) -> Surge:
+        surge = self._surges[chat_id] = Surge(chat_title, recipients, now)
+        self.stats["started"] += 1
+        logger.warning("Surge terdeteksi di chat %s (%s): %s user keluar dalam %.0f detik.", chat_id, chat_title, rate, SURGE_WINDOW, extra={"chat_id": chat_id})
+        for recipient in recipients:
+            ban_dispatcher.submit_message(
+                recipient, bot, parse_mode='Markdown',
+                text=f"🚨 **Lonjakan Keluar Terdeteksi**\n\n{rate} user keluar dari **{chat_title}** dalam {SURGE_WINDOW:.0f} detik terakhir.\n"
+                     f"Ban tetap berjalan tapi diperlambat, dan notifikasi per user digabung jadi satu ringkasan setelah lonjakan reda."
+            )
+        surge.timer = asyncio.get_running_loop().call_later(SURGE_COOLDOWN, self._check_end, chat_id, bot)
+        return surge
+
+    def ban_submitted(self, chat_id: int) -> None:
+        self._surges[chat_id].pending += 1
+
+    def ban_finished(self, chat_id: int, error: Exception) -> None:
+        """Mencatat hasil ban surge (pengganti notifikasi per user)."""
+        surge = self._surges.get(chat_id)
+        if surge is None:
+            return
+        surge.pending -= 1
+        if error is None:
+            surge.banned += 1
+        else:
+            surge.failed += 1
+            surge.last_error = str(error)
+
+    def _check_end(self, chat_id: int, bot) -> None:
+        surge = self._surges.get(chat_id)
+        if surge is None:
+            return
+        remaining = surge.last_hot + SURGE_COOLDOWN - time.monotonic()
+        if remaining > 0 or surge.pending > 0:
+            surge.timer = asyncio.get_running_loop().call_later(max(remaining, 5.0), self._check_end, chat_id, bot)
+            return
+        self._finish(chat_id, bot)
+
+    def _finish(self, chat_id: int, bot) -> None:
+        surge = self._surges.pop(chat_id)
+        if surge.timer:
+            surge.timer.cancel()
+        self.stats["ended"] += 1
+        minutes = max(1, round((time.monotonic() - surge.started) / 60))
+        logger.info("Surge di chat %s selesai: %s keluar, %s diblokir, %s gagal.", chat_id, surge.leaves, surge.banned, surge.failed)
+        text = (
+            f"📋 **Ringkasan Lonjakan Keluar — {surge.chat_title}**\n\n"
+            f"▪️ **User keluar**: {surge.leaves} (sekitar {minutes} menit)\n"
+            f"▪️ **Berhasil diblokir**: {surge.banned}\n"
+            f"▪️ **Gagal**: {surge.failed}"
+        )
+        if surge.pending:
+            text += f"\n▪️ **Masih diproses**: {surge.pending} (bot sedang restart, dilanjutkan setelah aktif lagi)"
+        if surge.last_error:
+            text += f"\n▪️ **Error terakhir**: `{surge.last_error}`"
+        for recipient in surge.recipients:
+            ban_dispatcher.submit_message(recipient, bot, text=text, parse_mode='Markdown')
+
+    def flush_all(self, bot) -> None:
+        """Mengakhiri semua surge dan mengirim ringkasannya (dipanggil saat shutdown)."""
+        for chat_id in list(self._surges):
+            self._finish(chat_id, bot)
+
+surge_detector = SurgeDetector()
+
+# --- AUDIT IZIN BOT BERKALA (JOBQUEUE) ---
+
+class PermissionAuditor:
+    """
+    Memeriksa ulang izin 'Ban Users' bot di setiap chat yang dimonitor, supaya hilangnya hak admin ketahuan
+    sebelum ada member keluar (bukan baru saat ban_chat_member gagal).
+    - run(): callback JobQueue tiap `tick` detik; memeriksa satu batch kecil dari putaran yang sedang berjalan
+      (dibatasi `concurrency`), dengan ukuran batch sehingga satu putaran mencakup semua chat dalam ~`interval`.
+      Satu jalan job hanya selama satu batch, jadi Application.stop() tidak tertahan menunggu audit.
+    - recheck(): pemeriksaan langsung satu chat setelah ban di chat itu gagal.
+    Chat yang izinnya hilang disuspend (banning dimatikan untuk semua pemilik/grupnya) sehingga keluar dari
+    monitor_rules; tidak ada ban gagal berulang, dan penerima hanya mendapat satu pemberitahuan.
+    """
+
+    def __init__(self, interval: float, tick: float, concurrency: int, recheck_window: float):
+        self.interval = interval
+        self.tick = min(tick, interval) if interval > 0 else tick
+        self.concurrency = concurrency
+        self._round = [] # Sisa chat putaran saat ini (diambil dari belakang)
+        self._batch_size = 0
+        self._round_started = 0.0
+        self._rechecks = RecentKeys(recheck_window, 10000)
+        self._tasks = set() # Referensi task recheck supaya tidak dibuang garbage collector sebelum selesai
+        self.stats = {"checked": 0, "suspended": 0, "transient_errors": 0, "rechecks": 0, "runs": 0}
+
+    async def run(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        application = context.application
+        loop = asyncio.get_running_loop()
+        if not self._round:
+            if self._round_started:
+                logger.info("Audit izin selesai satu putaran dalam %.0f detik. Statistik: %s",
+                            loop.time() - self._round_started, self.stats)
+            self._round = list(monitor_rules)
+            # Urutan diacak setiap putaran, jadi restart yang lebih sering dari interval tetap mencakup semua chat
+            random.shuffle(self._round)
+            self._batch_size = max(1, math.ceil(len(self._round) * self.tick / (self.interval * 0.9)))
+            self._round_started = loop.time() if self._round else 0.0
+            self.stats["runs"] += 1
+        batch = self._round[-self._batch_size:]
+        del self._round[-self._batch_size:]
+        gate = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(
+            self._check(application, chat_id, gate)
+            for chat_id in batch if chat_id in monitor_rules # Bisa sudah dimatikan sejak putaran dimulai
+        ))
+
+    def recheck(self, application: Application, chat_id: int) -> None:
+        """Memeriksa izin chat yang baru saja gagal diban (paling sering sekali per jendela recheck per chat)."""
+        if self._rechecks.check_and_add(chat_id):
+            return
+        self.stats["rechecks"] += 1
+        task = asyncio.get_running_loop().create_task(self._check(application, chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _check(self, application: Application, chat_id: int, gate: asyncio.Semaphore = None) -> None:
+        try:
+            async with gate or contextlib.nullcontext():
+                is_valid, message = await check_bot_ban_permissions(application.bot, chat_id, use_cache=False, raise_transient=True)
+        except (NetworkError, RetryAfter) as e:
+            self.stats["transient_errors"] += 1
+            logger.warning("Audit izin chat %s ditunda (error sementara): %s", chat_id, e, extra={"chat_id": chat_id})
+            return
+        self.stats["checked"] += 1
+        if not is_valid:
+            self.suspend(application, chat_id, message)
+
+    def suspend(self, application: Application, chat_id: int, reason: str) -> None:
+        """Mematikan banning chat ini untuk semua pemilik & grupnya, lalu memberi tahu masing-masing sekali."""
+        rule = monitor_rules.get(chat_id)
+        if rule is None:
+            return # Sudah disuspend/dimatikan
+        self.stats["suspended"] += 1
+        logger.warning("Izin ban bot di chat %s hilang (%s); banning disuspend.", chat_id, reason, extra={"chat_id": chat_id})
+        bot = application.bot
+        for owner_id in rule.owner_ids:
+            user_data = application.user_data[owner_id]
+            channels = user_data.channels or {}
+            title, _ = channels.get(chat_id, (None, False))
+            if chat_id in channels:
+                user_data.set_channel(chat_id, title, False)
+            update_channel_index(owner_id, user_data)
+            ban_dispatcher.submit_message(
+                owner_id, bot, parse_mode='Markdown',
+                text=f"🔒 **Banning Dinonaktifkan Otomatis**\n\nBot kehilangan izin ban di channel **{title or chat_id}**: {reason}\n\n"
+                     f"Jadikan bot admin dengan izin 'Ban Users' lagi, lalu aktifkan kembali dari 📋 Daftar Channel."
+            )
+        if rule.group_enabled:
+            chat_data = application.chat_data[chat_id]
+            chat_data.banning_enabled = False
+            update_group_index(chat_id, chat_data)
+            ban_dispatcher.submit_message(
+                chat_id, bot, parse_mode='Markdown',
+                text=f"🔒 **Banning Group Dinonaktifkan Otomatis**\n\nBot kehilangan izin ban di group ini: {reason}\n\n"
+                     f"Jadikan bot admin dengan izin 'Ban Users' lagi, lalu aktifkan kembali lewat /start."
+            )
+        # Perubahan ini tidak berasal dari update, jadi persistence perlu diberi tahu secara eksplisit
+        application.mark_data_for_update_persistence(
+            user_ids=rule.owner_ids, chat_ids=(chat_id,) if rule.group_enabled else None
+        )
+
+permission_auditor = PermissionAuditor(PERMISSION_AUDIT_INTERVAL, PERMISSION_AUDIT_TICK, PERMISSION_AUDIT_CONCURRENCY,
+                                       PERMISSION_RECHECK_WINDOW)
+
+# --- JURNAL BAN (WRITE-AHEAD, TAHAN RESTART/CRASH) ---
+
+# Pasangan (chat_id, user_id) yang baru saja diantrikan untuk diban
+recent_bans = RecentKeys(BAN_DEDUP_WINDOW, BAN_DEDUP_MAX_ENTRIES)
+
+class BanJournal:
+    """
+    Jurnal JSON-lines untuk niat ban. Setiap ban ditulis (dan di-fsync) ke jurnal sebelum diserahkan ke
+    BanDispatcher, lalu ditandai selesai setelah dispatcher menuntaskannya. Ban yang belum selesai saat
+    proses mati diputar ulang pada startup berikutnya, karena Telegram tidak mengirim ulang update "left".
+    Penulisan memakai group commit: semua record yang masuk selama satu fsync berjalan ditulis
+    bersama dan di-fsync sekali, sehingga saat burst jumlah fsync jauh lebih kecil dari jumlah ban.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._ids = itertools.count(1)
+        self._pending: dict[int, dict] = {} # id -> record ban yang belum ditandai selesai
+        self._buffer: list[str] = []
+        self._callbacks: list = [] # Dipanggil setelah record di buffer sudah aman di disk
+        self._wakeup: asyncio.Event = None
+        self._flusher: asyncio.Task = None
+        self._records_since_compaction = 0
+        self.stats = {"appended": 0, "done": 0, "commits": 0, "replayed": 0}
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _load(self) -> None:
+        """Membaca jurnal lama; baris terakhir yang terpotong (crash saat menulis) dilewati."""
+        if not os.path.exists(self.path):
+            return
+        last_id = 0
+        with open(self.path, "r", encoding="utf-8") as journal_file:
+            for line_number, line in enumerate(journal_file, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("Baris %s jurnal ban %s rusak, dilewati.", line_number, self.path)
+                    continue
+                if "done" in record:
+                    self._pending.pop(record["done"], None)
+                else:
+                    self._pending[record["id"]] = record
+                    last_id = max(last_id, record["id"])
+        self._ids = itertools.count(last_id + 1)
+
+    def _rewrite(self, records: list[dict]) -> None:
+        """Menulis ulang jurnal hanya berisi ban yang belum selesai (atomik lewat file sementara)."""
+        if self._file:
+            self._file.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+            for record in records:
+                tmp_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._records_since_compaction = 0
+
+    async def open(self) -> list[dict]:
+        """Memuat & memadatkan jurnal, menjalankan task group commit, dan mengembalikan ban yang perlu diputar ulang."""
+        await asyncio.to_thread(self._load)
+        await asyncio.to_thread(self._rewrite, list(self._pending.values()))
+        self._wakeup = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop(), name="ban-journal")
+        logger.info("Jurnal ban %s dibuka, %s ban belum selesai.", self.path, len(self._pending))
+        return list(self._pending.values())
+
+    async def close(self) -> None:
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        await asyncio.gather(self._flusher, return_exceptions=True)
+        self._flusher = None
+        if self._buffer:
+            await asyncio.to_thread(self._write, self._buffer)
+        self._file.close()
+        logger.info("Jurnal ban ditutup. Statistik: %s, belum selesai: %s", self.stats, len(self._pending))
+
+    def append(self, record: dict, on_durable) -> int:
+        """Menambahkan niat ban; `on_durable()` dipanggil setelah record sudah di-fsync ke disk."""
+        record["id"] = next(self._ids)
+        self._pending[record["id"]] = record
+        self.stats["appended"] += 1
+        self._enqueue(record, on_durable)
+        return record["id"]
+
+    async def flush(self) -> None:
+        """Menunggu sampai semua record yang sudah di-append ter-fsync dan callback-nya dipanggil."""
+        if self._flusher is None:
+            return
+        durable = asyncio.get_running_loop().create_future()
+        # Callback dipanggil berurutan setelah commit, jadi penanda ini selesai paling akhir
+        self._callbacks.append(lambda: durable.done() or durable.set_result(None))
+        self._wakeup.set()
+        await durable
+
+    def mark_done(self, entry_id: int) -> None:
+        if self._pending.pop(entry_id, None) is not None:
+            self.stats["done"] += 1
+            self._enqueue({"done": entry_id}, None)
+
+    def _enqueue(self, record: dict, callback) -> None:
+        self._buffer.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if callback:
+            self._callbacks.append(callback)
+        self._wakeup.set()
+
+    def _write(self, lines: list[str]) -> None:
+        self._file.write("".join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # Ambil semua yang terkumpul sejauh ini; record yang masuk selama fsync ikut commit berikutnya
+            lines, callbacks = self._buffer, self._callbacks
+            self._buffer, self._callbacks = [], []
+            try:
+                await asyncio.to_thread(self._write, lines)
+            except OSError as e:
+                # Jangan tahan ban hanya karena disk bermasalah; ban tetap dijalankan tanpa jaminan replay
+                logger.error("Gagal menulis jurnal ban %s: %s", self.path, e)
+            self.stats["commits"] += 1
+            self._records_since_compaction += len(lines)
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error("Callback jurnal ban error: %s", e)
+            if self._records_since_compaction >= BAN_JOURNAL_COMPACT_RECORDS:
+                # Snapshot diambil di event loop; buffer baru tetap aman karena ditulis setelah file diganti
+                await asyncio.to_thread(self._rewrite, list(self._pending.values()))
+
+ban_journal = BanJournal(BAN_JOURNAL_PATH)
 
 # --- FUNGSI UTAMA UNTUK MEMPROSES UPDATE ANGGOTA (DETEKSI USER KELUAR) ---
 
@@ -547,73 +3064,906 @@ async def handle_member_update(update: Update, context: ContextTypes.DEFAULT_TYP
     """
     if not update.chat_member: # Pastikan ini adalah update chat_member
         return
+    received = update_received_at.pop(update.update_id, None) # Untuk metrik latensi keluar -> ban
     
     leaving_user = update.chat_member.new_chat_member.user
     chat_id_of_event = update.chat_member.chat.id # ID chat tempat event terjadi (bisa Channel atau Group)
     chat_title_of_event = update.chat_member.chat.title # Nama chat tempat event terjadi
 
+    # Event dari channel wajib langsung memperbarui cache keanggotaan (join/left terlihat seketika)
+    if chat_id_of_event == REQUIRED_CHANNEL_ID:
+        remember_membership(leaving_user.id, update.chat_member.new_chat_member.status in ['member', 'administrator', 'creator'])
+
     # Hanya proses jika status lama adalah 'member' atau 'restricted' dan status baru adalah 'left'
     if not (update.chat_member.old_chat_member.status in ["member", "restricted"] and
             update.chat_member.new_chat_member.status == "left"):
         return # Abaikan jika bukan event meninggalkan chat
 
-    banned_successfully = False # Flag untuk menghindari double-banning/notifikasi
+    # Aturan chat ini (pemilik yang memonitor, status banning grup, target notifikasi) dalam satu lookup
+    rule = monitor_rules.get(chat_id_of_event)
+    if rule is None:
+        return # Chat ini tidak dimonitor
 
-    # 1. Cek apakah event ini terjadi di CHANNEL yang dimonitor oleh salah satu pengguna bot
-    # Iterasi melalui semua data pengguna yang disimpan oleh bot
-    for user_id_owner, user_data_owner in context.application.user_data.items():
-        # Jika channel yang dimonitor pengguna cocok dengan chat_id_of_event DAN fitur banning aktif untuk channel tersebut
-        if user_data_owner.get('monitored_channel_id') == chat_id_of_event and user_data_owner.get('banning_enabled', False):
-            try:
-                # Coba ban pengguna dari channel
-                await context.bot.ban_chat_member(chat_id=chat_id_of_event, user_id=leaving_user.id)
-                logger.info(f"Berhasil memblokir {leaving_user.full_name} dari channel {chat_id_of_event} milik user {user_id_owner} (via pengaturan pribadi)")
-                
-                # Kirim notifikasi sukses ke chat pribadi pemilik bot
-                await context.bot.send_message(
-                    chat_id=user_id_owner,
-                    text=f"✅ **Notifikasi Blokir (Channel)**\n\nPengguna berikut telah keluar dari channel **{chat_title_of_event}** dan berhasil diblokir:\n\n▪️ **Nama**: {leaving_user.full_name}\n▪️ **Username**: @{leaving_user.username or 'Tidak ada'}\n▪️ **ID**: `{leaving_user.id}`",
+    # User di allowlist chat ini (staf, bot, VIP) tidak diban
+    if allowlist.is_allowed(chat_id_of_event, leaving_user.id):
+        logger.info("%s keluar dari chat %s tapi ada di allowlist, tidak diban.", leaving_user.id, chat_id_of_event, extra={"chat_id": chat_id_of_event})
+        ban_audit.record(chat_id_of_event, leaving_user.id, "allowlisted", int(time.time()), leaving_user.full_name, leaving_user.username)
+        return
+
+    # Event yang sama (update duplikat, replay setelah reconnect) cukup diproses sekali dalam jendela dedup
+    if recent_bans.check_and_add((chat_id_of_event, leaving_user.id)):
+        logger.info("Event left duplikat untuk %s di chat %s, diabaikan.", leaving_user.id, chat_id_of_event, extra={"chat_id": chat_id_of_event})
+        return
+
+    # Laju keluar per chat dipantau; lonjakan mengalihkan chat ke surge mode (lihat SurgeDetector)
+    surge_detector.record_leave(chat_id_of_event, chat_title_of_event, rule.surge_recipients, context.bot)
+
+    # Niat ban dicatat ke jurnal lebih dulu; ban baru diantrikan setelah record aman di disk
+    record = {
+        "chat_id": chat_id_of_event, "chat_title": chat_title_of_event,
+        "user_id": leaving_user.id, "full_name": leaving_user.full_name, "username": leaving_user.username,
+        "ts": int(time.time()),
+    }
+    application = context.application
+    ban_journal.append(record, lambda: submit_journaled_ban(application, record, received))
+
+def submit_journaled_ban(application: Application, record: dict, received: float = None) -> None:
+    """
+    Menyerahkan ban yang sudah tercatat di jurnal ke BanDispatcher (dipakai untuk event baru maupun replay saat startup).
+    Setelah ban selesai (berhasil atau gagal), entri jurnal ditandai selesai dan notifikasi diantrikan.
+    `received` (time.monotonic() saat update diterima) dipakai untuk metrik latensi; None untuk replay.
+    """
+    chat_id_of_event = record["chat_id"]
+    chat_title_of_event = record["chat_title"]
+    user_id, full_name, username = record["user_id"], record["full_name"], record["username"]
+
+    rule = monitor_rules.get(chat_id_of_event)
+    if rule is None:
+        ban_journal.mark_done(record["id"]) # Fitur ban sudah dimatikan sejak niat ini dicatat
+        return
+
+    bot = application.bot
+    user_label = f"{full_name} (@{username or 'Tidak ada'}, `{user_id}`)"
+    in_surge = surge_detector.is_active(chat_id_of_event)
+
+    def on_ban_done(error: Exception) -> None:
+        """Dipanggil BanDispatcher setelah ban selesai; notifikasi diantrikan dengan prioritas lebih rendah."""
+        ban_journal.mark_done(record["id"])
+        ban_audit.record(chat_id_of_event, user_id, "banned" if error is None else "failed", record["ts"], full_name, username, error)
+        if error is None and received is not None:
+            metrics.observe("bot_leave_to_ban_seconds", time.monotonic() - received, lane="surge" if in_surge else "normal")
+        if error is None:
+            logger.info("Berhasil memblokir %s dari chat %s (pemilik channel: %s, grup aktif: %s)", full_name, chat_id_of_event, list(rule.owner_ids), rule.group_enabled, extra={"chat_id": chat_id_of_event})
+        else:
+            logger.error("Gagal memblokir %s di chat %s: %s", user_id, chat_id_of_event, error, extra={"chat_id": chat_id_of_event})
+            if isinstance(error, (Forbidden, BadRequest)):
+                # Mungkin izin ban bot sudah dicabut; jika benar, chat disuspend sebelum event left berikutnya
+                permission_auditor.recheck(application, chat_id_of_event)
+        if in_surge:
+            # Selama surge hasilnya hanya dihitung; penerima mendapat satu ringkasan saat surge selesai
+            surge_detector.ban_finished(chat_id_of_event, error)
+            return
+
+        # Pemilik yang memonitor chat ini dikabari lewat chat pribadi; grup aktif dikabari di grup itu sendiri
+        for recipient_id, mode, is_group in (rule.on_success if error is None else rule.on_failure):
+            if is_group and error is None:
+                send_ban_notification(
+                    bot, recipient_id, mode,
+                    text=f"✅ **Notifikasi Blokir (Group)**\n\nPengguna berikut telah keluar dari group ini dan berhasil diblokir:\n\n▪️ **Nama**: {full_name}\n▪️ **Username**: @{username or 'Tidak ada'}\n▪️ **ID**: `{user_id}`",
+                    digest_line=f"✅ {user_label}",
                     parse_mode='Markdown'
                 )
-                banned_successfully = True
-                break # Setelah menemukan channel yang cocok dan berhasil di-ban, berhenti iterasi
-            except Exception as e:
-                logger.error(f"Gagal memblokir {leaving_user.id} di channel {chat_id_of_event} (pengaturan pribadi): {e}")
-                # Kirim notifikasi gagal ke chat pribadi pemilik bot
-                await context.bot.send_message(
-                    chat_id=user_id_owner,
-                    text=f"❌ **Gagal Memblokir (Channel)**\n\nGagal memblokir {leaving_user.full_name} di channel **{chat_title_of_event}**.\n**Error**: `{e}`\n\nPastikan bot masih menjadi admin dengan izin ban."
+            elif is_group:
+                send_ban_notification(
+                    bot, recipient_id, mode,
+                    text=f"❌ **Gagal Memblokir (Group)**\n\nGagal memblokir {full_name} di group ini.\n**Error**: `{error}`\n\nPastikan bot masih menjadi admin dengan izin ban.",
+                    digest_line=f"❌ {user_label}: `{error}`"
                 )
-
-    # 2. Cek apakah event ini terjadi di GROUP tempat bot diaktifkan
-    # context.application.chat_data menyimpan data untuk setiap chat (group)
-    group_specific_data = context.application.chat_data.get(chat_id_of_event)
-    if group_specific_data and group_specific_data.get('banning_enabled', False):
-        if not banned_successfully: # Hanya proses jika belum di-ban oleh logika channel
-            try:
-                # Coba ban pengguna dari grup
-                await context.bot.ban_chat_member(chat_id=chat_id_of_event, user_id=leaving_user.id)
-                logger.info(f"Berhasil memblokir {leaving_user.full_name} dari group {chat_id_of_event} (via pengaturan group)")
-                
-                # Kirim notifikasi sukses ke grup itu sendiri
-                await context.bot.send_message(
-                    chat_id=chat_id_of_event,
-                    text=f"✅ **Notifikasi Blokir (Group)**\n\nPengguna berikut telah keluar dari group ini dan berhasil diblokir:\n\n▪️ **Nama**: {leaving_user.full_name}\n▪️ **Username**: @{leaving_user.username or 'Tidak ada'}\n▪️ **ID**: `{leaving_user.id}`",
+            elif error is None:
+                send_ban_notification(
+                    bot, recipient_id, mode,
+                    text=f"✅ **Notifikasi Blokir (Channel)**\n\nPengguna berikut telah keluar dari channel **{chat_title_of_event}** dan berhasil diblokir:\n\n▪️ **Nama**: {full_name}\n▪️ **Username**: @{username or 'Tidak ada'}\n▪️ **ID**: `{user_id}`",
+                    digest_line=f"✅ {user_label} — **{chat_title_of_event}**",
                     parse_mode='Markdown'
                 )
-            except Exception as e:
-                logger.error(f"Gagal memblokir {leaving_user.id} di group {chat_id_of_event} (pengaturan group): {e}")
-                # Kirim notifikasi gagal ke grup itu sendiri
-                await context.bot.send_message(
-                    chat_id=chat_id_of_event,
-                    text=f"❌ **Gagal Memblokir (Group)**\n\nGagal memblokir {leaving_user.full_name} di group ini.\n**Error**: `{e}`\n\nPastikan bot masih menjadi admin dengan izin ban."
+            else:
+                send_ban_notification(
+                    bot, recipient_id, mode,
+                    text=f"❌ **Gagal Memblokir (Channel)**\n\nGagal memblokir {full_name} di channel **{chat_title_of_event}**.\n**Error**: `{error}`\n\nPastikan bot masih menjadi admin dengan izin ban.",
+                    digest_line=f"❌ {user_label} — **{chat_title_of_event}**: `{error}`"
                 )
 
-def main() -> None:
-    """Menjalankan Bot."""
-    # PicklePersistence akan otomatis menangani penyimpanan data untuk user_data dan chat_data
-    persistence = PicklePersistence(filepath="my_bot_data.pkl")
-    application = Application.builder().token(BOT_TOKEN).persistence(persistence).build()
+    # Ban cukup dilakukan sekali per event; eksekusinya diatur BanDispatcher sesuai flood limit Telegram
+    if ban_dispatcher.submit_ban(chat_id_of_event, user_id, bot, on_done=on_ban_done, surge=in_surge) and in_surge:
+        surge_detector.ban_submitted(chat_id_of_event)
+
+# --- PEMROSESAN UPDATE: BERURUTAN PER CHAT, PARALEL ANTAR CHAT ---
+
+# Waktu (time.monotonic()) update prioritas masuk antrian, per update_id; diambil handle_member_update untuk metrik
+update_received_at: OrderedDict = OrderedDict()
+
+def is_priority_update(update: object) -> bool:
+    """Update keamanan (event keluar & perubahan status bot) yang didahulukan dari menu/perintah."""
+    return isinstance(update, Update) and (update.chat_member is not None or update.my_chat_member is not None)
+
+class PriorityUpdateQueue:
+    """
+    Antrian update Application (diisi Updater, dibaca satu per satu oleh Application) dengan dua jalur: update
+    prioritas diambil lebih dulu, sisanya tetap FIFO. Sinyal stop dari Application.stop() masuk jalur biasa,
+    jadi semua update yang sudah diterima tetap diproses sebelum berhenti.
+
+    Isinya heap (jalur, nomor urut, item) dengan Event sendiri, bukan turunan asyncio.Queue; yang disediakan
+    hanya method asyncio.Queue yang dipakai PTB (put/get/get_nowait/empty/task_done/join) plus qsize.
+    """
+
+    def __init__(self):
+        self._heap: list = []
+        self._sequence = itertools.count()
+        self._has_items = asyncio.Event()
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def put_nowait(self, item) -> None:
+        lane = 1
+        if is_priority_update(item):
+            update_received_at[item.update_id] = time.monotonic()
+            if len(update_received_at) > 10000: # Update yang di-drop sebelum sampai handler
+                update_received_at.popitem(last=False)
+            if UPDATE_PRIORITY_LANE:
+                lane = 0
+        heapq.heappush(self._heap, (lane, next(self._sequence), item))
+        self._unfinished += 1
+        self._finished.clear()
+        self._has_items.set()
+
+    async def put(self, item) -> None:
+        self.put_nowait(item) # Tanpa batas ukuran, jadi tidak pernah menunggu
+
+    def get_nowait(self):
+        if not self._heap:
+            raise asyncio.QueueEmpty
+        item = heapq.heappop(self._heap)[2]
+        if not self._heap:
+            self._has_items.clear()
+        return item
+
+    async def get(self):
+        while not self._heap:
+            await self._has_items.wait()
+        return self.get_nowait()
+
+    def task_done(self) -> None:
+        if self._unfinished <= 0:
+            raise ValueError("task_done() dipanggil lebih banyak dari jumlah item")
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+
+    async def join(self) -> None:
+        await self._finished.wait()
+
+    def qsize(self) -> int:
+        return len(self._heap)
+
+    def empty(self) -> bool:
+        return not self._heap
+
+class PrioritySlots:
+    """Semaphore dengan dua antrian tunggu: slot yang dilepas diberikan ke penunggu prioritas lebih dulu."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters = (deque(), deque()) # (prioritas, biasa), masing-masing berisi Future
+
+    async def acquire(self, urgent: bool) -> None:
+        if self._value > 0 and not self._waiters[0] and not self._waiters[1]:
+            self._value -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        lane = self._waiters[0 if urgent else 1]
+        lane.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release() # Slot sudah diserahkan ke task ini tepat sebelum dibatalkan
+            else:
+                lane.remove(waiter)
+            raise
+
+    def release(self) -> None:
+        # Slot langsung diserahkan ke penunggu berikutnya, jadi tidak bisa diserobot task baru
+        for lane in self._waiters:
+            while lane:
+                waiter = lane.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self._value += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, urgent: bool):
+        await self.acquire(urgent)
+        try:
+            yield
+        finally:
+            self.release()
+
+def allowed_update_types(application: Application) -> list[str]:
+    """
+    Jenis update yang benar-benar dipakai handler terdaftar, untuk allowed_updates di getUpdates/setWebhook,
+    supaya Telegram tidak mengirim (dan bot tidak mengurai) update yang tidak pernah ditangani.
+    Handler jenis lain yang tidak dikenali membuat fungsi ini kembali ke Update.ALL_TYPES.
+    """
+    types = set()
+
+    def collect(handler) -> bool:
+        if isinstance(handler, ConversationHandler):
+            return all(collect(inner) for inner in itertools.chain(handler.entry_points, handler.fallbacks, *handler.states.values()))
+        if isinstance(handler, ChatMemberHandler):
+            if handler.chat_member_types in (ChatMemberHandler.CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                types.add(Update.CHAT_MEMBER)
+            if handler.chat_member_types in (ChatMemberHandler.MY_CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                types.add(Update.MY_CHAT_MEMBER)
+        elif isinstance(handler, CallbackQueryHandler):
+            types.add(Update.CALLBACK_QUERY)
+        elif isinstance(handler, (CommandHandler, MessageHandler)):
+            types.add(Update.MESSAGE)
+        else:
+            logger.warning("Handler %s tidak dikenali, semua jenis update diminta.", type(handler).__name__)
+            return False
+        return True
+
+    if not all(collect(handler) for handlers in application.handlers.values() for handler in handlers):
+        return Update.ALL_TYPES
+    return sorted(types)
+
+class ChatSequentialUpdateProcessor(BaseUpdateProcessor):
+    """
+    Update processor untuk mode concurrent updates.
+    Update dari chat yang sama diproses satu per satu sesuai urutan masuk (jadi dua event chat_member
+    di chat yang sama, atau toggle dan ban yang sedang berjalan, tidak saling mendahului),
+    sedangkan update dari chat berbeda berjalan paralel hingga `max_parallel` sekaligus. Saat semua slot paralel
+    terpakai, update chat_member/my_chat_member mendapat slot berikutnya lebih dulu (lihat PrioritySlots).
+    """
+
+    def __init__(self, max_parallel: int, max_queue_per_chat: int = UPDATE_QUEUE_PER_CHAT):
+        # Semaphore bawaan BaseUpdateProcessor dipakai sebagai batas total update yang tertahan;
+        # batas paralel sebenarnya diterapkan setelah antrian per chat (lihat do_process_update),
+        # supaya satu chat yang ramai tidak menghabiskan slot milik chat lain.
+        super().__init__(max_concurrent_updates=UPDATE_MAX_PENDING)
+        self.max_parallel = max_parallel
+        self.max_queue_per_chat = max_queue_per_chat
+        self._parallel = PrioritySlots(max_parallel)
+        self._lanes: dict[int, list] = {} # key chat -> [asyncio.Lock, jumlah update di antrian chat]
+        self.stats = {"processed": 0, "dropped": 0, "max_chat_depth": 0}
+
+    @staticmethod
+    def _chat_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    def chat_depths(self) -> dict[int, int]:
+        """Snapshot jumlah update yang sedang antri/diproses per chat."""
+        return {key: lane[1] for key, lane in self._lanes.items()}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._chat_key(update)
+        urgent = UPDATE_PRIORITY_LANE and is_priority_update(update)
+        if key is None:
+            async with self._parallel.slot(urgent):
+                with pin_update_data(update):
+                    await coroutine
+            self.stats["processed"] += 1
+            return
+
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = [asyncio.Lock(), 0]
+        if lane[1] >= self.max_queue_per_chat:
+            coroutine.close()
+            self.stats["dropped"] += 1
+            logger.warning("Antrian update chat %s penuh (%s), update %s di-drop.", key, lane[1], getattr(update, 'update_id', '?'), extra={"chat_id": key})
+            return
+
+        lane[1] += 1
+        self.stats["max_chat_depth"] = max(self.stats["max_chat_depth"], lane[1])
+        try:
+            # asyncio.Lock melayani antrian secara FIFO, jadi urutan update per chat terjaga
+            async with lane[0]:
+                async with self._parallel.slot(urgent):
+                    with pin_update_data(update):
+                        await coroutine
+            self.stats["processed"] += 1
+        finally:
+            lane[1] -= 1
+            if lane[1] == 0:
+                del self._lanes[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        logger.info("ChatSequentialUpdateProcessor berhenti. Statistik: %s", self.stats)
+
+class SerialUpdateProcessor(BaseUpdateProcessor):
+    """Satu update sekaligus (CONCURRENT_UPDATES=1), dengan data user/chat update-nya dipin selama diproses."""
+
+    def __init__(self):
+        super().__init__(max_concurrent_updates=1)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        with pin_update_data(update):
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# --- PERSISTENCE (SQLITE, MODE WAL) ---
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """Unpickler untuk file PicklePersistence lama; referensi objek Bot yang tersimpan diganti None."""
+    def persistent_load(self, pid):
+        return None
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence berbasis SQLite dalam mode WAL.
+    user_data, chat_data, bot_data, dan state conversation disimpan sebagai baris terpisah,
+    jadi setiap update persistence hanya menulis baris yang isinya benar-benar berubah
+    (bukan me-pickle ulang seluruh data seperti PicklePersistence).
+    """
+
+    # Tabel yang barisnya berupa record pengaturan; disimpan ringkas sebagai tuple nilai field (lihat ConfigRecord)
+    RECORD_TYPES = {"user_data": OwnerConfig, "chat_data": GroupConfig}
+    # 2: user_data menyimpan banyak channel per pemilik (OwnerConfig.channels)
+    RECORD_FORMAT_VERSION = "2"
+
+    def __init__(self, filepath: str, update_interval: float = 60, lazy: bool = False):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.filepath = filepath
+        self.lazy = lazy # True: user_data/chat_data tidak dimuat saat startup, tapi per entri lewat LazyDataStore
+        self._conn = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key)
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+        )
+        for table in self.RECORD_TYPES:
+            # Kolom 'banning' (record punya banning aktif, lihat banning_active) supaya indeks monitor bisa dibangun tanpa membaca semua baris
+            columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            if "banning" not in columns:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN banning INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_banning ON {table} (id) WHERE banning = 1")
+        # Hash isi terakhir yang tersimpan per baris, untuk melewati penulisan yang tidak mengubah apa pun
+        self._digests: dict[str, dict[int, int]] = {"user_data": {}, "chat_data": {}, "bot_data": {}}
+        # Mode lazy: ID semua baris user_data/chat_data (8 byte per baris), supaya akses ke user/chat yang belum pernah
+        # tersimpan (misal setiap user yang keluar dari chat) dijawab dari memori tanpa query SQLite
+        self._row_ids: dict[str, CompactIntSet] = {}
+        if lazy:
+            for table in self.RECORD_TYPES:
+                rows = self._conn.execute(f"SELECT id FROM {table} ORDER BY id")
+                self._row_ids[table] = CompactIntSet.from_sorted(itertools.chain.from_iterable(rows))
+        # Blob untuk data kosong/default; baris seperti ini tidak perlu disimpan jika memang belum pernah ada
+        self._empty_blobs = {
+            table: self._encode(table, self.RECORD_TYPES[table]() if table in self.RECORD_TYPES else {})
+            for table in self._digests
+        }
+
+    # --- Helper internal ---
+
+    def _encode(self, table: str, data) -> bytes:
+        if table in self.RECORD_TYPES:
+            data = data.to_row()
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, table: str, blob: bytes):
+        data = pickle.loads(blob)
+        record_type = self.RECORD_TYPES.get(table)
+        return record_type.from_row(data) if record_type is not None else data
+
+    def _load_table(self, table: str) -> dict:
+        digests = self._digests[table]
+        result = {}
+        decode = self.RECORD_TYPES[table].from_row if table in self.RECORD_TYPES else None
+        for row_id, blob in self._conn.execute(f"SELECT id, data FROM {table}"):
+            digests[row_id] = hash(blob)
+            data = pickle.loads(blob)
+            result[row_id] = decode(data) if decode else data
+        return result
+
+    def _write_row(self, table: str, row_id: int, data) -> None:
+        record_type = self.RECORD_TYPES.get(table)
+        if record_type is not None and not isinstance(data, record_type):
+            data = record_type.from_row(data) # dict format lama (misal dari migrasi pickle)
+        blob = self._encode(table, data)
+        if blob == self._empty_blobs[table] and row_id not in self._digests[table]:
+            # Entri kosong yang belum pernah tersimpan (misal user_data otomatis untuk setiap user yang keluar dari chat)
+            return
+        digest = hash(blob)
+        if self._digests[table].get(row_id) == digest:
+            return # Isi tidak berubah sejak penulisan terakhir
+        if record_type is not None:
+            self._conn.execute(
+                f"INSERT INTO {table} (id, data, banning) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data, banning = excluded.banning",
+                (row_id, blob, int(data.banning_active))
+            )
+        else:
+            self._conn.execute(
+                f"INSERT INTO {table} (id, data) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                (row_id, blob)
+            )
+        self._digests[table][row_id] = digest
+        if table in self._row_ids:
+            self._row_ids[table].add(row_id)
+
+    def _delete_row(self, table: str, row_id: int) -> None:
+        self._conn.execute(f"DELETE FROM {table} WHERE id = ?", (row_id,))
+        self._digests[table].pop(row_id, None)
+        if table in self._row_ids:
+            self._row_ids[table].discard(row_id)
+
+    def load_row(self, table: str, row_id: int):
+        """Memuat satu baris user_data/chat_data (None jika belum ada)."""
+        if table in self._row_ids and row_id not in self._row_ids[table]:
+            return None
+        row = self._conn.execute(f"SELECT data FROM {table} WHERE id = ?", (row_id,)).fetchone()
+        if row is None:
+            return None
+        self._digests[table][row_id] = hash(row[0])
+        return self._decode(table, row[0])
+
+    def has_row(self, table: str, row_id: int) -> bool:
+        if table in self._row_ids:
+            return row_id in self._row_ids[table]
+        return self._conn.execute(f"SELECT 1 FROM {table} WHERE id = ?", (row_id,)).fetchone() is not None
+
+    def iter_rows(self, table: str, banning_only: bool = False):
+        """
+        Membaca baris satu per satu tanpa menyimpannya (untuk membangun indeks saat startup).
+        - banning_only: hanya baris dengan banning aktif (lewat partial index), baris lain tidak di-unpickle sama sekali.
+        """
+        where = " WHERE banning = 1" if banning_only else ""
+        for row_id, blob in self._conn.execute(f"SELECT id, data FROM {table}{where}"):
+            yield row_id, self._decode(table, blob)
+
+    def evict_row(self, table: str, row_id: int, data) -> None:
+        """Menulis balik entri yang dikeluarkan dari memori (jika berubah) dan melupakan hash-nya."""
+        self._write_row(table, row_id, data)
+        self._digests[table].pop(row_id, None)
+
+    def is_empty(self) -> bool:
+        """True jika database belum berisi data apa pun (misal baru dibuat)."""
+        for table in ("user_data", "chat_data", "bot_data", "conversations"):
+            if self._conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    # --- Implementasi BasePersistence ---
+
+    async def get_user_data(self) -> dict:
+        return {} if self.lazy else self._load_table("user_data")
+
+    async def get_chat_data(self) -> dict:
+        return {} if self.lazy else self._load_table("chat_data")
+
+    async def get_bot_data(self) -> dict:
+        return self._load_table("bot_data").get(0, {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = self._conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        json_key = json.dumps(list(key))
+        if new_state is None:
+            self._conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json_key))
+            return
+        self._conn.execute(
+            "INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+            "ON CONFLICT(name, key) DO UPDATE SET state = excluded.state",
+            (name, json_key, pickle.dumps(new_state, protocol=pickle.HIGHEST_PROTOCOL))
+        )
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._write_row("user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._write_row("chat_data", chat_id, data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._write_row("bot_data", 0, data)
+
+    async def update_callback_data(self, data) -> None:
+        pass # callback_data tidak disimpan (store_data.callback_data=False)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._delete_row("user_data", user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._delete_row("chat_data", chat_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # Setiap update sudah di-commit; di sini cukup memindahkan isi WAL ke file database utama
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # --- Migrasi format data ---
+
+    def migrate_records(self, batch_size: int = 1000) -> None:
+        """
+        Mengubah baris user_data/chat_data format lama (dict pickle, atau record satu channel per pemilik)
+        menjadi record terbaru, sekali jalan. Versi format dicatat di tabel meta supaya migrasi tidak diulang pada startup berikutnya.
+        """
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'record_format'").fetchone()
+        if row and row[0] == self.RECORD_FORMAT_VERSION:
+            return
+        for table in self.RECORD_TYPES:
+            migrated = 0
+            last_id = None
+            while True:
+                query = f"SELECT id, data FROM {table}" + (" WHERE id > ?" if last_id is not None else "") + " ORDER BY id LIMIT ?"
+                batch = self._conn.execute(query, (last_id, batch_size) if last_id is not None else (batch_size,)).fetchall()
+                if not batch:
+                    break
+                self._conn.execute("BEGIN")
+                for row_id, blob in batch:
+                    data = self._decode(table, blob)
+                    self._digests[table].pop(row_id, None) # Paksa tulis ulang walaupun isinya sama
+                    self._conn.execute(
+                        f"UPDATE {table} SET data = ?, banning = ? WHERE id = ?",
+                        (self._encode(table, data), int(data.banning_active), row_id)
+                    )
+                self._conn.execute("COMMIT")
+                migrated += len(batch)
+                last_id = batch[-1][0]
+            logger.info("Migrasi record: %s baris %s diubah ke format ringkas.", migrated, table)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('record_format', ?)", (self.RECORD_FORMAT_VERSION,)
+        )
+
+    # --- Migrasi dari PicklePersistence ---
+
+    def migrate_from_pickle(self, pickle_path: str, batch_size: int = 1000) -> None:
+        """
+        Memindahkan isi file PicklePersistence lama ke database ini (sekali jalan).
+        Data ditulis per batch dan dibuang dari memori sambil jalan, lalu file lama di-rename
+        menjadi '<nama>.migrated' supaya migrasi tidak terulang.
+        """
+        with open(pickle_path, "rb") as f:
+            legacy = _LegacyUnpickler(f).load()
+
+        for table in ("user_data", "chat_data"):
+            source = legacy.pop(table, None) or {}
+            migrated = 0
+            while source:
+                batch = [source.popitem() for _ in range(min(batch_size, len(source)))]
+                self._conn.execute("BEGIN")
+                for row_id, data in batch:
+                    self._write_row(table, row_id, data)
+                self._conn.execute("COMMIT")
+                migrated += len(batch)
+            logger.info("Migrasi pickle: %s baris %s dipindahkan ke %s", migrated, table, self.filepath)
+
+        if legacy.get("bot_data"):
+            self._write_row("bot_data", 0, legacy["bot_data"])
+        for name, conversation in (legacy.get("conversations") or {}).items():
+            for key, state in conversation.items():
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                    (name, json.dumps(list(key)), pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+                )
+
+        os.replace(pickle_path, pickle_path + ".migrated")
+        logger.info("Migrasi dari %s selesai.", pickle_path)
+
+class LazyDataStore(OrderedDict):
+    """
+    Pengganti dict user_data/chat_data milik Application untuk mode lazy:
+    - entri dimuat dari SQLite saat pertama kali diakses (context.user_data, application.user_data.get(...));
+    - urutan OrderedDict dipakai sebagai LRU, dan jika jumlah entri melebihi `max_entries`, entri yang
+      paling lama tidak dipakai ditulis balik ke database (hanya jika berubah) lalu dibuang dari memori;
+    - entri milik update yang sedang diproses dipin (lihat pin_update_data) dan tidak ikut dibuang, karena handler
+      bisa masih memegang objeknya melewati await; tulisan ke objek yang sudah dibuang akan hilang.
+    Indeks monitor (channel_owner_index/active_group_ids) tidak bergantung pada isi store ini, jadi tetap lengkap.
+    """
+
+    def __init__(self, persistence: SQLitePersistence, table: str, max_entries: int, factory=dict):
+        super().__init__()
+        self._persistence = persistence
+        self._table = table
+        self._factory = factory
+        self.max_entries = max_entries
+        self._pins: dict = {} # key -> jumlah update yang sedang diproses dan memakai entri ini
+        self.loads = 0
+        self.evictions = 0
+
+    def pin(self, key) -> None:
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, key) -> None:
+        remaining = self._pins.pop(key) - 1
+        if remaining:
+            self._pins[key] = remaining
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key) # Memanggil __missing__ jika belum ada di memori
+        self.move_to_end(key)
+        return value
+
+    def __missing__(self, key):
+        value = self._load(key)
+        return value if value is not None else self._store(key, self._factory())
+
+    def __contains__(self, key) -> bool:
+        return super().__contains__(key) or self._persistence.has_row(self._table, key)
+
+    def get(self, key, default=None):
+        if super().__contains__(key):
+            return self[key]
+        value = self._load(key)
+        return default if value is None else value
+
+    def _load(self, key):
+        data = self._persistence.load_row(self._table, key)
+        if data is None:
+            return None
+        self.loads += 1
+        return self._store(key, data)
+
+    def _store(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        # Entri yang baru dimuat ada di ujung LRU, jadi yang dibuang selalu entri lain yang sudah lama tidak dipakai
+        skipped = 0
+        while len(self) > self.max_entries:
+            old_key = next(iter(self))
+            if old_key in self._pins:
+                if skipped >= len(self._pins):
+                    break # Semua sisa kandidat sedang dipin; batas boleh terlampaui sampai update-nya selesai
+                self.move_to_end(old_key)
+                skipped += 1
+                continue
+            self._persistence.evict_row(self._table, old_key, self.pop(old_key))
+            self.evictions += 1
+        return value
+
+# Store lazy yang terpasang di Application (diisi install_lazy_data_stores); kosong di mode eager
+lazy_data_stores: dict[str, LazyDataStore] = {}
+
+@contextlib.contextmanager
+def pin_update_data(update: object):
+    """Menahan user_data/chat_data milik update di memori (tidak dibuang LRU) selama update itu diproses."""
+    if not lazy_data_stores or not isinstance(update, Update):
+        yield
+        return
+    pins = []
+    if update.effective_user:
+        pins.append((lazy_data_stores["user_data"], update.effective_user.id))
+    if update.effective_chat:
+        pins.append((lazy_data_stores["chat_data"], update.effective_chat.id))
+    for store, key in pins:
+        store.pin(key)
+    try:
+        yield
+    finally:
+        for store, key in pins:
+            store.unpin(key)
+
+def install_lazy_data_stores(application: Application, persistence: SQLitePersistence) -> bool:
+    """
+    Mengganti penyimpanan user_data/chat_data bawaan Application (defaultdict yang menampung semuanya) dengan
+    LazyDataStore. PTB tidak punya API publik untuk ini, jadi atribut internal _user_data/_chat_data diganti; bentuknya
+    diperiksa dulu, dan jika tidak sesuai (misal setelah upgrade PTB) bot kembali ke mode eager dengan peringatan.
+    Harus dipanggil sebelum Application.initialize(). Mengembalikan True jika mode lazy terpasang.
+    """
+    for name in ("user_data", "chat_data"):
+        internal = getattr(application, f"_{name}", None)
+        public = getattr(application, name, None)
+        compatible = isinstance(internal, dict) and not internal and isinstance(public, MappingProxyType)
+        if compatible:
+            # Pastikan mapping publik memang tampilan dari dict internal (yang dibaca CallbackContext & update_persistence)
+            internal[None] = None
+            compatible = None in public
+            del internal[None]
+        if not compatible:
+            logger.warning("Struktur %s di Application tidak dikenali (versi PTB berbeda?); data dimuat penuh saat startup.", name)
+            persistence.lazy = False
+            return False
+    for name, record_type in (("user_data", application.context_types.user_data), ("chat_data", application.context_types.chat_data)):
+        store = lazy_data_stores[name] = LazyDataStore(persistence, name, DATA_CACHE_MAX_ENTRIES, record_type)
+        setattr(application, f"_{name}", store)
+        setattr(application, name, MappingProxyType(store))
+    return True
+
+def collect_runtime_metrics(application: Application):
+    """Collector metrik untuk statistik yang sudah dihitung komponen lain (dispatcher, digest, cache, update processor)."""
+    yield ("bot_dispatch_jobs_total", "counter", "Statistik job BanDispatcher per hasil.",
+           [({"result": key}, value) for key, value in ban_dispatcher.stats.items()])
+    yield ("bot_dispatch_pending", "gauge", "Job dispatch yang belum selesai (antri atau menunggu retry).",
+           [({}, ban_dispatcher.pending)])
+    yield ("bot_ban_journal_records_total", "counter", "Record jurnal ban per jenis (appended/done/commits/replayed).",
+           [({"kind": key}, value) for key, value in ban_journal.stats.items()])
+    yield ("bot_ban_journal_pending", "gauge", "Ban di jurnal yang belum selesai.", [({}, ban_journal.pending)])
+    yield ("bot_ban_dedup_total", "counter", "Pemeriksaan dedup ban (hit = event duplikat yang diabaikan).",
+           [({"result": "hit"}, recent_bans.hits), ({"result": "miss"}, recent_bans.misses),
+            ({"result": "evicted"}, recent_bans.evictions)])
+    yield ("bot_ban_dedup_entries", "gauge", "Entri di jendela dedup ban.", [({}, len(recent_bans))])
+    for name, store in lazy_data_stores.items():
+        yield (f"bot_{name}_cache", "gauge", f"Entri {name} di memori dan aktivitas LRU lazy.",
+               [({"kind": "entries"}, len(store)), ({"kind": "loads"}, store.loads), ({"kind": "evictions"}, store.evictions)])
+    yield ("bot_digest_pending_chats", "gauge", "Chat yang punya ringkasan notifikasi belum terkirim.",
+           [({}, notification_digest.pending_chats)])
+    caches = {"bot_permission": bot_permission_cache, "membership": membership_cache}
+    yield ("bot_cache_hits_total", "counter", "Hit cache (panggilan Bot API yang dihemat).",
+           [({"cache": name}, cache.hits) for name, cache in caches.items()])
+    yield ("bot_cache_misses_total", "counter", "Miss cache.",
+           [({"cache": name}, cache.misses) for name, cache in caches.items()])
+    yield ("bot_cache_entries", "gauge", "Jumlah entri cache.",
+           [({"cache": name}, len(cache)) for name, cache in caches.items()])
+    yield ("bot_surges_total", "counter", "Surge mode yang dimulai/selesai, dan penghitung chat yang dibuang dari LRU.",
+           [({"event": key}, value) for key, value in surge_detector.stats.items()])
+    yield ("bot_surge_chats", "gauge", "Chat yang sedang surge dan chat yang punya penghitung event left.",
+           [({"kind": "active"}, surge_detector.active), ({"kind": "tracked"}, surge_detector.tracked)])
+    yield ("bot_log_records_total", "counter", "Record log yang tidak ditulis (dropped = antrian penuh, suppressed = sampling per chat).",
+           [({"result": "dropped"}, log_queue_handler.dropped if log_queue_handler else 0), ({"result": "suppressed"}, log_sampler.suppressed)])
+    if log_queue_handler:
+        yield ("bot_log_queue_depth", "gauge", "Record log yang menunggu ditulis thread QueueListener.", [({}, log_queue_handler.queue.qsize())])
+    allowlist_chats, allowlist_users, allowlist_bytes = allowlist.totals()
+    yield ("bot_allowlist", "gauge", "Isi allowlist pengecualian ban.",
+           [({"kind": "chats"}, allowlist_chats), ({"kind": "users"}, allowlist_users), ({"kind": "bytes"}, allowlist_bytes)])
+    yield ("bot_menu_renders_total", "counter", "Tampilan menu foto: dikirim baru, diedit (caption/foto), edit dilewati karena isinya sama, menu lama dihapus.",
+           [({"result": key}, value) for key, value in menu_renders.stats.items()])
+    yield ("bot_menu_render_cache_entries", "gauge", "Pesan menu yang isi terakhirnya diingat.", [({}, len(menu_renders))])
+    yield ("bot_ban_audit_records_total", "counter", "Record riwayat ban: ditulis, dibuang karena antrian penuh, jumlah batch, batch gagal.",
+           [({"result": key}, value) for key, value in ban_audit.stats.items()])
+    yield ("bot_ban_audit_pending", "gauge", "Record riwayat ban yang menunggu ditulis.", [({}, ban_audit.pending)])
+    yield ("bot_http_pool", "gauge", "Pool koneksi Bot API per lane: ukuran, sedang dipakai, puncak, dan request yang menunggu slot.",
+           [({"lane": lane, "kind": kind}, getattr(request, kind))
+            for lane, request in http_lanes.items() for kind in ("size", "in_use", "peak", "waiting")])
+    yield ("bot_http_pool_timeouts_total", "counter", "Request yang gagal karena tidak mendapat slot pool dalam BOT_API_POOL_TIMEOUT.",
+           [({"lane": lane}, request.pool_timeouts) for lane, request in http_lanes.items()])
+    yield ("bot_permission_audit_total", "counter", "Audit izin bot berkala: putaran, chat diperiksa, disuspend, error sementara, recheck setelah ban gagal.",
+           [({"result": key}, value) for key, value in permission_auditor.stats.items()])
+    yield ("bot_monitored_chats", "gauge", "Chat yang dimonitor untuk event left.",
+           [({"kind": "channel"}, len(channel_owner_index)), ({"kind": "group"}, len(active_group_ids)),
+            ({"kind": "owner"}, len(owner_channel_index)), ({"kind": "rule"}, len(monitor_rules))])
+
+    processor = application.update_processor
+    if isinstance(processor, ChatSequentialUpdateProcessor):
+        yield ("bot_updates_total", "counter", "Update yang diproses/di-drop oleh ChatSequentialUpdateProcessor.",
+               [({"result": "processed"}, processor.stats["processed"]), ({"result": "dropped"}, processor.stats["dropped"])])
+        depths = processor.chat_depths()
+        yield ("bot_update_queued_chats", "gauge", "Chat yang sedang punya update antri/diproses.", [({}, len(depths))])
+        yield ("bot_update_chat_depth_max", "gauge", "Antrian update per chat terdalam saat ini.",
+               [({}, max(depths.values(), default=0))])
+        yield ("bot_update_chat_depth_peak", "gauge", "Antrian update per chat terdalam sejak bot berjalan.",
+               [({}, processor.stats["max_chat_depth"])])
+        # Hanya 10 chat terdalam yang diberi label chat_id supaya kardinalitas metrik tetap kecil
+        busiest = sorted(depths.items(), key=lambda item: item[1], reverse=True)[:10]
+        yield ("bot_update_chat_depth", "gauge", "Kedalaman antrian update untuk chat tersibuk.",
+               [({"chat_id": chat_id}, depth) for chat_id, depth in busiest])
+
+async def post_init(application: Application) -> None:
+    """Dipanggil sekali setelah data persistence dimuat, sebelum bot mulai menerima update."""
+    build_monitor_index(application)
+    allowlist.open(ALLOWLIST_DB_PATH, legacy_db_path=PERSISTENCE_DB_PATH)
+    if BAN_AUDIT_DB_PATH:
+        ban_audit.open(BAN_AUDIT_DB_PATH)
+    await ban_dispatcher.start()
+    # Putar ulang ban yang sudah dicatat di jurnal tapi belum selesai saat proses sebelumnya berhenti
+    unfinished_bans = await ban_journal.open()
+    for record in unfinished_bans:
+        # Dicatat di dedup supaya update yang sama, jika dikirim ulang Telegram setelah restart, tidak diban dua kali
+        recent_bans.check_and_add((record["chat_id"], record["user_id"]))
+        submit_journaled_ban(application, record)
+    ban_journal.stats["replayed"] += len(unfinished_bans)
+    if unfinished_bans:
+        logger.info("%s ban dari jurnal diputar ulang.", len(unfinished_bans))
+    if PERMISSION_AUDIT_INTERVAL > 0:
+        if application.job_queue is None:
+            logger.warning('Audit izin berkala nonaktif: JobQueue butuh pip install "python-telegram-bot[job-queue]".')
+        else:
+            application.job_queue.run_repeating(
+                permission_auditor.run, interval=permission_auditor.tick, first=min(60.0, PERMISSION_AUDIT_INTERVAL),
+                name="permission_audit"
+            )
+    if METRICS_PORT:
+        metrics.add_collector(lambda: collect_runtime_metrics(application))
+        await metrics_server.start()
+    await warm_up_photo_cache(application)
+
+async def post_stop(application: Application) -> None:
+    """
+    Dipanggil setelah bot berhenti mengambil update, semua handler & job selesai dan Application.stop() sudah
+    menulis persistence untuk terakhir kalinya, tapi sebelum koneksi Bot API ditutup (Application.shutdown).
+    Di sini ban & notifikasi yang masih antri dituntaskan dalam batas SHUTDOWN_DRAIN_SECONDS, lalu data yang
+    berubah selama drain (mis. suspend karena ban gagal) ditulis lagi ke persistence secara eksplisit.
+    """
+    started = time.monotonic()
+    deadline = started + SHUTDOWN_DRAIN_SECONDS
+    logger.info("Shutdown: menuntaskan %s job dispatch (batas %.0f detik)...", ban_dispatcher.pending, SHUTDOWN_DRAIN_SECONDS)
+    # Ban yang baru dicatat di jurnal baru masuk antrian dispatcher setelah fsync-nya selesai
+    await ban_journal.flush()
+    # Sebagian waktu disisakan untuk ringkasan digest/surge, yang baru lengkap setelah ban-nya selesai
+    await ban_dispatcher.drain(SHUTDOWN_DRAIN_SECONDS * 0.8)
+    notification_digest.flush_all()
+    surge_detector.flush_all(application.bot)
+    drained = await ban_dispatcher.drain(deadline - time.monotonic())
+    await ban_dispatcher.stop()
+    # Penulisan persistence terakhir di Application.stop() terjadi sebelum drain; tulis ulang data yang ditandai sejak itu
+    await application.update_persistence()
+    logger.info("Shutdown: drain %s dalam %.1f detik.", 'selesai' if drained else 'terpotong batas waktu', time.monotonic() - started)
+
+async def post_shutdown(application: Application) -> None:
+    """Dipanggil sekali setelah bot berhenti dan persistence sudah di-flush."""
+    # Ban yang tidak sempat dituntaskan saat drain tetap tercatat belum selesai dan diputar ulang saat startup berikutnya
+    await ban_journal.close()
+    # Hasil ban yang selesai saat drain di post_stop masih di antrian penulis riwayat
+    await ban_audit.close()
+    allowlist.close()
+    await metrics_server.stop()
+    logger.info("Cache izin bot: %s hit / %s miss (hit = panggilan get_chat_member yang dihemat).", bot_permission_cache.hits, bot_permission_cache.misses)
+
+def build_application() -> Application:
+    """Membuat Application beserta persistence dan seluruh handler bot (tanpa menjalankannya)."""
+    # SQLitePersistence menyimpan user_data, chat_data & state conversation per baris di database SQLite
+    persistence = SQLitePersistence(PERSISTENCE_DB_PATH, lazy=DATA_CACHE_MAX_ENTRIES > 0)
+    if persistence.is_empty() and os.path.exists(LEGACY_PICKLE_PATH):
+        # Migrasi sekali jalan dari file PicklePersistence yang dipakai versi sebelumnya
+        persistence.migrate_from_pickle(LEGACY_PICKLE_PATH)
+    # Ubah baris dict format lama menjadi OwnerConfig/GroupConfig ringkas (tidak melakukan apa pun jika sudah)
+    persistence.migrate_records()
+    builder = Application.builder().token(BOT_TOKEN)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    application = (
+        builder
+        .persistence(persistence)
+        # Event keluar (chat_member) dan perubahan status bot didahulukan dari menu/perintah saat antrian menumpuk
+        .update_queue(PriorityUpdateQueue())
+        # user_data/chat_data berupa record ber-slots, bukan dict bebas
+        .context_types(ContextTypes(user_data=OwnerConfig, chat_data=GroupConfig))
+        # Pool koneksi terpisah untuk panggilan API dan long-polling getUpdates, dengan metrik per method & per lane
+        .request(build_request("api", BOT_API_POOL_SIZE))
+        .get_updates_request(build_request("updates", GET_UPDATES_POOL_SIZE))
+        # Jika CONCURRENT_UPDATES > 1: paralel antar chat, tetap berurutan di dalam satu chat
+        .concurrent_updates(ChatSequentialUpdateProcessor(CONCURRENT_UPDATES) if CONCURRENT_UPDATES > 1 else SerialUpdateProcessor())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    if persistence.lazy:
+        # user_data/chat_data dimuat per entri saat dipakai, dengan batas DATA_CACHE_MAX_ENTRIES entri di memori
+        install_lazy_data_stores(application, persistence)
 
     # --- DAFTAR HANDLER BOT ---
     # Handler untuk Command /start (universal untuk chat pribadi dan grup)
@@ -635,22 +3985,66 @@ def main() -> None:
     application.add_handler(conv_handler)
 
     # Handler untuk toggle fitur ban channel pribadi dan panduan cara pakai
-    application.add_handler(CallbackQueryHandler(toggle_channel_ban_callback, pattern='^toggle_channel_ban$'))
-    application.add_handler(CallbackQueryHandler(how_to_use_channel_callback, pattern='^how_to_use_channel$'))
+    application.add_handler(CallbackQueryHandler(channel_list_callback, pattern=r'^(channels:\d+|toggle_channel_ban)$'))
+    application.add_handler(CallbackQueryHandler(toggle_channel_ban_callback, pattern=r'^ch_toggle:-?\d+:\d+$'))
+    application.add_handler(CallbackQueryHandler(remove_channel_callback, pattern=r'^ch_remove:-?\d+:\d+$'))
+    application.add_handler(CallbackQueryHandler(toggle_notification_mode_callback, pattern='^toggle_notification_mode$'))
+    application.add_handler(CallbackQueryHandler(how_to_use_channel_callback, pattern='^how_to_use_channel(:resend)?$'))
     application.add_handler(CallbackQueryHandler(back_to_main_menu, pattern='^back_to_main$'))
 
     # Handler untuk toggle fitur ban group dan panduan cara pakai di grup
     application.add_handler(CallbackQueryHandler(toggle_group_ban_callback, pattern='^toggle_group_ban$'))
-    application.add_handler(CallbackQueryHandler(how_to_use_group_callback, pattern='^how_to_use_group$'))
+    application.add_handler(CallbackQueryHandler(toggle_group_notification_mode_callback, pattern='^toggle_group_notification_mode$'))
+    application.add_handler(CallbackQueryHandler(how_to_use_group_callback, pattern='^how_to_use_group(:resend)?$'))
     application.add_handler(CallbackQueryHandler(back_to_group_menu, pattern='^back_to_group_menu$'))
 
+    # Allowlist (user yang dikecualikan dari ban): di grup untuk grup itu, di chat pribadi untuk channel target
+    application.add_handler(CommandHandler("allow", allow_command))
+    application.add_handler(CommandHandler("unallow", unallow_command))
+    application.add_handler(CommandHandler("allowlist_export", allowlist_export_command))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/allowlist_import\b'), allowlist_import_document))
+
+    # Statistik & export riwayat member keluar (sasaran chat sama seperti allowlist)
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("export", export_command))
+
     # Handler universal untuk update status anggota (mendeteksi user keluar dari channel/group)
     application.add_handler(ChatMemberHandler(handle_member_update, ChatMemberHandler.CHAT_MEMBER))
+    # Handler untuk perubahan status/izin bot sendiri (memperbarui cache izin)
+    application.add_handler(ChatMemberHandler(handle_bot_member_update, ChatMemberHandler.MY_CHAT_MEMBER))
+
+    # Catat latensi & error setiap handler (murah: dua perf_counter dan satu bisect per update)
+    instrument_handlers(application)
+    return application
+
+def main() -> None:
+    """Menjalankan Bot."""
+    configure_logging()
+    try:
+        application = build_application()
+
+        if WEBHOOK_URL:
+            # --- Mode Webhook ---
+            # Telegram mengirim update ke server web lokal (proses `web:` di Procfile), jadi tidak ada long-polling.
+            logger.info("Bot running via webhook di port %s (concurrent updates: %s)...", WEBHOOK_PORT, CONCURRENT_UPDATES)
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_update_types(application),
+            )
+            return
 
-    # --- Jalankan Bot dalam Mode Polling ---
-    # Bot akan selalu berjalan dalam mode polling, cocok untuk lingkungan lokal seperti Termux.
-    logger.info("Bot running locally via polling...")
-    application.run_polling()
+        # --- Jalankan Bot dalam Mode Polling ---
+        # Mode default jika WEBHOOK_URL tidak diatur, cocok untuk lingkungan lokal seperti Termux.
+        logger.info("Bot running locally via polling (concurrent updates: %s)...", CONCURRENT_UPDATES)
+        # Hanya jenis update yang dipakai handler; chat_member wajib diminta eksplisit (tidak termasuk default Telegram)
+        application.run_polling(allowed_updates=allowed_update_types(application))
+    finally:
+        # Sisa log di antrian (termasuk log shutdown) ditulis sebelum proses keluar
+        stop_logging()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,973 @@
+"""
+Load test offline untuk bot, memakai server Bot API palsu di localhost.
+
+Server palsu melayani getUpdates, getChatMember, banChatMember, sendMessage, sendPhoto,
+editMessageCaption (dan method lain yang dipanggil bot, dijawab `true`), dengan latensi dan
+rasio error 429 yang bisa diatur. Bot dijalankan di proses yang sama lewat Main.build_application(),
+dengan BOT_API_BASE_URL diarahkan ke server palsu, jadi tidak ada satu pun request ke Telegram asli.
+
+Contoh:
+    python loadtest.py mass_leave --events 2000 --chats 20
+    python loadtest.py start_storm --events 500 --transport polling
+    python loadtest.py menu_storm --events 500 --latency-ms 50 --error-rate 0.02
+    python loadtest.py mass_leave --transport webhook --max-p99-ms 50
+    python loadtest.py mixed --transport polling --latency-ms 20   # event keluar di tengah banjir tombol menu
+    python loadtest.py multi_channel --chats 50   # satu pemilik memonitor 50 channel
+    python loadtest.py channel_pages --chats 200   # navigasi daftar channel panjang (edit caption, tanpa foto ulang)
+    python loadtest.py menu_session --events 1000 --max-calls-per-event 1.5   # panggilan API per interaksi menu
+    python loadtest.py serve --port 8081   # hanya server palsu, untuk dipakai proses Main.py terpisah
+    python loadtest.py mass_leave --events 2000 --sigterm-after 200   # SIGTERM di tengah burst, cek tidak ada ban hilang
+    BOT_API_POOL_SIZE=8 CONCURRENT_UPDATES=64 python loadtest.py menu_storm --latency-ms 50   # pool kecil: lihat tunggu/timeout pool
+    python loadtest.py startup --events 1000000   # benchmark: startup & RSS mode lazy vs eager dengan 1 juta user
+    python loadtest.py owner_scaling --events 2000   # benchmark: latensi handler left pada 100 / 10 ribu / 100 ribu pemilik
+    python loadtest.py sequencer --events 2000 --chats 200   # benchmark: update/detik serial vs paralel per chat
+    python loadtest.py records --events 100000   # benchmark: memori & ukuran user_data dict vs OwnerConfig
+    python loadtest.py logging --events 20000   # benchmark: waktu event loop di logging, stdout yang dibaca lambat
+
+Laporan: events/detik, latensi handler p50/p99 (transport direct), latensi end-to-end p50/p99
+(update dikirim -> panggilan API penanda selesai tercatat di server palsu), jumlah panggilan
+API per event, koneksi TCP yang dibuka bot, dan pemakaian pool koneksi per lane. Opsi --max-*
+membuat exit code 1 jika batas terlampaui (untuk cek regresi sebelum deploy). Ban atau notifikasi yang
+di-drop (antrian penuh, atau belum terkirim saat bot berhenti) juga membuat exit code 1.
+
+Dengan --sigterm-after N, Main.py dijalankan sebagai proses terpisah (polling ke server palsu) dan dikirimi
+SIGTERM setelah N ban tercatat, seperti saat deploy. Setelah proses keluar, setiap event left yang sudah
+diambil bot lewat getUpdates harus sudah diban atau masih tercatat di jurnal ban (diputar ulang saat startup);
+jika tidak, exit code 1.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import random
+import signal
+from urllib.parse import parse_qs
+
+FAKE_BOT_ID = 999000
+FAKE_TOKEN = f"{FAKE_BOT_ID}:LOADTEST"
+WEBHOOK_PORT = 8799
+
+# Method "overhead" yang tidak dihitung sebagai panggilan API per event
+NON_EVENT_METHODS = {"getMe", "getUpdates", "setWebhook", "deleteWebhook", "close", "logOut"}
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# --- SERVER BOT API PALSU ---
+
+class FakeBotAPI:
+    """Server HTTP minimal yang meniru Bot API. Mencatat jumlah panggilan per method dan waktu 'penanda'."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls: dict[str, int] = {}
+        self.errors_429 = 0
+        self.connections = 0 # Koneksi TCP yang dibuka klien (keep-alive jalan = angka kecil)
+        self.markers: dict[tuple, float] = {} # (jenis, id) -> waktu pertama kali tercatat
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.delivered: list[dict] = [] # Update yang sudah dikonfirmasi bot (offset getUpdates berikutnya melewatinya)
+        self._unconfirmed: list[dict] = [] # Sudah dikirim lewat getUpdates, belum dikonfirmasi; dikirim ulang seperti Telegram
+        self._message_ids: dict[int, int] = {} # Seperti Telegram: id pesan berurutan per chat (pesan user & bot)
+        self.last_photo: dict[int, int] = {} # chat_id -> message_id foto terakhir yang dikirim bot
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def api_calls(self) -> int:
+        return sum(count for method, count in self.calls.items() if method not in NON_EVENT_METHODS)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.decode("latin-1").split(" ")[1]
+                status, payload = await self._dispatch(path.rstrip("/").rsplit("/", 1)[-1], headers, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass # Koneksi ditutup klien, atau server dihentikan saat long-poll getUpdates masih menunggu
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(headers: dict, body: bytes) -> dict:
+        content_type = headers.get("content-type", "")
+        if "application/x-www-form-urlencoded" not in content_type:
+            return {} # multipart (upload file) tidak perlu diurai untuk keperluan load test
+        params = {}
+        for key, values in parse_qs(body.decode()).items():
+            try:
+                params[key] = json.loads(values[0])
+            except ValueError:
+                params[key] = values[0]
+        return params
+
+    def next_message_id(self, chat_id: int) -> int:
+        self._message_ids[chat_id] = self._message_ids.get(chat_id, 0) + 1
+        return self._message_ids[chat_id]
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        chat_type = "private" if int(chat_id) > 0 else "supergroup"
+        return {"message_id": self.next_message_id(int(chat_id)), "date": int(time.time()), "chat": {"id": int(chat_id), "type": chat_type}, **extra}
+
+    def _mark(self, kind: str, key) -> None:
+        self.markers.setdefault((kind, key), time.perf_counter())
+
+    async def _dispatch(self, method: str, headers: dict, body: bytes) -> tuple[int, dict]:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = self._parse_params(headers, body)
+
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(params)}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {
+                "id": FAKE_BOT_ID, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False,
+            }}
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and method not in NON_EVENT_METHODS and random.random() < self.error_rate:
+            self.errors_429 += 1
+            return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+
+        if method == "getChatMember":
+            user = {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "User"}
+            if user["id"] == FAKE_BOT_ID:
+                return 200, {"ok": True, "result": {
+                    "status": "administrator", "user": {**user, "is_bot": True}, "can_be_edited": False,
+                    "is_anonymous": False, "can_manage_chat": True, "can_delete_messages": True,
+                    "can_manage_video_chats": True, "can_restrict_members": True, "can_promote_members": False,
+                    "can_change_info": True, "can_invite_users": True, "can_post_stories": False,
+                    "can_edit_stories": False, "can_delete_stories": False,
+                }}
+            return 200, {"ok": True, "result": {"status": "member", "user": user}}
+        if method == "banChatMember":
+            self._mark("ban", int(params.get("user_id", 0)))
+            return 200, {"ok": True, "result": True}
+        if method == "sendMessage":
+            self._mark("message", int(params.get("chat_id", 0)))
+            return 200, {"ok": True, "result": self._message(params.get("chat_id", 0), text=params.get("text", ""))}
+        if method == "sendPhoto":
+            self._mark("photo", int(params.get("chat_id", 0)))
+            photo = [{"file_id": "loadtest-photo", "file_unique_id": "lt", "width": 800, "height": 600}]
+            message = self._message(params.get("chat_id", 0), photo=photo, caption=params.get("caption", ""))
+            self.last_photo[message["chat"]["id"]] = message["message_id"]
+            return 200, {"ok": True, "result": message}
+        if method in ("editMessageCaption", "editMessageMedia"):
+            chat_id = int(params.get("chat_id", 0))
+            self._mark("edit", chat_id)
+            photo = [{"file_id": "loadtest-photo", "file_unique_id": "lt", "width": 800, "height": 600}]
+            return 200, {"ok": True, "result": {
+                "message_id": int(params.get("message_id", 0)), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}, "photo": photo,
+                "caption": params.get("caption", ""),
+            }}
+        if method == "answerCallbackQuery":
+            self._mark("answer", str(params.get("callback_query_id", "")))
+        if method == "deleteMessage":
+            self._mark("delete", (int(params.get("chat_id", 0)), int(params.get("message_id", 0))))
+        if method == "getChat":
+            chat_id = params.get("chat_id", 0)
+            return 200, {"ok": True, "result": {
+                "id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else -1009999, "type": "channel", "title": "LoadTest",
+                "accent_color_id": 0, "max_reaction_count": 11,
+            }}
+        return 200, {"ok": True, "result": True}
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset", 0) or 0)
+        while self._unconfirmed and self._unconfirmed[0]["update_id"] < offset:
+            self.delivered.append(self._unconfirmed.pop(0))
+        if self._unconfirmed:
+            return self._unconfirmed[:100]
+        timeout = float(params.get("timeout", 0) or 0)
+        result = []
+        try:
+            result.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(result) < 100:
+            result.append(self.updates.get_nowait())
+        self._unconfirmed.extend(result)
+        return result
+
+
+# --- SKENARIO ---
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+def scenario_mass_leave(events: int, chats: int) -> tuple[dict, list]:
+    """Banyak member keluar dari `chats` channel yang dimonitor (masing-masing satu pemilik, banning aktif)."""
+    seed = {"user_data": {1000 + c: {"channels": {-1001000000 - c: (f"Channel {c}", True)}} for c in range(chats)}}
+    updates = []
+    now = int(time.time())
+    for i in range(events):
+        chat = {"id": -1001000000 - (i % chats), "type": "channel", "title": f"Channel {i % chats}"}
+        user = _user(5_000_000 + i)
+        updates.append(({"update_id": i + 1, "chat_member": {
+            "chat": chat, "from": user, "date": now,
+            "old_chat_member": {"status": "member", "user": user},
+            "new_chat_member": {"status": "left", "user": user},
+        }}, ("ban", user["id"])))
+    return seed, updates
+
+def scenario_start_storm(events: int, chats: int) -> tuple[dict, list]:
+    """Banyak pengguna berbeda mengirim /start di chat pribadi."""
+    updates = []
+    now = int(time.time())
+    for i in range(events):
+        user = _user(6_000_000 + i)
+        updates.append(({"update_id": i + 1, "message": {
+            "message_id": 1, "date": now, "chat": {"id": user["id"], "type": "private"}, "from": user,
+            "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        }}, ("photo", user["id"])))
+    return {}, updates
+
+def scenario_menu_storm(events: int, chats: int) -> tuple[dict, list]:
+    """Banyak pengguna menekan tombol menu (ganti mode notifikasi) pada pesan menu foto mereka."""
+    updates = []
+    now = int(time.time())
+    for i in range(events):
+        user = _user(7_000_000 + i)
+        message = {"message_id": 10, "date": now, "chat": {"id": user["id"], "type": "private"},
+                   "from": {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "LoadTest"},
+                   "photo": [{"file_id": "loadtest-photo", "file_unique_id": "lt", "width": 800, "height": 600}],
+                   "caption": "menu"}
+        updates.append(({"update_id": i + 1, "callback_query": {
+            "id": str(i + 1), "from": user, "chat_instance": str(user["id"]), "message": message,
+            "data": "toggle_notification_mode",
+        }}, ("edit", user["id"])))
+    return {}, updates
+
+def scenario_multi_channel(events: int, chats: int) -> tuple[dict, list]:
+    """Seperti mass_leave, tapi satu pemilik memonitor semua `chats` channel sekaligus."""
+    _, updates = scenario_mass_leave(events, chats)
+    seed = {"user_data": {1000: {"channels": {-1001000000 - c: (f"Channel {c}", True) for c in range(chats)}}}}
+    return seed, updates
+
+def scenario_channel_pages(events: int, chats: int) -> tuple[dict, list]:
+    """Pemilik dengan `chats` channel membuka halaman daftar channel (harus edit caption saja, tanpa kirim foto ulang)."""
+    channels = {-1001000000 - c: (f"Channel {c}", c % 2 == 0) for c in range(chats)}
+    seed = {"user_data": {8_000_000 + i: {"channels": dict(channels)} for i in range(events)}}
+    updates = []
+    now = int(time.time())
+    for i in range(events):
+        user = _user(8_000_000 + i)
+        message = {"message_id": 10, "date": now, "chat": {"id": user["id"], "type": "private"},
+                   "from": {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "LoadTest"},
+                   "photo": [{"file_id": "loadtest-photo", "file_unique_id": "lt", "width": 800, "height": 600}],
+                   "caption": "menu"}
+        updates.append(({"update_id": i + 1, "callback_query": {
+            "id": str(i + 1), "from": user, "chat_instance": str(user["id"]), "message": message,
+            "data": f"channels:{i % 20}",
+        }}, ("edit", user["id"])))
+    return seed, updates
+
+def scenario_mixed(events: int, chats: int) -> tuple[dict, list]:
+    """Beban campuran: setiap event ke-5 adalah member keluar, sisanya tombol menu (cek jalur prioritas chat_member)."""
+    seed, leaves = scenario_mass_leave(events // 5, chats)
+    _, taps = scenario_menu_storm(events - len(leaves), chats)
+    updates = []
+    for i in range(events):
+        data, marker = leaves.pop(0) if i % 5 == 4 and leaves else taps.pop(0)
+        updates.append(({**data, "update_id": i + 1}, marker))
+    return seed, updates
+
+def scenario_menu_session(events: int, chats: int) -> tuple[dict, list]:
+    """
+    Satu sesi menu lengkap per pengguna di chat pribadi: /start, /start lagi, panduan, kembali, panduan lagi, kembali,
+    ganti mode notifikasi, tambah channel (tombol + input ID), lalu /start. Untuk mengukur panggilan API per interaksi.
+    message_id None diisi saat update dikirim (lihat bind_message_ids), jadi pakai transport direct dengan
+    CONCURRENT_UPDATES=1 (default) supaya urutan per pengguna terjaga.
+    """
+    steps = ["/start", "/start", "how_to_use_channel", "back_to_main", "how_to_use_channel", "back_to_main",
+             "toggle_notification_mode", "set_channel", "-1009999", "/start"]
+    updates = []
+    now = int(time.time())
+    for i in range(max(1, events // len(steps))):
+        user = _user(9_000_000 + i)
+        chat = {"id": user["id"], "type": "private"}
+        for step in steps:
+            update_id = len(updates) + 1
+            if step.startswith("/") or step.startswith("-"):
+                message = {"message_id": None, "date": now, "chat": chat, "from": user, "text": step}
+                if step.startswith("/"):
+                    message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(step)}]
+                # Perintah & input channel selalu dihapus bot, jadi penghapusannya jadi penanda selesai
+                updates.append(({"update_id": update_id, "message": message}, ("delete", (user["id"], None))))
+            else:
+                menu = {"message_id": None, "date": now, "chat": chat,
+                        "from": {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "LoadTest"},
+                        "photo": [{"file_id": "loadtest-photo", "file_unique_id": "lt", "width": 800, "height": 600}],
+                        "caption": "menu"}
+                updates.append(({"update_id": update_id, "callback_query": {
+                    "id": str(update_id), "from": user, "chat_instance": str(user["id"]), "message": menu, "data": step,
+                }}, ("answer", str(update_id))))
+    return {}, updates
+
+def bind_message_ids(api: FakeBotAPI, data: dict, marker: tuple) -> tuple:
+    """
+    Mengisi message_id None tepat sebelum update dikirim: pesan user mendapat id berikutnya dari penghitung per chat
+    server palsu (seperti Telegram), dan tombol menempel di foto menu terakhir yang dikirim bot ke chat itu.
+    Mengembalikan penanda dengan message_id yang sudah terisi.
+    """
+    if "message" in data and data["message"]["message_id"] is None:
+        chat_id = data["message"]["chat"]["id"]
+        data["message"]["message_id"] = api.next_message_id(chat_id)
+        if marker[0] == "delete":
+            marker = ("delete", (chat_id, data["message"]["message_id"]))
+    elif "callback_query" in data and data["callback_query"]["message"]["message_id"] is None:
+        chat_id = data["callback_query"]["message"]["chat"]["id"]
+        data["callback_query"]["message"]["message_id"] = api.last_photo.get(chat_id, 1)
+    return marker
+
+SCENARIOS = {
+    "mass_leave": scenario_mass_leave,
+    "start_storm": scenario_start_storm,
+    "menu_storm": scenario_menu_storm,
+    "mixed": scenario_mixed,
+    "multi_channel": scenario_multi_channel,
+    "channel_pages": scenario_channel_pages,
+    "menu_session": scenario_menu_session,
+}
+
+
+# --- RUNNER ---
+
+async def run_scenario(args, api: FakeBotAPI, api_port: int) -> dict:
+    import logging
+    import Main
+    from telegram import Update
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    seed, updates = SCENARIOS[args.scenario](args.events, args.chats)
+    application = Main.build_application()
+    for owner_id, data in seed.get("user_data", {}).items():
+        await application.persistence.update_user_data(owner_id, data)
+
+    await application.initialize()
+    await application.post_init(application)
+    if args.transport == "polling":
+        await application.updater.start_polling(poll_interval=0, timeout=1, allowed_updates=Main.allowed_update_types(application))
+    elif args.transport == "webhook":
+        await application.updater.start_webhook(
+            listen="127.0.0.1", port=WEBHOOK_PORT, url_path="loadtest",
+            webhook_url=f"http://127.0.0.1:{WEBHOOK_PORT}/loadtest",
+            allowed_updates=Main.allowed_update_types(application),
+        )
+    await application.start()
+
+    sent_at: dict[tuple, float] = {}
+    handler_latencies: list[float] = []
+    calls_before = api.api_calls()
+    connections_before = api.connections
+    started = time.perf_counter()
+
+    if args.transport == "direct":
+        processor = application.update_processor
+
+        async def process(data: dict) -> None:
+            update = Update.de_json(data, application.bot)
+            t0 = time.perf_counter()
+            # Lewat update processor seperti run_polling/run_webhook (urutan per chat, pin data lazy)
+            await processor.process_update(update, application.process_update(update))
+            handler_latencies.append(time.perf_counter() - t0)
+
+        tasks = []
+        for data, marker in updates:
+            marker = bind_message_ids(api, data, marker)
+            sent_at[marker] = time.perf_counter()
+            if application.update_processor.max_concurrent_updates > 1:
+                tasks.append(asyncio.create_task(process(data)))
+            else:
+                await process(data)
+        await asyncio.gather(*tasks)
+    elif args.transport == "polling":
+        for data, marker in updates:
+            marker = bind_message_ids(api, data, marker)
+            sent_at[marker] = time.perf_counter()
+            api.updates.put_nowait(data)
+    else:
+        import httpx
+        async with httpx.AsyncClient() as client:
+            for data, marker in updates:
+                marker = bind_message_ids(api, data, marker)
+                sent_at[marker] = time.perf_counter()
+                await client.post(f"http://127.0.0.1:{WEBHOOK_PORT}/loadtest", json=data)
+
+    # Tunggu sampai semua panggilan penanda selesai tercatat (ban, foto menu, edit caption)
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline and any(marker not in api.markers for marker in sent_at):
+        await asyncio.sleep(0.02)
+    elapsed = time.perf_counter() - started
+    completed = [api.markers[m] - t for m, t in sent_at.items() if m in api.markers]
+    completed_by_kind: dict[str, list[float]] = {}
+    for marker, t in sent_at.items():
+        if marker in api.markers:
+            completed_by_kind.setdefault(marker[0], []).append(api.markers[marker] - t)
+    # Beri waktu notifikasi yang masih antri untuk terkirim sebelum menghitung panggilan API
+    while time.perf_counter() < deadline and Main.ban_dispatcher.pending:
+        await asyncio.sleep(0.02)
+
+    # Urutan sama dengan run_polling/run_webhook
+    if application.updater.running:
+        await application.updater.stop()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+    calls = api.api_calls() - calls_before
+    http_pool = {}
+    for lane, request in Main.http_lanes.items():
+        waits = Main.metrics.histograms.get(("bot_http_pool_wait_seconds", (("lane", lane),)))
+        http_pool[lane] = {
+            "size": request.size, "peak": request.peak, "timeouts": request.pool_timeouts,
+            "wait_mean_ms": waits.sum / waits.count * 1000 if waits and waits.count else 0.0,
+        }
+    return {
+        "scenario": args.scenario,
+        "transport": args.transport,
+        "events": len(updates),
+        "completed": len(completed),
+        "events_per_sec": len(completed) / elapsed if elapsed else 0.0,
+        "handler_p50_ms": percentile(handler_latencies, 50) * 1000,
+        "handler_p99_ms": percentile(handler_latencies, 99) * 1000,
+        "e2e_p50_ms": percentile(completed, 50) * 1000,
+        "e2e_p99_ms": percentile(completed, 99) * 1000,
+        "e2e_by_kind_ms": {kind: [percentile(values, 50) * 1000, percentile(values, 99) * 1000]
+                           for kind, values in sorted(completed_by_kind.items())},
+        "api_calls_per_event": calls / len(updates) if updates else 0.0,
+        "calls_by_method": dict(sorted(api.calls.items())),
+        "errors_429": api.errors_429,
+        "connections": api.connections - connections_before,
+        "http_pool": http_pool,
+        "ban_audit": dict(Main.ban_audit.stats),
+        "dispatch": {key: Main.ban_dispatcher.stats[key] for key in
+                     ("dropped_ban", "dropped_surge_ban", "dropped_message", "abandoned_message", "coalesced_message")},
+    }
+
+async def run_sigterm_check(args, api: FakeBotAPI, api_port: int) -> dict:
+    """Menjalankan Main.py sebagai proses terpisah, mengirim SIGTERM di tengah burst, lalu mencocokkan ban vs jurnal."""
+    import Main
+
+    seed, updates = SCENARIOS[args.scenario](args.events, args.chats)
+    persistence = Main.SQLitePersistence(os.environ["PERSISTENCE_DB_PATH"])
+    for owner_id, data in seed.get("user_data", {}).items():
+        await persistence.update_user_data(owner_id, data)
+    await persistence.flush()
+    for data, _ in updates:
+        api.updates.put_nowait(data)
+
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "Main.py"),
+        env={**os.environ, "WEBHOOK_URL": ""},
+        stdout=None if args.verbose else asyncio.subprocess.DEVNULL,
+        stderr=None if args.verbose else asyncio.subprocess.DEVNULL,
+    )
+    deadline = time.perf_counter() + args.timeout
+    while api.calls.get("banChatMember", 0) < args.sigterm_after and process.returncode is None and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    bans_at_signal = api.calls.get("banChatMember", 0)
+    signalled = time.perf_counter()
+    process.send_signal(signal.SIGTERM)
+    await asyncio.wait_for(process.wait(), timeout=args.timeout)
+    shutdown_seconds = time.perf_counter() - signalled
+
+    done = set()
+    with open(os.environ["BAN_JOURNAL_PATH"], encoding="utf-8") as journal_file:
+        records = [json.loads(line) for line in journal_file if line.strip()]
+    for record in records:
+        if "done" in record:
+            done.add(record["done"])
+    journaled = {record["user_id"] for record in records if "id" in record and record["id"] not in done}
+    banned = {key for kind, key in api.markers if kind == "ban"}
+    accepted = {data["chat_member"]["new_chat_member"]["user"]["id"] for data in api.delivered if "chat_member" in data}
+    return {
+        "exit_code": process.returncode,
+        "accepted": len(accepted),
+        "bans_at_signal": bans_at_signal,
+        "banned": len(banned & accepted),
+        "journaled": len(journaled & accepted),
+        "lost": len(accepted - banned - journaled),
+        "shutdown_seconds": shutdown_seconds,
+        "calls_by_method": dict(sorted(api.calls.items())),
+    }
+
+def print_sigterm_report(report: dict) -> None:
+    print("\n=== SIGTERM di tengah burst ===")
+    print(f"exit code        : {report['exit_code']}")
+    print(f"event diterima   : {report['accepted']}")
+    print(f"ban saat SIGTERM : {report['bans_at_signal']}")
+    print(f"sudah diban      : {report['banned']}")
+    print(f"tersisa di jurnal: {report['journaled']} (diputar ulang saat startup)")
+    print(f"hilang           : {report['lost']}")
+    print(f"waktu shutdown   : {report['shutdown_seconds']:.1f} s")
+    print(f"per method       : {report['calls_by_method']}")
+
+def print_report(report: dict) -> None:
+    print(f"\n=== {report['scenario']} ({report['transport']}) ===")
+    print(f"events           : {report['completed']}/{report['events']} selesai")
+    print(f"events/sec       : {report['events_per_sec']:.1f}")
+    if report["handler_p99_ms"]:
+        print(f"handler p50/p99  : {report['handler_p50_ms']:.2f} / {report['handler_p99_ms']:.2f} ms")
+    print(f"end-to-end p50/99: {report['e2e_p50_ms']:.2f} / {report['e2e_p99_ms']:.2f} ms")
+    if len(report["e2e_by_kind_ms"]) > 1:
+        for kind, (p50, p99) in report["e2e_by_kind_ms"].items():
+            print(f"  {kind:<15}: {p50:.2f} / {p99:.2f} ms")
+    print(f"API calls/event  : {report['api_calls_per_event']:.2f}")
+    print(f"429 dikirim      : {report['errors_429']}")
+    print(f"koneksi TCP baru : {report['connections']}")
+    for lane, pool in report["http_pool"].items():
+        print(f"  pool {lane:<10}: puncak {pool['peak']}/{pool['size']}, tunggu rata-rata {pool['wait_mean_ms']:.2f} ms, "
+              f"timeout {pool['timeouts']}")
+    print(f"riwayat ban      : {report['ban_audit']['written']} record dalam {report['ban_audit']['batches']} batch, "
+          f"dibuang {report['ban_audit']['dropped']}")
+    dispatch = report["dispatch"]
+    print(f"notifikasi       : {dispatch['coalesced_message']} digabung ke ringkasan, "
+          f"{dispatch['dropped_message'] + dispatch['abandoned_message']} di-drop")
+    print(f"per method       : {report['calls_by_method']}")
+
+# --- BENCHMARK (ANGKA PERFORMA YANG BISA DIULANG) ---
+# Tidak mengirim event; mengukur satu komponen bot dan mencetak angkanya. Angka di pesan commit berasal dari sini.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+async def run_child(code: str, env: dict) -> dict:
+    """Menjalankan `code` (ekspresi yang menghasilkan dict) di proses Python baru dan mengembalikan hasilnya (RSS terpisah)."""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c",
+        f"import sys, json, asyncio, logging; sys.path.insert(0, {HERE!r}); import loadtest; "
+        f"logging.disable(logging.WARNING); print(json.dumps({code}))",
+        env={**os.environ, **env}, stdout=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"proses benchmark gagal (exit code {process.returncode})")
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+def max_rss_mb() -> float:
+    """Puncak RSS proses ini. VmHWM dipakai jika ada: ru_maxrss di Linux ikut membawa puncak proses induk lewat fork/exec."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB di Linux, byte di macOS
+
+async def seed_user_database(path: str, users: int, groups: int) -> None:
+    """Database seperti produksi: `users` user (1% pemilik channel dengan banning aktif) dan `groups` grup (10% aktif)."""
+    import Main
+    persistence = Main.SQLitePersistence(path)
+    persistence.migrate_records() # Database masih kosong: hanya mencatat versi format, supaya bot tidak memigrasi ulang
+    for i in range(users):
+        record = Main.OwnerConfig(is_verified=True, last_private_menu_message_id=i % 1000 + 1)
+        if i % 100 == 0:
+            record.set_channel(-1001000000000 - i, f"Channel {i}", True)
+        await persistence.update_user_data(10_000_000 + i * 7, record)
+    for i in range(groups):
+        await persistence.update_chat_data(-1002000000000 - i, Main.GroupConfig(banning_enabled=i % 10 == 0))
+    await persistence.flush()
+
+async def measure_startup(users: int, accesses: int) -> dict:
+    """
+    Dijalankan di proses anak: waktu build_application (termasuk membuka persistence dan klien HTTP), initialize
+    (memuat user_data/chat_data di mode eager) dan indeks monitor, lalu RSS sebelum/sesudah akses acak.
+    """
+    import Main
+    started = time.perf_counter()
+    application = Main.build_application()
+    built = time.perf_counter()
+    await application.initialize()
+    initialized = time.perf_counter()
+    Main.build_monitor_index(application)
+    indexed = time.perf_counter()
+    rss_start = max_rss_mb()
+    rng = random.Random(1)
+    for _ in range(accesses):
+        application.user_data[10_000_000 + rng.randrange(users) * 7].last_private_menu_message_id += 1
+    access = time.perf_counter() - indexed
+    result = {"startup_s": indexed - started, "build_s": built - started, "initialize_s": initialized - built,
+              "index_s": indexed - initialized, "rss_start_mb": rss_start, "rss_after_mb": max_rss_mb(),
+              "access_us": access / accesses * 1e6 if accesses else 0.0, "resident": len(application.user_data)}
+    await application.shutdown()
+    return result
+
+async def bench_startup(args) -> dict:
+    """Startup & memori dengan --events user di database: mode lazy (DATA_CACHE_MAX_ENTRIES) vs eager (=0)."""
+    users, accesses = args.events, min(args.events, 100_000)
+    path = os.path.join(os.path.dirname(os.environ["PERSISTENCE_DB_PATH"]), "startup.sqlite3")
+    started = time.perf_counter()
+    await seed_user_database(path, users, users // 50)
+    report = {"user": users, "seed_s": time.perf_counter() - started, "akses_acak": accesses}
+    with open(path, "rb") as db_file:
+        while db_file.read(1 << 20):
+            pass # Isi page cache OS dulu supaya mode yang diukur pertama tidak dirugikan
+    for mode, cache in (("lazy", os.environ.get("DATA_CACHE_MAX_ENTRIES", "20000")), ("eager", "0")):
+        report[mode] = await run_child(f"asyncio.run(loadtest.measure_startup({users}, {accesses}))",
+                                       {"PERSISTENCE_DB_PATH": path, "DATA_CACHE_MAX_ENTRIES": cache})
+    return report
+
+def print_startup_report(report: dict) -> None:
+    print(f"\n=== startup ({report['user']} user, database dibuat dalam {report['seed_s']:.1f} s) ===")
+    for mode in ("lazy", "eager"):
+        result = report[mode]
+        print(f"{mode:<6}: startup {result['startup_s']:.2f} s (build {result['build_s']:.2f}, initialize "
+              f"{result['initialize_s']:.2f}, indeks {result['index_s']:.2f}), RSS {result['rss_start_mb']:.0f} MB -> "
+              f"{result['rss_after_mb']:.0f} MB setelah {report['akses_acak']} akses acak "
+              f"({result['access_us']:.1f} us/akses, {result['resident']} entri di memori)")
+
+async def scenario_report(argv: list[str]) -> dict:
+    """Dijalankan di proses anak: satu skenario dengan server palsu sendiri (state modul Main selalu baru)."""
+    args = parse_args(argv)
+    api = FakeBotAPI(latency=args.latency_ms / 1000, error_rate=args.error_rate)
+    port = await api.start()
+    os.environ["BOT_API_BASE_URL"] = f"http://127.0.0.1:{port}/bot"
+    try:
+        return await run_scenario(args, api, port)
+    finally:
+        await api.stop()
+
+def fresh_state_env(name: str) -> dict:
+    """Path database/jurnal tersendiri untuk satu proses anak, supaya hasil run sebelumnya tidak ikut terbaca."""
+    workdir = os.path.dirname(os.environ["PERSISTENCE_DB_PATH"])
+    return {"PERSISTENCE_DB_PATH": os.path.join(workdir, f"{name}.sqlite3"),
+            "BAN_JOURNAL_PATH": os.path.join(workdir, f"{name}.journal.jsonl"),
+            "BAN_AUDIT_DB_PATH": os.path.join(workdir, f"{name}.audit.sqlite3"),
+            "ALLOWLIST_DB_PATH": os.path.join(workdir, f"{name}.allowlist.sqlite3")}
+
+OWNER_SCALING_COUNTS = (100, 10_000, 100_000)
+
+async def bench_owner_scaling(args) -> dict:
+    """Latensi handler event left (mass_leave, transport direct) untuk jumlah pemilik channel yang berbeda-beda."""
+    report = {"events": args.events, "owners": {}}
+    for owners in OWNER_SCALING_COUNTS:
+        argv = ["mass_leave", "--events", str(args.events), "--chats", str(owners), "--timeout", str(args.timeout)]
+        # Rate limit dispatch dilepas: yang diukur hanya handler, dan run tidak perlu menunggu ban antri 25/detik
+        env = {**fresh_state_env(f"owners-{owners}"), "DISPATCH_GLOBAL_RATE": "1000000", "DISPATCH_BAN_CHAT_RATE": "1000000"}
+        result = await run_child(f"asyncio.run(loadtest.scenario_report({argv!r}))", env)
+        report["owners"][owners] = {key: result[key] for key in ("handler_p50_ms", "handler_p99_ms", "completed")}
+    return report
+
+def print_owner_scaling_report(report: dict) -> None:
+    print(f"\n=== owner_scaling ({report['events']} event left per ukuran) ===")
+    for owners, result in report["owners"].items():
+        print(f"{owners:>7} pemilik: handler p50 {result['handler_p50_ms'] * 1000:.0f} us, "
+              f"p99 {result['handler_p99_ms'] * 1000:.0f} us ({result['completed']}/{report['events']} selesai)")
+
+SEQUENCER_HANDLER_SECONDS = 0.01
+
+async def bench_sequencer(args) -> dict:
+    """
+    Throughput update processor dengan handler 10 ms: SerialUpdateProcessor vs ChatSequentialUpdateProcessor
+    (16 & 64 slot) untuk --events update yang tersebar di --chats chat, sambil mengecek urutan per chat tetap terjaga.
+    """
+    import Main
+    from telegram import Update
+
+    now = int(time.time())
+    updates = [Update.de_json({"update_id": i + 1, "message": {
+        "message_id": i + 1, "date": now, "chat": {"id": 7_000_000 + i % args.chats, "type": "private"},
+        "from": _user(7_000_000 + i % args.chats), "text": "ping",
+    }}, None) for i in range(args.events)]
+    report = {"events": args.events, "chats": args.chats, "handler_ms": SEQUENCER_HANDLER_SECONDS * 1000, "modes": {}}
+    for name, processor in (("serial", Main.SerialUpdateProcessor()),
+                            ("paralel 16", Main.ChatSequentialUpdateProcessor(16)),
+                            ("paralel 64", Main.ChatSequentialUpdateProcessor(64))):
+        seen: dict[int, list[int]] = {}
+
+        async def handler(update) -> None:
+            await asyncio.sleep(SEQUENCER_HANDLER_SECONDS)
+            seen.setdefault(update.effective_chat.id, []).append(update.update_id)
+
+        await processor.initialize()
+        started = time.perf_counter()
+        if processor.max_concurrent_updates > 1:
+            # Seperti Application: satu task per update, urutan per chat diatur processor
+            await asyncio.gather(*(asyncio.create_task(processor.process_update(u, handler(u))) for u in updates))
+        else:
+            for update in updates:
+                await processor.process_update(update, handler(update))
+        elapsed = time.perf_counter() - started
+        await processor.shutdown()
+        report["modes"][name] = {
+            "updates_per_sec": len(updates) / elapsed,
+            "in_order": all(ids == sorted(ids) for ids in seen.values()),
+            "processed": sum(len(ids) for ids in seen.values()),
+        }
+    return report
+
+def print_sequencer_report(report: dict) -> None:
+    print(f"\n=== sequencer ({report['events']} update di {report['chats']} chat, handler {report['handler_ms']:.0f} ms) ===")
+    for name, result in report["modes"].items():
+        print(f"{name:<11}: {result['updates_per_sec']:.0f} update/detik, {result['processed']} diproses, "
+              f"urutan per chat {'terjaga' if result['in_order'] else 'RUSAK'}")
+
+def owner_entry(i: int):
+    """OwnerConfig seperti di produksi: semua terverifikasi dan punya menu, 1% pemilik channel dengan banning aktif."""
+    import Main
+    record = Main.OwnerConfig(is_verified=True, last_private_menu_message_id=i % 1000 + 1)
+    if i % 100 == 0:
+        record.set_channel(-1001000000000 - i, f"Channel {i}", True)
+    return record
+
+async def bench_records(args) -> dict:
+    """Memori per entri, waktu baca field dan ukuran blob tersimpan: dict bebas (format lama) vs OwnerConfig, --events entri."""
+    import pickle
+    import tracemalloc
+
+    def legacy_entry(i: int) -> dict:
+        # Key yang ditulis handler versi dict: semua user terverifikasi + menu, pemilik juga channel-nya
+        entry = {"is_verified": True, "last_private_menu_message_id": i % 1000 + 1}
+        if i % 100 == 0:
+            entry.update(monitored_channel_id=-1001000000000 - i, monitored_channel_title=f"Channel {i}", banning_enabled=True)
+        return entry
+
+    report = {"entries": args.events, "formats": {}}
+    for name, make, read, row in (("dict", legacy_entry, lambda entry: entry.get("notification_mode", "instant"), lambda entry: entry),
+                                  ("OwnerConfig", owner_entry, lambda entry: entry.notification_mode, lambda entry: entry.to_row())):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        entries = {10_000_000 + i * 7: make(i) for i in range(args.events)}
+        per_entry = (tracemalloc.get_traced_memory()[0] - before) / args.events
+        tracemalloc.stop()
+        values = list(entries.values())
+        started = time.perf_counter()
+        for entry in values:
+            read(entry)
+        read_ns = (time.perf_counter() - started) / len(values) * 1e9
+        blob = sum(len(pickle.dumps(row(entry), protocol=pickle.HIGHEST_PROTOCOL)) for entry in values[:10000])
+        report["formats"][name] = {"bytes_per_entry": per_entry, "read_ns": read_ns, "blob_bytes": blob / min(len(values), 10000)}
+        del entries, values
+    return report
+
+def print_records_report(report: dict) -> None:
+    print(f"\n=== records ({report['entries']} entri user_data, termasuk kunci di dict penampung) ===")
+    for name, result in report["formats"].items():
+        print(f"{name:<11}: {result['bytes_per_entry']:.0f} B/entri di memori, baca field {result['read_ns']:.0f} ns, "
+              f"blob tersimpan {result['blob_bytes']:.0f} B")
+
+LOG_BENCH_MODES = {
+    # handler sinkron + f-string (seperti sebelum configure_logging), handler antrian teks, handler antrian JSON
+    "sync f-string": {"LOG_QUEUE": "0", "LOG_FORMAT": "text", "LOG_SAMPLE_LIMIT": "0"},
+    "queue": {"LOG_QUEUE": "1", "LOG_FORMAT": "text"},
+    "queue + json": {"LOG_QUEUE": "1", "LOG_FORMAT": "json"},
+}
+LOG_BENCH_DRAIN_BYTES_PER_SEC = 1_000_000 # Pembaca stdout lambat (misal pengumpul log platform yang tersendat)
+
+def measure_logging(mode: str, events: int, result_path: str) -> None:
+    """
+    Dijalankan di proses anak dengan stdout ke pipa yang dibaca lambat: mencatat `events` event left (info per ban,
+    error setiap event ke-5, di 20 chat) lewat jalur log bot dan mengukur waktu yang dihabiskan di pemanggilan logger.
+    Hasil ditulis ke `result_path` karena stdout dipakai untuk log.
+    """
+    import logging
+    import Main
+    logging.disable(logging.NOTSET)
+    if mode == "sync f-string":
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter(Main.LOG_TEXT_FORMAT))
+        root.addHandler(stream_handler)
+        root.setLevel(logging.INFO)
+    else:
+        Main.configure_logging()
+    logger = Main.logger
+    durations = []
+    started = time.perf_counter()
+    for i in range(events):
+        chat_id, user_id, owners = -1001000000000 - i % 20, 5_000_000 + i, [1000 + i % 20]
+        t0 = time.perf_counter()
+        if mode == "sync f-string":
+            logger.info(f"Berhasil memblokir User {user_id} dari chat {chat_id} (pemilik channel: {owners}, grup aktif: False)")
+            if i % 5 == 0:
+                logger.error(f"Gagal memblokir {user_id} di chat {chat_id}: Forbidden: bot is not a member of the channel chat")
+        else:
+            logger.info("Berhasil memblokir %s dari chat %s (pemilik channel: %s, grup aktif: %s)",
+                        f"User {user_id}", chat_id, owners, False, extra={"chat_id": chat_id})
+            if i % 5 == 0:
+                logger.error("Gagal memblokir %s di chat %s: %s", user_id, chat_id,
+                             "Forbidden: bot is not a member of the channel chat", extra={"chat_id": chat_id})
+        durations.append(time.perf_counter() - t0)
+    burst = time.perf_counter() - started
+    result = {"total_ms": sum(durations) * 1000, "p99_us": percentile(durations, 99) * 1e6, "burst_s": burst,
+              "suppressed": Main.log_sampler.suppressed,
+              "dropped": Main.log_queue_handler.dropped if Main.log_queue_handler else 0}
+    Main.stop_logging()
+    with open(result_path, "w", encoding="utf-8") as result_file:
+        json.dump(result, result_file)
+
+async def bench_logging(args) -> dict:
+    """Waktu event loop yang habis di logging saat burst --events event left, per mode LOG_BENCH_MODES."""
+    report = {"events": args.events, "drain_bytes_per_sec": LOG_BENCH_DRAIN_BYTES_PER_SEC, "modes": {}}
+    for index, (mode, env) in enumerate(LOG_BENCH_MODES.items()):
+        result_path = os.path.join(os.path.dirname(os.environ["PERSISTENCE_DB_PATH"]), f"logging-{index}.json")
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c",
+            f"import sys; sys.path.insert(0, {HERE!r}); import loadtest; "
+            f"loadtest.measure_logging({mode!r}, {args.events}, {result_path!r})",
+            env={**os.environ, **env}, stdout=asyncio.subprocess.PIPE,
+        )
+        chunk = 65536
+        output = 0
+        while data := await process.stdout.read(chunk):
+            output += len(data)
+            await asyncio.sleep(len(data) / LOG_BENCH_DRAIN_BYTES_PER_SEC)
+        if await process.wait() != 0:
+            raise RuntimeError(f"proses benchmark logging '{mode}' gagal (exit code {process.returncode})")
+        with open(result_path, encoding="utf-8") as result_file:
+            report["modes"][mode] = {**json.load(result_file), "output_mb": output / 1e6}
+    return report
+
+def print_logging_report(report: dict) -> None:
+    print(f"\n=== logging ({report['events']} event left, stdout dibaca {report['drain_bytes_per_sec'] / 1e6:.1f} MB/detik) ===")
+    for mode, result in report["modes"].items():
+        print(f"{mode:<14}: {result['total_ms']:.0f} ms di pemanggilan logger, p99 {result['p99_us']:.0f} us/event, "
+              f"burst {result['burst_s']:.2f} s, output {result['output_mb']:.1f} MB, "
+              f"di-suppress {result['suppressed']}, di-drop {result['dropped']}")
+
+BENCHMARKS = {
+    "startup": (bench_startup, print_startup_report),
+    "owner_scaling": (bench_owner_scaling, print_owner_scaling_report),
+    "sequencer": (bench_sequencer, print_sequencer_report),
+    "records": (bench_records, print_records_report),
+    "logging": (bench_logging, print_logging_report),
+}
+
+async def amain(args) -> int:
+    api = FakeBotAPI(latency=args.latency_ms / 1000, error_rate=args.error_rate)
+    port = await api.start(port=args.port)
+    if args.scenario == "serve":
+        print(f"Server Bot API palsu berjalan di http://127.0.0.1:{port}/bot (Ctrl+C untuk berhenti)")
+        try:
+            while True:
+                await asyncio.sleep(5)
+                print(f"calls: {api.calls}")
+        finally:
+            await api.stop()
+
+    os.environ["BOT_API_BASE_URL"] = f"http://127.0.0.1:{port}/bot"
+    if args.scenario in BENCHMARKS:
+        import logging
+        import Main # basicConfig di Main memasang level INFO; diturunkan sesudahnya
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        bench, print_bench = BENCHMARKS[args.scenario]
+        try:
+            report = await bench(args)
+        finally:
+            await api.stop()
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_bench(report)
+        return 0
+    if args.sigterm_after is not None:
+        try:
+            report = await run_sigterm_check(args, api, port)
+        finally:
+            await api.stop()
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_sigterm_report(report)
+        if report["lost"] or report["exit_code"] != 0:
+            print(f"REGRESI: {report['lost']} ban hilang setelah SIGTERM (exit code {report['exit_code']})", file=sys.stderr)
+            return 1
+        return 0
+
+    try:
+        report = await run_scenario(args, api, port)
+    finally:
+        await api.stop()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    failed = []
+    if report["completed"] < report["events"]:
+        failed.append(f"hanya {report['completed']}/{report['events']} event selesai dalam {args.timeout}s")
+    if args.max_p99_ms is not None and report["e2e_p99_ms"] > args.max_p99_ms:
+        failed.append(f"p99 end-to-end {report['e2e_p99_ms']:.1f} ms > {args.max_p99_ms} ms")
+    if args.max_calls_per_event is not None and report["api_calls_per_event"] > args.max_calls_per_event:
+        failed.append(f"{report['api_calls_per_event']:.2f} API calls/event > {args.max_calls_per_event}")
+    # Ban & notifikasi tidak boleh hilang: antrian penuh, atau masih antri saat bot berhenti (setelah drain)
+    lost = {key: value for key, value in report["dispatch"].items() if key != "coalesced_message" and value}
+    if lost:
+        failed.append(f"job dispatch di-drop: {lost}")
+    for reason in failed:
+        print(f"REGRESI: {reason}", file=sys.stderr)
+    return 1 if failed else 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test offline bot dengan server Bot API palsu.")
+    parser.add_argument("scenario", choices=[*SCENARIOS, *BENCHMARKS, "serve"])
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=10, help="Jumlah channel yang dimonitor (mass_leave)")
+    parser.add_argument("--transport", choices=["direct", "polling", "webhook"], default="direct")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latensi buatan per panggilan API")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Rasio respons 429 (0..1)")
+    parser.add_argument("--port", type=int, default=0, help="Port server palsu (0 = acak)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Batas waktu menunggu semua event selesai")
+    parser.add_argument("--json", action="store_true", help="Cetak laporan sebagai JSON")
+    parser.add_argument("--verbose", action="store_true", help="Tampilkan log INFO dari bot")
+    parser.add_argument("--max-p99-ms", type=float, help="Gagal jika p99 end-to-end melebihi nilai ini")
+    parser.add_argument("--max-calls-per-event", type=float, help="Gagal jika API calls/event melebihi nilai ini")
+    parser.add_argument("--sigterm-after", type=int, help="Jalankan Main.py terpisah dan kirim SIGTERM setelah N ban (cek drain saat deploy)")
+    return parser.parse_args(argv)
+
+def main() -> None:
+    args = parse_args()
+    # Semua state bot (database persistence) ditaruh di direktori sementara
+    workdir = tempfile.mkdtemp(prefix="bot-loadtest-")
+    os.environ["BOT_TOKEN"] = FAKE_TOKEN
+    os.environ.setdefault("PERSISTENCE_DB_PATH", os.path.join(workdir, "loadtest.sqlite3"))
+    os.environ.setdefault("BAN_JOURNAL_PATH", os.path.join(workdir, "ban_journal.jsonl"))
+    os.environ.setdefault("BAN_AUDIT_DB_PATH", os.path.join(workdir, "ban_audit.sqlite3"))
+    os.environ.setdefault("ALLOWLIST_DB_PATH", os.path.join(workdir, "allowlist.sqlite3"))
+    sys.exit(asyncio.run(amain(args)))
+
+if __name__ == "__main__":
+    main()